@@ -27,11 +27,11 @@
 """ Check screen (detects if Manjaro prerequisites are meet) """
 
 from gi.repository import GLib
-import subprocess
 import os
 import logging
 
 import misc.misc as misc
+import misc.block_devices as block_devices
 
 from gtkbasebox import GtkBaseBox
 
@@ -135,18 +135,10 @@ class Check(GtkBaseBox):
     @staticmethod
     def has_enough_space():
         """ Check that we have a disk or partition with enough space """
-        lsblk = subprocess.Popen(["lsblk", "-lnb"], stdout=subprocess.PIPE)
-        output = lsblk.communicate()[0].decode("utf-8").split("\n")
-
-        max_size = 0
-
-        for item in output:
-            col = item.split()
-            if len(col) >= 5:
-                if col[5] == "disk" or col[5] == "part":
-                    size = int(col[3])
-                    if size > max_size:
-                        max_size = size
+        # Called on every timer tick, the inventory answers from memory
+        sizes = [device['size'] for device in block_devices.devices()
+                 if device['type'] in ('disk', 'part')]
+        max_size = max(sizes or [0])
 
         if max_size >= MIN_ROOT_SIZE:
             return True
@@ -26,18 +26,46 @@
 
 """ Configuration module for Thus """
 
-from multiprocessing import Queue
+import copy
+import ctypes
+import pickle
+import struct
+import sys
+import timeit
+from multiprocessing import Condition, Queue, RawArray, RawValue
+
+# Shared memory set aside for the (pickled) settings
+CAPACITY = 1024 * 1024
+
+# Length of the pickled settings, stored before them
+_HEADER = struct.Struct('Q')
+
+# Values of these types are returned as they are, others are copied so
+# changing them doesn't change the stored setting
+_IMMUTABLE = (str, bytes, int, float, bool, type(None))
 
 
 class Settings(object):
-    """ Store all Thus setup options here """
+    """ Store all Thus setup options here
+
+        Settings live pickled in shared memory, along with a version that
+        changes on every set. Each process keeps them unpickled and only
+        reads them again when the version has changed, so get() is cheap.
+        Every key has a version of its own too, to wait for its changes """
+
     def __init__(self):
         """ Initialize default configuration """
 
-        # Creates a one element size queue
-        self.settings = Queue(1)
+        self._buffer = RawArray(ctypes.c_char, CAPACITY)
+        self._version = RawValue(ctypes.c_uint64, 0)
+        # Its lock guards the shared memory; notified on every set
+        self._condition = Condition()
 
-        self.settings.put({
+        # This process' copy: key -> (key version, value)
+        self._cache = {}
+        self._cache_version = 0
+
+        self._store({
             'auto_device': '/dev/sda',
 
             # In BIOS stores the disk (/dev/sdX) or the partition (/dev/sdXY)
@@ -48,6 +76,7 @@ class Settings(object):
             'bootloader_installation_successful': False,
             'btrfs': False,
             'cache': '',
+            'copy_started': False,
             'data': '/usr/share/thus/data/',
             'desktop': 'gnome',
             'desktops': [],
@@ -75,6 +104,7 @@ class Settings(object):
             'luks_root_volume': "",
             'partition_mode': 'easy',
             'password': '',
+            'prefetch_warm': {},
             'rankmirrors_done': False,
             'require_password': True,
             'root_password': '',
@@ -100,15 +130,92 @@ class Settings(object):
             'username': '',
             'z_hidden': False})
 
+    def _store(self, values):
+        """ Stores several settings at once """
+        with self._condition:
+            self._refresh()
+            version = self._cache_version + 1
+            settings = dict(self._cache)
+            for key, value in values.items():
+                if not isinstance(value, _IMMUTABLE):
+                    value = copy.deepcopy(value)
+                settings[key] = (version, value)
+            data = pickle.dumps(settings, pickle.HIGHEST_PROTOCOL)
+            if _HEADER.size + len(data) > CAPACITY:
+                raise ValueError("Settings don't fit in {0} bytes".format(CAPACITY))
+            ctypes.memmove(self._buffer, _HEADER.pack(len(data)) + data, _HEADER.size + len(data))
+            # Cache first: whoever sees the new version must see the new values
+            self._cache = settings
+            self._cache_version = version
+            self._version.value = version
+            self._condition.notify_all()
+
+    def _refresh(self):
+        """ Reads the settings again if another process (or thread) changed
+            them. Called with the lock held """
+        version = self._version.value
+        if version != self._cache_version:
+            length, = _HEADER.unpack(self._buffer[:_HEADER.size])
+            self._cache = pickle.loads(self._buffer[_HEADER.size:_HEADER.size + length])
+            self._cache_version = version
+
+    def _entry(self, key):
+        if self._version.value != self._cache_version:
+            with self._condition:
+                self._refresh()
+        return self._cache.get(key, (0, None))
+
+    def get(self, key):
+        """ Get one setting value """
+        value = self._entry(key)[1]
+        if isinstance(value, _IMMUTABLE):
+            return value
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        """ Set one setting's value """
+        self._store({key: value})
+
+    def version(self, key):
+        """ Version of a setting, it changes every time the setting is set
+            (0 if it never was) """
+        return self._entry(key)[0]
+
+    def wait_changed(self, key, version, timeout=None):
+        """ Blocks until the setting key is set again after version (see
+            version()). Returns its new version, or None on timeout """
+        with self._condition:
+            if self._condition.wait_for(lambda: self._refreshed(key)[0] != version, timeout):
+                return self._cache[key][0]
+        return None
+
+    def wait_for(self, key, timeout=None):
+        """ Blocks until the setting key is true. Returns False if timeout
+            seconds pass first """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._refreshed(key)[1], timeout)
+
+    def _refreshed(self, key):
+        self._refresh()
+        return self._cache.get(key, (0, None))
+
+
+class _QueueSettings(object):
+    """ Settings kept as they were before, in a one element Queue (each
+        get() takes the whole dict out, copies it and puts it back). Only
+        there for benchmark() to compare with """
+
+    def __init__(self, settings):
+        self.settings = Queue(1)
+        self.settings.put(settings)
+
     def _get_settings(self):
-        """ Get a copy of our settings """
         settings = self.settings.get()
-        copy = settings.copy()
+        settings_copy = settings.copy()
         self.settings.put(settings)
-        return copy
+        return settings_copy
 
     def _update_settings(self, new_settings):
-        """ Updates global settings """
         settings = self.settings.get()
         try:
             settings.update(new_settings)
@@ -116,12 +223,31 @@ class Settings(object):
             self.settings.put(settings)
 
     def get(self, key):
-        """ Get one setting value """
-        settings = self._get_settings()
-        return settings.get(key, None)
+        return self._get_settings().get(key, None)
 
     def set(self, key, value):
-        """ Set one setting's value """
         settings = self._get_settings()
         settings[key] = value
         self._update_settings(settings)
+
+
+def benchmark(rounds=10000):
+    """ Times get() and set() of Settings against the Queue store they
+        replaced. Returns {'get': (seconds, old seconds), 'set': ...},
+        per call """
+    settings = Settings()
+    defaults = dict((key, value) for key, (version, value) in settings._cache.items())
+    old_settings = _QueueSettings(defaults)
+    results = {}
+    for name, statement in (('get', "store.get('hostname')"),
+                            ('set', "store.set('hostname', 'manjaro')")):
+        results[name] = tuple(
+            timeit.timeit(statement, globals={'store': store}, number=rounds) / rounds
+            for store in (settings, old_settings))
+    return results
+
+
+if __name__ == '__main__':
+    # python config.py [rounds]
+    for name, (new, old) in sorted(benchmark(*[int(arg) for arg in sys.argv[1:2]]).items()):
+        print("{0}: {1:.2f} us (Queue: {2:.2f} us)".format(name, new * 1e6, old * 1e6))
@@ -28,7 +28,6 @@
 
 import os
 import logging
-import queue
 import shutil
 import urllib.request
 import urllib.error
@@ -208,8 +207,5 @@ class Download(object):
 
         self.last_event[event_type] = event_text
 
-        try:
-            # Add the event
-            self.callback_queue.put_nowait((event_type, event_text))
-        except queue.Full:
-            pass
+        # Add the event
+        self.callback_queue.put(event_type, event_text)
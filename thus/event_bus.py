@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  event_bus.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Channel that carries events from the installer processes to the UI """
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+# Events that only say where something is at. A newer one supersedes the
+# ones of the same type that haven't been shown yet
+PROGRESS_EVENTS = ('percent', 'downloads_percent', 'text', 'copy-progress')
+
+# Seconds between two progress events of the same type sent by a process,
+# and between two deliveries to the UI (see Slides)
+TICK = 0.1
+
+
+class EventBus(object):
+    """ Events are (event_type, event_text) pairs. Progress events are sent
+        at most once per TICK for each type, keeping only the last one, and
+        superseded ones are dropped again on delivery. All other events are
+        delivered in order, and never dropped.
+
+        put() may be called from any process started after the bus is
+        created; get_batch() is called by the UI, once per tick """
+
+    def __init__(self):
+        self._queue = multiprocessing.JoinableQueue()
+        self._dropped = multiprocessing.Value('L', 0)
+        self._delivered = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._init_sender()
+
+    def _init_sender(self):
+        """ Sender state, private to each process """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_sent = {}
+        self._timer = None
+
+    def _sender(self):
+        if self._pid != os.getpid():
+            # First event sent by a new process
+            self._init_sender()
+        return self._lock
+
+    def _drop(self):
+        with self._dropped.get_lock():
+            self._dropped.value += 1
+
+    def put(self, event_type, event_text=""):
+        """ Sends an event. Never blocks """
+        now = time.monotonic()
+        with self._sender():
+            if event_type in PROGRESS_EVENTS:
+                if event_type in self._pending:
+                    self._drop()
+                self._pending[event_type] = (event_text, now)
+                wait = self._last_sent.get(event_type, 0) + TICK - now
+                if wait <= 0:
+                    self._flush(event_type)
+                elif self._timer is None:
+                    self._timer = threading.Timer(wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+            else:
+                # Keep progress shown before whatever comes next
+                for pending_type in list(self._pending):
+                    self._flush(pending_type)
+                self._queue.put((event_type, event_text, now))
+
+    def _flush(self, event_type):
+        event_text, timestamp = self._pending.pop(event_type)
+        self._last_sent[event_type] = time.monotonic()
+        self._queue.put((event_type, event_text, timestamp))
+
+    def flush(self):
+        """ Sends the progress events held back by the rate limit """
+        with self._sender():
+            self._timer = None
+            for event_type in list(self._pending):
+                self._flush(event_type)
+
+    def join(self):
+        """ Waits until the UI has received every event sent so far """
+        self.flush()
+        self._queue.join()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def _get_all(self):
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+            self._queue.task_done()
+
+    def get_batch(self):
+        """ Returns the events received since the last call, in order, with
+            superseded progress events left out """
+        events = self._get_all()
+        last = dict((event[0], index) for index, event in enumerate(events)
+                    if event[0] in PROGRESS_EVENTS)
+        batch = []
+        now = time.monotonic()
+        for index, (event_type, event_text, timestamp) in enumerate(events):
+            if event_type in last and last[event_type] != index:
+                self._drop()
+                continue
+            latency = now - timestamp
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+            self._delivered += 1
+            batch.append((event_type, event_text))
+        return batch
+
+    def clear(self):
+        """ Throws away the events not delivered yet """
+        return len(self._get_all())
+
+    def stats(self):
+        """ Counters of the events delivered to (and dropped before) the UI,
+            and their latency in seconds """
+        delivered = self._delivered
+        return {
+            'delivered': delivered,
+            'dropped': self._dropped.value,
+            'latency_avg': self._latency_total / delivered if delivered else 0.0,
+            'latency_max': self._latency_max}
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  accounts.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Creates users and groups in the installed system by editing its passwd,
+    shadow and group files directly, instead of running useradd, usermod,
+    chfn and chown in a chroot """
+
+import crypt
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import time
+
+from installation import file_copy
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+# Lock file used by shadow-utils (lckpwdf)
+LOCK_FILE = "etc/.pwd.lock"
+
+# Number of fields of each file, in the order they are written
+DATABASES = (
+    ('passwd', 7),
+    ('shadow', 9),
+    ('group', 4),
+    ('gshadow', 4))
+
+# Used when login.defs doesn't say
+DEFAULT_UID_MIN = 1000
+DEFAULT_GID_MIN = 1000
+DEFAULT_HOME_MODE = 0o700
+
+# Characters chfn doesn't allow in the full name (they would break the
+# GECOS field, or the passwd line)
+GECOS_INVALID = ":,=\n"
+
+
+class AccountsError(Exception):
+    """ The user database can't be changed as asked """
+    pass
+
+
+class Accounts(object):
+    """ The user database of the system installed in root. Use it as a
+        context manager: the database is locked and read on entry, and the
+        files that changed are written on exit (each one atomically, through
+        a new file renamed over it), unless an exception was raised """
+
+    def __init__(self, root):
+        self.root = root
+        self.tables = {}
+        self.changed = set()
+        self._lock_fd = None
+        self.login_defs = self._read_login_defs()
+
+    def _path(self, name):
+        return os.path.join(self.root, "etc", name)
+
+    def _read_login_defs(self):
+        login_defs = {}
+        try:
+            with open(self._path("login.defs")) as defs:
+                for line in defs:
+                    fields = line.split()
+                    if len(fields) >= 2 and not fields[0].startswith('#'):
+                        login_defs[fields[0]] = fields[1]
+        except OSError:
+            pass
+        return login_defs
+
+    def __enter__(self):
+        self._lock_fd = os.open(os.path.join(self.root, LOCK_FILE),
+                                os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_EX)
+        for name, field_count in DATABASES:
+            self.tables[name] = self._read(name, field_count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                for name, field_count in DATABASES:
+                    if name in self.changed:
+                        self._write(name)
+        finally:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        return False
+
+    def _read(self, name, field_count):
+        """ Returns the entries of a database (None if the system doesn't
+            have that file), as lists of fields """
+        try:
+            with open(self._path(name)) as database:
+                lines = database.read().splitlines()
+        except FileNotFoundError:
+            return None
+        entries = []
+        for line in lines:
+            fields = line.split(':')
+            if len(fields) < field_count:
+                fields += [''] * (field_count - len(fields))
+            entries.append(fields)
+        return entries
+
+    def _write(self, name):
+        path = self._path(name)
+        new_path = path + '+'
+        st = os.stat(path)
+        text = ''.join(':'.join(fields) + '\n' for fields in self.tables[name])
+        fd = os.open(new_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+                     stat.S_IMODE(st.st_mode))
+        try:
+            os.fchown(fd, st.st_uid, st.st_gid)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            os.write(fd, text.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(new_path, path)
+        logging.debug(_("{0} updated").format(path))
+
+    def _find(self, name, key):
+        for fields in self.tables[name] or []:
+            if fields[0] == key:
+                return fields
+        return None
+
+    def _add(self, name, fields):
+        if self.tables[name] is not None:
+            self.tables[name].append(fields)
+            self.changed.add(name)
+
+    def _next_id(self, name, index, minimum):
+        used = set()
+        for fields in self.tables[name] or []:
+            try:
+                used.add(int(fields[index]))
+            except ValueError:
+                pass
+        new_id = minimum
+        while new_id in used:
+            new_id += 1
+        return new_id
+
+    def gid(self, group):
+        fields = self._find('group', group)
+        if fields is None:
+            raise AccountsError(_("Group {0} doesn't exist").format(group))
+        return int(fields[2])
+
+    def uid(self, user):
+        fields = self._find('passwd', user)
+        if fields is None:
+            raise AccountsError(_("User {0} doesn't exist").format(user))
+        return int(fields[2])
+
+    def add_group(self, group):
+        """ Adds a group (if there isn't one with that name already).
+            Returns its gid """
+        if self._find('group', group) is not None:
+            return self.gid(group)
+        gid = self._next_id('group', 2, int(self.login_defs.get('GID_MIN', DEFAULT_GID_MIN)))
+        self._add('group', [group, 'x', str(gid), ''])
+        self._add('gshadow', [group, '!', '', ''])
+        return gid
+
+    def add_user(self, user, fullname, group, groups, shell="/bin/bash"):
+        """ Adds a user whose primary group is group, and who also belongs to
+            groups. The password is locked until set_password. Returns the uid """
+        if self._find('passwd', user) is not None:
+            raise AccountsError(_("User {0} already exists").format(user))
+        if any(char in fullname for char in GECOS_INVALID):
+            raise AccountsError(_("Full name {0!r} has characters not allowed in /etc/passwd").format(
+                fullname))
+        uid = self._next_id('passwd', 2, int(self.login_defs.get('UID_MIN', DEFAULT_UID_MIN)))
+        gid = self.gid(group)
+        home = os.path.join("/home", user)
+        self._add('passwd', [user, 'x', str(uid), str(gid), fullname, home, shell])
+        self._add('shadow', [user, '!', str(self._today()), '0', '99999', '7', '', '', ''])
+        for name in ('group', 'gshadow'):
+            for fields in self.tables[name] or []:
+                if fields[0] in groups:
+                    # Members are the last field of both files
+                    members = [member for member in fields[3].split(',') if member]
+                    if user not in members:
+                        fields[3] = ','.join(members + [user])
+                        self.changed.add(name)
+        missing = set(groups) - set(entry[0] for entry in self.tables['group'])
+        if missing:
+            logging.warning(_("Groups {0} don't exist, {1} isn't added to them").format(
+                ", ".join(sorted(missing)), user))
+        return uid
+
+    def set_password(self, user, password):
+        """ Sets the password of a user (a SHA-512 hash with a random salt) """
+        fields = self._find('shadow', user)
+        if fields is None:
+            raise AccountsError(_("User {0} has no shadow entry").format(user))
+        fields[1] = crypt.crypt(password, crypt.mksalt(crypt.METHOD_SHA512))
+        fields[2] = str(self._today())
+        self.changed.add('shadow')
+
+    @staticmethod
+    def _today():
+        return int(time.time() // 86400)
+
+    def create_home(self, user):
+        """ Creates the home of user with a copy of /etc/skel, giving the user
+            everything in it as it is copied """
+        fields = self._find('passwd', user)
+        uid, gid, home = int(fields[2]), int(fields[3]), fields[5]
+        home_mode = int(self.login_defs.get('HOME_MODE', oct(DEFAULT_HOME_MODE)), 8)
+
+        home_path = os.path.join(self.root, home.lstrip('/'))
+        os.makedirs(os.path.dirname(home_path), exist_ok=True)
+        try:
+            os.mkdir(home_path, home_mode)
+        except FileExistsError:
+            # As useradd does, an existing home is left as it is
+            logging.warning(_("Home directory {0} already exists, /etc/skel isn't copied").format(
+                home))
+            os.chown(home_path, uid, gid)
+            return
+        home_fd = os.open(home_path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        try:
+            os.fchown(home_fd, uid, gid)
+            os.fchmod(home_fd, home_mode)
+            skel_path = self._path("skel")
+            if os.path.isdir(skel_path):
+                skel_fd = os.open(skel_path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    self._copy_tree(skel_fd, home_fd, uid, gid)
+                finally:
+                    os.close(skel_fd)
+        except OSError:
+            # Don't leave half a home behind
+            shutil.rmtree(home_path, ignore_errors=True)
+            raise
+        finally:
+            os.close(home_fd)
+
+    def _copy_tree(self, src_dir_fd, dst_dir_fd, uid, gid):
+        """ Copies the contents of a directory, owned by uid:gid """
+        for entry in os.scandir(src_dir_fd):
+            name = entry.name
+            st = entry.stat(follow_symlinks=False)
+            mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISDIR(st.st_mode):
+                os.mkdir(name, mode, dir_fd=dst_dir_fd)
+                os.chown(name, uid, gid, dir_fd=dst_dir_fd, follow_symlinks=False)
+                os.chmod(name, mode, dir_fd=dst_dir_fd)
+                src_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                                 dir_fd=src_dir_fd)
+                dst_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                                 dir_fd=dst_dir_fd)
+                try:
+                    self._copy_tree(src_fd, dst_fd, uid, gid)
+                finally:
+                    os.close(src_fd)
+                    os.close(dst_fd)
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(name, dir_fd=src_dir_fd), name, dir_fd=dst_dir_fd)
+                os.chown(name, uid, gid, dir_fd=dst_dir_fd, follow_symlinks=False)
+            elif stat.S_ISREG(st.st_mode):
+                src_fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=src_dir_fd)
+                try:
+                    dst_fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600,
+                                     dir_fd=dst_dir_fd)
+                    try:
+                        file_copy.copy_data(src_fd, dst_fd, st.st_size)
+                        os.fchown(dst_fd, uid, gid)
+                        os.fchmod(dst_fd, mode)
+                    finally:
+                        os.close(dst_fd)
+                finally:
+                    os.close(src_fd)
+            else:
+                logging.debug(_("Skipping special file {0} in /etc/skel").format(name))
@@ -27,13 +27,15 @@
 """ Installation advanced module. Custom partition screen """
 import os.path
 
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
+import concurrent.futures
 import subprocess
 import os
 import logging
 
 import misc.misc as misc
 import misc.gtkwidgets as gtkwidgets
+import misc.udev_monitor as udev_monitor
 import misc.validation as validation
 
 import parted3.partition_module as pm
@@ -42,6 +44,7 @@ import parted3.lvm as lvm
 import parted3.used_space as used_space
 
 from installation import process as installation_process
+from installation import partition_model
 import show_message as show
 
 from gtkbasebox import GtkBaseBox
@@ -63,6 +66,15 @@ COL_SSD_VISIBLE = 13
 COL_SSD_SENSITIVE = 14
 COL_ENCRYPTED = 15
 
+# Threads probing the used space of the listed partitions
+USED_SPACE_WORKERS = 4
+
+# Shown in the used column until the probe is done
+USED_SPACE_PENDING = "…"
+
+# Group of the LVM volumes in the partition model (each disk has its own)
+LVM_GROUP = "lvm"
+
 class InstallationAdvanced(GtkBaseBox):
     """ Installation advanced class. Custom partitioning. """
 
@@ -90,7 +102,6 @@ class InstallationAdvanced(GtkBaseBox):
         self.first_time_in_fill_partition_list = True
 
         self.orig_label_dic = {}
-        self.orig_part_dic = {}
 
         # stage_opts holds info about newly created partitions (it's like a todo list)
         # format is tuple (is_new, label, mount_point, fs, format)
@@ -98,10 +109,18 @@ class InstallationAdvanced(GtkBaseBox):
         # uses partition uid as index
         self.stage_opts = {}
 
-        # What's this?
+        # Used space of each partition, by filesystem uuid (or path) and
+        # geometry (see used_space_key), kept across list rebuilds
         self.used_dic = {}
 
+        # Used space probes running, and the keys of the partition list
+        # rows waiting for them, by the same key
+        self.used_space_pool = concurrent.futures.ThreadPoolExecutor(max_workers=USED_SPACE_WORKERS)
+        self.used_space_futures = {}
+        self.used_space_rows = {}
+
         # Holds partitions that exist now but are going to be deleted
+        # (see get_changes)
         self.to_be_deleted = []
 
         # We will store our devices here
@@ -118,6 +137,7 @@ class InstallationAdvanced(GtkBaseBox):
 
         # Store here ALL partitions from ALL devices
         self.all_partitions = []
+        self.disk_partitions = {}
 
         # Init GUI elements
 
@@ -172,7 +192,10 @@ class InstallationAdvanced(GtkBaseBox):
 
         # Initialise our partition list tree view
         self.partition_list = self.ui.get_object('partition_list_treeview')
-        self.partition_list_store = None
+        self.partition_list_store = Gtk.TreeStore(
+            str, str, str, str, bool, bool, str, str, str, str, int, bool, bool, bool, bool, bool)
+        self.partition_model = partition_model.PartitionModel(self.partition_list_store)
+        self.partition_list.set_model(self.partition_list_store)
         self.prepare_partition_list()
 
         self.partition_list.set_hexpand(True)
@@ -420,26 +443,62 @@ class InstallationAdvanced(GtkBaseBox):
 
         return size_txt
 
-    def fill_partition_list(self):
-        """ Fill the partition list with all the data. """
-
-        # We will store our data model in 'partition_list_store'
-        if self.partition_list_store is not None:
-            self.partition_list_store.clear()
+    @staticmethod
+    def used_space_key(partition_path, partition, info):
+        """ Key of a partition in used_dic. A new filesystem gets a new uuid,
+            a moved or resized partition a new geometry """
+        return info.get('UUID') or partition_path, partition.geometry.start, partition.geometry.length
+
+    def get_used_space(self, key, partition_path, partition, fs_type, sector_size):
+        """ Used space of a partition, if we know it. If we don't, it's
+            probed in the background and USED_SPACE_PENDING is returned """
+        if key in self.used_dic:
+            return self.used_dic[key]
+        if key not in self.used_space_futures:
+            future = self.used_space_pool.submit(
+                self.probe_used_space, partition_path, fs_type, partition.geometry.length, sector_size)
+            future.add_done_callback(
+                lambda done: GLib.idle_add(self.on_used_space_probed, key, done))
+            self.used_space_futures[key] = future
+        return USED_SPACE_PENDING
+
+    def probe_used_space(self, partition_path, fs_type, length, sector_size):
+        """ Runs in the used space pool """
+        used = used_space.get_used_space(partition_path, fs_type) * length
+        return self.get_size(used, sector_size)
+
+    def on_used_space_probed(self, key, future):
+        """ Puts a probed used space in the rows waiting for it """
+        self.used_space_futures.pop(key, None)
+        try:
+            used = future.result()
+        except Exception as err:
+            logging.warning(_("Can't detect used space from {0}: {1}").format(key[0], err))
+            used = ""
+        self.used_dic[key] = used
+        for row_key in self.used_space_rows.pop(key, ()):
+            # The row may be gone by now
+            if row_key in self.partition_model and \
+                    self.partition_model.get_value(row_key, COL_USED) == USED_SPACE_PENDING:
+                self.partition_model.set_value(row_key, COL_USED, used)
+        return False
 
-        self.partition_list_store = Gtk.TreeStore(
-            str, str, str, str, bool, bool, str, str, str, str, int, bool, bool, bool, bool, bool)
+    def uses_luks(self, uid):
+        """ True if the partition uid will be encrypted """
+        return uid in self.luks_options and self.luks_options[uid][0]
 
-        # Be sure to call get_devices once
-        if self.disks is None:
-            self.disks = pm.get_devices()
+    def partition_group(self, disk_path):
+        """ Group of the partition model the rows of disk_path are in (the
+            LVM volumes are under their volume group, not a disk) """
+        if self.disks is not None and disk_path in self.disks:
+            return disk_path
+        return LVM_GROUP
 
-        self.diskdic = {}
-        self.all_partitions = []
+    def lvm_rows(self):
+        """ Rows of the volume groups and their logical volumes """
+        rows = []
         self.lv_partitions = []
-        self.diskdic['mounts'] = []
 
-        # Put all volumes (lvm) info in our model
         volume_groups = lvm.get_volume_groups()
         if volume_groups:
             for volume_group in volume_groups:
@@ -448,16 +507,17 @@ class InstallationAdvanced(GtkBaseBox):
                 if not logical_volumes:
                     continue
                 row = [volume_group, "", "", "", False, False, "", "", "", "", 0, False, is_ssd, False, False, False]
-                lvparent = self.partition_list_store.append(None, row)
+                vg_key = (LVM_GROUP, volume_group)
+                rows.append(partition_model.PartitionRow(vg_key, None, None, False, row))
                 for logical_volume in logical_volumes:
                     fmt_enable = True
                     fmt_active = False
+                    is_new = False
                     label = ""
                     mount_point = ""
                     formatable = True
 
                     partition_path = "/dev/mapper/{0}-{1}".format(volume_group, logical_volume)
-                    self.all_partitions.append(partition_path)
                     self.lv_partitions.append(partition_path)
 
                     uid = self.gen_partition_uid(path=partition_path)
@@ -473,174 +533,201 @@ class InstallationAdvanced(GtkBaseBox):
 
                     if uid in self.stage_opts:
                         (is_new, label, mount_point, fs_type, fmt_active) = self.stage_opts[uid]
-
-                    info = fs.get_info(partition_path)
-                    if 'LABEL' in info:
-                        label = info['LABEL']
-
-                    if mount_point:
-                        self.diskdic['mounts'].append(mount_point)
+                    else:
+                        info = fs.get_info(partition_path)
+                        if 'LABEL' in info:
+                            label = info['LABEL']
 
                     # Do not show swap version, only the 'swap' word
                     if 'swap' in fs_type:
                         fs_type = 'swap'
 
                     row = [partition_path, fs_type, mount_point, label, fmt_active, formatable, '', '',
-                           partition_path, "", 0, fmt_enable, is_ssd, False, False, False]
-
-                    self.partition_list_store.append(lvparent, row)
+                           partition_path, "", 0, fmt_enable, is_ssd, False, False, self.uses_luks(uid)]
+                    rows.append(partition_model.PartitionRow((uid, 'lvm', is_new), vg_key, uid, is_new, row))
 
                     if self.first_time_in_fill_partition_list:
-                        self.orig_part_dic[partition_path] = uid
                         self.orig_label_dic[partition_path] = label
+        return rows
 
-        # Fill our model with the rest of devices (non LVM)
-        for disk_path in sorted(self.disks):
-            if '/dev/mapper/arch_' in disk_path:
-                # Already added
-                continue
+    def disk_rows(self, disk_path):
+        """ Rows of a disk and its partitions """
+        if '/dev/mapper/arch_' in disk_path:
+            # Already added
+            return []
 
-            self.diskdic[disk_path] = {}
-            self.diskdic[disk_path]['has_logical'] = False
-            self.diskdic[disk_path]['has_extended'] = False
+        self.diskdic[disk_path] = {}
+        self.diskdic[disk_path]['has_logical'] = False
+        self.diskdic[disk_path]['has_extended'] = False
 
-            if disk_path not in self.ssd:
-                self.ssd[disk_path] = fs.is_ssd(disk_path)
+        if disk_path not in self.ssd:
+            self.ssd[disk_path] = fs.is_ssd(disk_path)
 
-            is_ssd = self.ssd[disk_path]
+        is_ssd = self.ssd[disk_path]
 
-            (disk, result) = self.disks[disk_path]
+        (disk, result) = self.disks[disk_path]
 
-            if disk is None:
-                # Disk without a partition table
-                row = [disk_path, "", "", "", False, False, "", "", "", "", 0, False, is_ssd, False, False, False]
-                self.partition_list_store.append(None, row)
-            elif '/dev/mapper/' in disk_path:
-                # Already added
+        if disk is None:
+            # Disk without a partition table
+            row = [disk_path, "", "", "", False, False, "", "", "", "", 0, False, is_ssd, False, False, False]
+            return [partition_model.PartitionRow(disk_path, None, None, False, row)]
+        elif '/dev/mapper/' in disk_path:
+            # Already added
+            return []
+
+        dev = disk.device
+
+        # Get device size
+        size_txt = self.get_size(dev.length, dev.sectorSize)
+
+        # Append the device info to our model
+        row = [dev.path, "", "", "", False, False, size_txt, "", "", "", 0, False, is_ssd, True, True, False]
+        rows = [partition_model.PartitionRow(disk_path, None, None, False, row)]
+
+        extended_key = None
+
+        # Create a list of partitions for this device (/dev/sda for example)
+        partitions = pm.get_partitions(disk)
+        self.disk_partitions[disk_path] = partitions
+        partition_list = pm.order_partitions(partitions)
+
+        # Append all partitions to our model
+        for partition_path in partition_list:
+            # Get partition size
+            partition = partitions[partition_path]
+            size_txt = self.get_size(partition.geometry.length, dev.sectorSize)
+            fmt_active = False
+            is_new = False
+            label = ""
+            mount_point = ""
+            used = ""
+            used_key = None
+            formatable = True
+
+            path = partition.path
+
+            # Skip lvm, LUKS, cdrom, ...
+            if '/dev/mapper' in path or 'sr0' in path:
                 continue
+
+            # Get filesystem
+            if partition.fileSystem and partition.fileSystem.type:
+                fs_type = partition.fileSystem.type
+            # Check if its free space before trying to get the filesystem with blkid.
+            elif 'free' in partition_path:
+                fs_type = _("none")
+            elif fs.get_type(path):
+                fs_type = fs.get_type(path)
             else:
-                dev = disk.device
+                # Unknown filesystem
+                fs_type = '?'
+
+            # Nothing should be mounted at this point
+
+            if partition.type == pm.PARTITION_EXTENDED:
+                formatable = False
+                self.diskdic[disk_path]['has_extended'] = True
+            elif partition.type == pm.PARTITION_LOGICAL:
+                formatable = True
+                self.diskdic[disk_path]['has_logical'] = True
+
+            uid = self.gen_partition_uid(partition=partition)
+
+            if partition.type in (pm.PARTITION_FREESPACE, pm.PARTITION_FREESPACE_EXTENDED):
+                # Show 'free space' instead of /dev/sda-1
+                path = _("free space")
+                formatable = False
+            # else:
+            #    # Get partition flags
+            #    flags = pm.get_flags(partition)
+
+            if uid in self.stage_opts:
+                (is_new, label, mount_point, fs_type, fmt_active) = self.stage_opts[uid]
+                fmt_enable = not is_new
+            else:
+                fmt_enable = True
+                if _("free space") not in path:
+                    # Answered from the block device inventory
+                    info = fs.get_info(partition_path)
+                    if 'LABEL' in info:
+                        label = info['LABEL']
+                    used_key = self.used_space_key(partition_path, partition, info)
+                    if mount_point:
+                        used = pm.get_used_space(partition)
+                    else:
+                        used = self.get_used_space(used_key, partition_path, partition,
+                                                   fs_type, dev.sectorSize)
 
-                # Get device size
-                size_txt = self.get_size(dev.length, dev.sectorSize)
+            if partition.type == pm.PARTITION_EXTENDED:
+                # Show 'extended' in file system type column
+                fs_type = 'extended'
 
-                # Append the device info to our model
-                row = [dev.path, "", "", "", False, False, size_txt, "", "", "", 0, False, is_ssd, True, True, False]
-                disk_parent = self.partition_list_store.append(None, row)
+            # Do not show swap version, only the 'swap' word
+            if 'swap' in fs_type:
+                fs_type = 'swap'
 
-                extended_parent = None
+            row = [path, fs_type, mount_point, label, fmt_active, formatable, size_txt, used,
+                   partition_path, "", partition.type, fmt_enable, False, False, False, self.uses_luks(uid)]
 
-                # Create a list of partitions for this device (/dev/sda for example)
-                partitions = pm.get_partitions(disk)
-                self.all_partitions.append(partitions)
-                partition_list = pm.order_partitions(partitions)
-
-                # Append all partitions to our model
-                for partition_path in partition_list:
-                    # Get partition size
-                    partition = partitions[partition_path]
-                    size_txt = self.get_size(partition.geometry.length, dev.sectorSize)
-                    fmt_active = False
-                    label = ""
-                    mount_point = ""
-                    used = ""
-                    formatable = True
+            if partition.type in (pm.PARTITION_LOGICAL, pm.PARTITION_FREESPACE_EXTENDED):
+                # Our parent (in the treeview) will be the extended partition we're in, not the disk
+                parent = extended_key
+            else:
+                # Our parent (in the treeview) will be the disk we're in
+                parent = disk_path
 
-                    path = partition.path
+            # A partition deleted and created again is another row
+            key = (uid, partition.type, is_new)
+            if _("free space") in path:
+                uid = None
+            rows.append(partition_model.PartitionRow(key, parent, uid, is_new, row))
 
-                    # Skip lvm, LUKS, cdrom, ...
-                    if '/dev/mapper' in path or 'sr0' in path:
-                        continue
+            if used == USED_SPACE_PENDING:
+                self.used_space_rows.setdefault(used_key, set()).add(key)
 
-                    # Get filesystem
-                    if partition.fileSystem and partition.fileSystem.type:
-                        fs_type = partition.fileSystem.type
-                    # Check if its free space before trying to get the filesystem with blkid.
-                    elif 'free' in partition_path:
-                        fs_type = _("none")
-                    elif fs.get_type(path):
-                        fs_type = fs.get_type(path)
-                    else:
-                        # Unknown filesystem
-                        fs_type = '?'
-
-                    # Nothing should be mounted at this point
-
-                    if partition.type == pm.PARTITION_EXTENDED:
-                        formatable = False
-                        self.diskdic[disk_path]['has_extended'] = True
-                    elif partition.type == pm.PARTITION_LOGICAL:
-                        formatable = True
-                        self.diskdic[disk_path]['has_logical'] = True
-
-                    if partition.type in (pm.PARTITION_FREESPACE, pm.PARTITION_FREESPACE_EXTENDED):
-                        # Show 'free space' instead of /dev/sda-1
-                        path = _("free space")
-                        formatable = False
-                    # else:
-                    #    # Get partition flags
-                    #    flags = pm.get_flags(partition)
-
-                    uid = self.gen_partition_uid(partition=partition)
-                    if uid in self.stage_opts:
-                        (is_new, label, mount_point, fs_type, fmt_active) = self.stage_opts[uid]
-                        fmt_enable = not is_new
-                    else:
-                        fmt_enable = True
-                        if _("free space") not in path:
-                            if self.first_time_in_fill_partition_list:
-                                if mount_point:
-                                    used = pm.get_used_space(partition)
-                                else:
-                                    used = used_space.get_used_space(partition_path,
-                                                                     fs_type) * partition.geometry.length
-                                    used = self.get_size(used, dev.sectorSize)
-                                self.used_dic[(disk_path, partition.geometry.start)] = used
-                            else:
-                                if (disk_path, partition.geometry.start) in self.used_dic:
-                                    used = self.used_dic[(disk_path, partition.geometry.start)]
-                                else:
-                                    used = '0b'
-                            info = fs.get_info(partition_path)
-                            if 'LABEL' in info:
-                                label = info['LABEL']
+            # If we're an extended partition, all the logical partitions
+            # that follow will be shown as children of this one
+            if partition.type == pm.PARTITION_EXTENDED:
+                extended_key = key
 
-                    if mount_point:
-                        self.diskdic['mounts'].append(mount_point)
+            if self.first_time_in_fill_partition_list:
+                self.orig_label_dic[partition.path] = label
 
-                    if partition.type == pm.PARTITION_EXTENDED:
-                        # Show 'extended' in file system type column
-                        fs_type = 'extended'
+        return rows
 
-                    # Do not show swap version, only the 'swap' word
-                    if 'swap' in fs_type:
-                        fs_type = 'swap'
+    def fill_partition_list(self, disk_paths=None):
+        """ Fill the partition list with all the data. If disk_paths is given,
+            only the rows of those disks (or LVM_GROUP) are built again """
 
-                    row = [path, fs_type, mount_point, label, fmt_active, formatable, size_txt, used,
-                           partition_path, "", partition.type, fmt_enable, False, False, False, False]
+        # Be sure to call get_devices once
+        if self.disks is None:
+            self.disks = pm.get_devices()
 
-                    if partition.type in (pm.PARTITION_LOGICAL, pm.PARTITION_FREESPACE_EXTENDED):
-                        # Our parent (in the treeview) will be the extended partition we're in, not the disk
-                        parent = extended_parent
-                    else:
-                        # Our parent (in the treeview) will be the disk we're in
-                        parent = disk_parent
+        if disk_paths is None:
+            disk_paths = [LVM_GROUP] + sorted(self.disks)
+            for group in list(self.partition_model.groups):
+                if group not in disk_paths:
+                    self.partition_model.remove_group(group)
+                    self.disk_partitions.pop(group, None)
 
-                    tree_iter = self.partition_list_store.append(parent, row)
+        for disk_path in disk_paths:
+            if disk_path == LVM_GROUP:
+                rows = self.lvm_rows()
+            else:
+                rows = self.disk_rows(disk_path)
+            self.partition_model.update(disk_path, rows)
 
-                    # If we're an extended partition, all the logical partitions
-                    # that follow will be shown as children of this one
-                    if partition.type == pm.PARTITION_EXTENDED:
-                        extended_parent = tree_iter
+        self.all_partitions = list(self.lv_partitions)
+        for disk_path in sorted(self.disk_partitions):
+            self.all_partitions.append(self.disk_partitions[disk_path])
 
-                    if self.first_time_in_fill_partition_list:
-                        self.orig_part_dic[partition.path] = self.gen_partition_uid(partition=partition)
-                        self.orig_label_dic[partition.path] = label
+        self.diskdic['mounts'] = []
+        for row in self.partition_model.all_rows():
+            if row.values[COL_MOUNT_POINT]:
+                self.diskdic['mounts'].append(row.values[COL_MOUNT_POINT])
 
         self.first_time_in_fill_partition_list = False
 
-        # Assign our new model to our treeview
-        self.partition_list.set_model(self.partition_list_store)
         self.partition_list.expand_all()
 
         # Check if correct mount points are already defined, so we can proceed with installation
@@ -780,11 +867,12 @@ class InstallationAdvanced(GtkBaseBox):
         self.edit_partition_dialog.hide()
 
         # Update the partition list treeview
-        self.update_view()
+        self.update_view([self.partition_group(disk_path)])
 
-    def update_view(self):
-        """ Reloads widgets contents """
-        self.fill_partition_list()
+    def update_view(self, disk_paths=None):
+        """ Reloads widgets contents (the partition list rows of disk_paths
+            only, if given) """
+        self.fill_partition_list(disk_paths)
         self.fill_bootloader_device_entry()
         self.fill_bootloader_entry()
 
@@ -821,8 +909,6 @@ class InstallationAdvanced(GtkBaseBox):
         if tree_iter is None:
             return
 
-        am_new = False
-
         # Get row data
         row = model[tree_iter]
 
@@ -836,17 +922,11 @@ class InstallationAdvanced(GtkBaseBox):
         uid = self.gen_partition_uid(path=partition_path)
 
         if uid in self.stage_opts:
-            am_new = self.stage_opts[uid][0]
             del self.stage_opts[uid]
 
         if uid in self.luks_options:
             del self.luks_options[uid]
 
-        if not am_new:
-            for orig_part in self.orig_part_dic:
-                if uid == self.orig_part_dic[orig_part]:
-                    self.to_be_deleted.append(orig_part)
-
         disk_path = self.get_disk_path_from_selection(model, tree_iter)
         self.disks_changed.append(disk_path)
 
@@ -860,10 +940,8 @@ class InstallationAdvanced(GtkBaseBox):
 
         partitions = pm.get_partitions(disk)
 
-        # used_dic ?
         part = partitions[partition_path]
-        if (disk.device.path, part.geometry.start) in self.used_dic:
-            del self.used_dic[(disk.device.path, part.geometry.start)]
+        self.used_dic.pop(self.used_space_key(part.path, part, fs.get_info(part.path)), None)
 
         # Before delete the partition, check if it's already mounted
         if pm.check_mounted(part):
@@ -879,7 +957,7 @@ class InstallationAdvanced(GtkBaseBox):
         pm.delete_partition(disk, part)
 
         # Update the partition list treeview
-        self.update_view()
+        self.update_view([disk_path])
 
     @staticmethod
     def get_mount_point(partition_path):
@@ -1115,7 +1193,7 @@ class InstallationAdvanced(GtkBaseBox):
                             self.settings.set('luks_root_volume', self.tmp_luks_options[1])
 
                 # Update partition list treeview
-                self.update_view()
+                self.update_view([disk_path])
 
         self.create_partition_dialog.hide()
 
@@ -1237,9 +1315,6 @@ class InstallationAdvanced(GtkBaseBox):
         self.stage_opts = {}
         self.luks_options = {}
 
-        # Empty to be deleted partitions list
-        self.to_be_deleted = []
-
         # Refresh our partition treeview
         self.update_view()
 
@@ -1524,7 +1599,7 @@ class InstallationAdvanced(GtkBaseBox):
                 new_disk = pm.make_new_disk(disk_path, ptype)
                 self.disks[disk_path] = (new_disk, pm.OK)
 
-                self.update_view()
+                self.update_view([disk_path])
 
                 if ptype == 'gpt' and not os.path.exists('/sys/firmware/efi'):
                     # Show warning (see https://github.com/Antergos/Cnchi/issues/63)
@@ -1604,7 +1679,7 @@ class InstallationAdvanced(GtkBaseBox):
                 self.stage_opts[uid] = (True, mylabel, mymount, myfmt, formatme)
 
         # Update partition list treeview
-        self.update_view()
+        self.update_view([disk_path])
 
     def on_partition_list_lvm_activate(self, button):
         pass
@@ -1719,165 +1794,131 @@ class InstallationAdvanced(GtkBaseBox):
             txt = _("Install now!")
             self.forward_button.set_label(txt)
 
+    def unmount_partition(self, partition_path, partition):
+        """ Unmounts a partition we are going to change, asking first unless
+            it's left from a previous install. Returns False if the user
+            doesn't want it unmounted """
+        if not pm.check_mounted(partition):
+            return True
+
+        mounted = False
+        mount_point, fs_type, writable = self.get_mount_point(partition_path)
+        # if "swap" in fs_type:
+        swap_partition = self.get_swap_partition(partition_path)
+        msg = ""
+        if swap_partition == partition_path:
+            msg = _("{0} is mounted as swap.\nTo continue it has to be unmounted.\n"
+                    "Click Yes to unmount, or No to return\n").format(partition_path)
+            mounted = True
+        elif len(mount_point) > 0:
+            msg = _("{0} is mounted in '{1}'.\nTo continue it has to be unmounted.\n"
+                    "Click Yes to unmount, or No to return\n").format(partition_path, mount_point)
+            mounted = True
+
+        if "install" in mount_point:
+            # If we're recovering from a failed/stopped install, there'll be
+            # some mounted directories. Unmount them without asking.
+            try:
+                cmd = ['umount', '-l', partition_path]
+                subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                logging.debug(_("{0} unmounted".format(mount_point)))
+            except subprocess.CalledProcessError as process_error:
+                logging.error(process_error)
+        elif mounted:
+            response = show.question(self.get_toplevel(), msg)
+            if response != Gtk.ResponseType.YES:
+                # User doesn't want to unmount, we can't go on.
+                return False
+            else:
+                # unmount it!
+                if swap_partition == partition_path:
+                    try:
+                        cmd = ['sh', '-c', 'swapoff {0}'.format(partition_path)]
+                        subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                        logging.debug(_("Swap partition {0} unmounted".format(partition_path)))
+                    except subprocess.CalledProcessError as process_error:
+                        logging.error(process_error)
+                else:
+                    try:
+                        cmd = ['umount', partition_path]
+                        subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                        logging.debug(_("{0} unmounted".format(mount_point)))
+                    except subprocess.CalledProcessError as process_error:
+                        logging.error(process_error)
+        else:
+            msg = _("{0} shows as mounted (busy) but it has no mount point")
+            msg = msg.format(partition_path)
+            logging.warning(msg)
+        return True
+
     def get_changes(self):
-        """ Grab all changes for confirmation """
+        """ Grab all changes for confirmation. They are the differences
+            between the partition list rows we started with and the current
+            ones (see partition_model.py) """
+        # The format toggles change stage_opts, not the rows
+        self.fill_partition_list()
+        old_rows, new_rows, changes = self.partition_model.changes()
+
+        # Partitions that were there and are gone (or have been created again)
+        self.to_be_deleted = [old_rows[key].values[COL_PARTITION_PATH] for key in changes.removed
+                              if old_rows[key].uid is not None]
+
+        changed = set(changes.added) | set(changes.changed)
         changelist = []
         # Store values as (path, create?, label?, format?, mount_point, encrypt?)
-        if self.lv_partitions:
-            for e in self.lv_partitions:
+        for disk_path, keys in self.partition_model.groups.items():
+            for key in keys:
+                row = new_rows[key]
+                if key not in changed or row.uid is None:
+                    continue
+
+                partition_path = row.values[COL_PARTITION_PATH]
+                lbl = row.values[COL_LABEL]
+                mnt = row.values[COL_MOUNT_POINT]
+                fsystem = row.values[COL_FS]
+                fmt = row.values[COL_FORMAT_ACTIVE]
+
+                if disk_path != LVM_GROUP and row.uid in self.stage_opts:
+                    (disk, result) = self.disks[disk_path]
+                    if disk.device.busy:
+                        # Check if there's some mounted partition
+                        partition = self.disk_partitions[disk_path][partition_path]
+                        if not self.unmount_partition(partition_path, partition):
+                            return []
+
+                    if mnt == "/" and not fmt:
+                        msg = _('The root partition is not marked to be formatted.\n'
+                                'This might create problems. Should it be marked to be formatted now?')
+                        response = show.question(self.get_toplevel(), msg)
+                        if response == Gtk.ResponseType.YES:
+                            # Mark root partition to be formatted and check it in list.
+                            fmt = True
+                            self.stage_opts[row.uid] = self.stage_opts[row.uid][:4] + (fmt,)
+                            self.fill_partition_list([disk_path])
+
                 relabel = 'No'
-                encrypt = 'No'
-                uid = self.gen_partition_uid(path=e)
-                if uid in self.stage_opts:
-                    is_new, lbl, mnt, fsystem, fmt = self.stage_opts[uid]
-                    if fmt:
+                createme = 'No'
+                fmt = 'Yes' if fmt else 'No'
+                encrypt = 'Yes' if row.values[COL_ENCRYPTED] else 'No'
+
+                if row.is_new:
+                    if lbl != "":
+                        relabel = 'Yes'
+                    # Avoid extended and bios-gpt-boot partitions getting fmt flag true on new creation
+                    if fsystem != "extended" and fsystem != "bios-gpt-boot":
                         fmt = 'Yes'
-                    else:
-                        fmt = 'No'
-                    if is_new:
-                        if lbl != "":
-                            relabel = 'Yes'
-                        # Avoid extended and bios-gpt-boot partitions getting fmt flag true on new creation
-                        if fsystem != "extended" and fsystem != "bios-gpt-boot":
-                            fmt = 'Yes'
-                        createme = 'Yes'
-                    else:
-                        if e in self.orig_label_dic:
-                            if self.orig_label_dic[e] == lbl:
-                                relabel = 'No'
-                            else:
-                                relabel = 'Yes'
-                        createme = 'No'
-
-                    if uid in self.luks_options:
-                        (use_luks, vol_name, password) = self.luks_options[uid]
-                        if use_luks:
-                            encrypt = 'Yes'
-                else:
-                    relabel = 'No'
-                    fmt = 'No'
-                    createme = 'No'
-                    mnt = ''
-                    encrypt = 'No'
+                    createme = 'Yes'
+                elif partition_path in self.orig_label_dic:
+                    if self.orig_label_dic[partition_path] != lbl:
+                        relabel = 'Yes'
 
                 if createme == 'Yes' or relabel == 'Yes' or fmt == 'Yes' or mnt or encrypt == 'Yes':
-                    changelist.append((e, createme, relabel, fmt, mnt, encrypt))
-
-        if self.disks:
-            for disk_path in self.disks:
-                (disk, result) = self.disks[disk_path]
-                partitions = pm.get_partitions(disk)
-                for partition_path in partitions:
-                    # Init vars
-                    relabel = 'No'
-                    encrypt = 'No'
-                    uid = self.gen_partition_uid(path=partition_path)
-                    if uid in self.stage_opts:
-                        if disk.device.busy:
-                            # Check if there's some mounted partition
-                            mounted = False
-                            if pm.check_mounted(partitions[partition_path]):
-                                mount_point, fs_type, writable = self.get_mount_point(partition_path)
-                                # if "swap" in fs_type:
-                                swap_partition = self.get_swap_partition(partition_path)
-                                msg = ""
-                                if swap_partition == partition_path:
-                                    msg = _("{0} is mounted as swap.\nTo continue it has to be unmounted.\n"
-                                            "Click Yes to unmount, or No to return\n").format(partition_path)
-                                    mounted = True
-                                elif len(mount_point) > 0:
-                                    msg = _("{0} is mounted in '{1}'.\nTo continue it has to be unmounted.\n"
-                                            "Click Yes to unmount, or No to return\n").format(partition_path,
-                                                                                              mount_point)
-                                    mounted = True
-
-                                if "install" in mount_point:
-                                    # If we're recovering from a failed/stopped install, there'll be
-                                    # some mounted directories. Unmount them without asking.
-                                    try:
-                                        cmd = ['umount', '-l', partition_path]
-                                        subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                                        logging.debug(_("{0} unmounted".format(mount_point)))
-                                    except subprocess.CalledProcessError as process_error:
-                                        logging.error(process_error)
-                                elif mounted:
-                                    response = show.question(self.get_toplevel(), msg)
-                                    if response != Gtk.ResponseType.YES:
-                                        # User doesn't want to unmount, we can't go on.
-                                        return []
-                                    else:
-                                        # unmount it!
-                                        if swap_partition == partition_path:
-                                            try:
-                                                cmd = ['sh', '-c', 'swapoff {0}'.format(partition_path)]
-                                                subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                                                logging.debug(_("Swap partition {0} unmounted".format(partition_path)))
-                                            except subprocess.CalledProcessError as process_error:
-                                                logging.error(process_error)
-                                        else:
-                                            try:
-                                                cmd = ['umount', partition_path]
-                                                subprocess.Popen(cmd, stdout=subprocess.PIPE)
-                                                logging.debug(_("{0} unmounted".format(mount_point)))
-                                            except subprocess.CalledProcessError as process_error:
-                                                logging.error(process_error)
-                                else:
-                                    msg = _("{0} shows as mounted (busy) but it has no mount point")
-                                    msg = msg.format(partition_path)
-                                    logging.warning(msg)
-
-                        (is_new, lbl, mnt, fsystem, fmt) = self.stage_opts[uid]
-
-                        if mnt == "/" and not fmt:
-                             msg = _('The root partition is not marked to be formatted.\n'
-                                     'This might create problems. Should it be marked to be formatted now?')
-                             response = show.question(self.get_toplevel(), msg)
-                             if response != Gtk.ResponseType.YES:
-                                 # User doesn't want to format root partition.
-                                 fmt = False
-                             else:
-                                 # Mark root partition to be formatted and check it in list.
-                                 fmt = True
-                                 self.stage_opts[uid] = (is_new, lbl, mnt, fsystem, fmt)
-                                 self.fill_partition_list()
-
-                        if fmt:
-                            fmt = 'Yes'
-                        else:
-                            fmt = 'No'
-
-                        if is_new:
-                            if lbl != "":
-                                relabel = 'Yes'
-                            # Avoid extended and bios-gpt-boot partitions getting fmt flag true on new creation
-                            if fsystem != "extended" and fsystem != "bios-gpt-boot":
-                                fmt = 'Yes'
-                            createme = 'Yes'
-                        else:
-                            if partition_path in self.orig_label_dic:
-                                if self.orig_label_dic[partition_path] == lbl:
-                                    relabel = 'No'
-                                else:
-                                    relabel = 'Yes'
-                            createme = 'No'
-
-                        if uid in self.luks_options:
-                            (use_luks, vol_name, password) = self.luks_options[uid]
-                            if use_luks:
-                                encrypt = 'Yes'
-                    else:
-                        relabel = 'No'
-                        fmt = 'No'
-                        createme = 'No'
-                        mnt = ''
-
-                    if createme == 'Yes' or relabel == 'Yes' or fmt == 'Yes' or mnt or encrypt == 'Yes':
-                        changelist.append((partition_path, createme, relabel, fmt, mnt, encrypt))
-                        msg = _("Added {0} to changelist: createme[{1}] relabel[{2}] fmt[{3}] mnt[{4}] encrypt[{5}]")
-                        msg = msg.format(partition_path, createme, relabel, fmt, mnt, encrypt)
-                        logging.debug(msg)
+                    changelist.append((partition_path, createme, relabel, fmt, mnt, encrypt))
+                    msg = _("Added {0} to changelist: createme[{1}] relabel[{2}] fmt[{3}] mnt[{4}] encrypt[{5}]")
+                    msg = msg.format(partition_path, createme, relabel, fmt, mnt, encrypt)
+                    logging.debug(msg)
 
-            return changelist
+        return changelist
 
     def show_changes(self, changelist):
         """ Show all changes to the user before doing anything, just in case. """
@@ -2017,8 +2058,12 @@ class InstallationAdvanced(GtkBaseBox):
                 (disk, result) = self.disks[disk_path]
                 # Only commit changes to disks we've changed!
                 if disk_path in self.disks_changed:
+                    udev_mark = udev_monitor.mark()
                     pm.finalize_changes(disk)
                     logging.info(_("Finished saving changes in {0}".format(disk_path)))
+                    # Don't format new partitions before udev has set them up
+                    # (the nodes of the old ones may still be there)
+                    udev_monitor.wait_for_devices(sorted(pm.get_partitions(disk)), since=udev_mark)
                 # Now that partitions are created, set fs and label
                 partitions.update(pm.get_partitions(disk))
 
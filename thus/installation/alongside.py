@@ -44,7 +44,7 @@ except NameError as err:
 import misc.misc as misc
 import misc.gtkwidgets as gtkwidgets
 import show_message as show
-import bootinfo
+import os_probe
 
 from gtkbasebox import GtkBaseBox
 
@@ -107,7 +107,7 @@ class InstallationAlongside(GtkBaseBox):
         self.choose_partition_label = self.ui.get_object('choose_partition_label')
         self.choose_partition_combo = self.ui.get_object('choose_partition_combo')
 
-        self.oses = bootinfo.get_os_dict()
+        self.oses = os_probe.get_os_dict()
         # print(self.oses)
         self.resize_widget = None
 
@@ -43,11 +43,12 @@ if __name__ == '__main__':
     PARENT_DIR = os.path.join(BASE_DIR, '..')
     sys.path.insert(0, PARENT_DIR)
 
-import bootinfo
+import os_probe
 import logging
 
 from gtkbasebox import GtkBaseBox
 import misc.misc as misc
+from installation import image_install
 
 
 def check_alongside_disk_layout():
@@ -129,7 +130,7 @@ class InstallationAsk(GtkBaseBox):
             logging.debug(msg)
             enable_alongside = False
         else:
-            oses = bootinfo.get_os_dict()
+            oses = os_probe.get_os_dict()
             self.other_oses = []
             for key in oses:
                 # We only check the first hard disk
@@ -352,7 +353,13 @@ class InstallationAsk(GtkBaseBox):
         elif self.next_page == "installation_advanced":
             self.settings.set('partition_mode', 'advanced')
         elif self.next_page == "installation_automatic":
-            self.settings.set('partition_mode', 'automatic')
+            if image_install.image_available() and not use_luks and not use_lvm:
+                # Same layout, but the system is written as a prebuilt image
+                logging.info(_("Manjaro will be installed from the system image {0}").format(
+                    image_install.image_path()))
+                self.settings.set('partition_mode', 'image')
+            else:
+                self.settings.set('partition_mode', 'automatic')
 
         return True
 
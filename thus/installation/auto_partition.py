@@ -33,6 +33,8 @@ import parted3.partition_module as pm
 import parted3.fs_module as fs
 import parted3.lvm as lvm
 import parted3.used_space as used_space
+import misc.block_devices as block_devices
+import misc.udev_monitor as udev_monitor
 
 from misc.misc import InstallError
 
@@ -55,18 +57,8 @@ MIN_ROOT_SIZE = 6500
 
 
 def get_info(part):
-    """ Get partition info using blkid """
-    cmd = ['blkid', part]
-    ret = subprocess.check_output(cmd).decode().strip()
-
-    partdic = {}
-
-    for info in ret.split():
-        if '=' in info:
-            info = info.split('=')
-            partdic[info[0]] = info[1].strip('"')
-
-    return partdic
+    """ Get partition info (as blkid names it) from the device inventory """
+    return block_devices.get_info(part)
 
 
 def check_output(command):
@@ -437,8 +429,11 @@ class AutoPartition(object):
                 mode = 0o750
             os.chmod(path, mode)
 
-        fs_uuid = get_info(device)['UUID']
-        fs_label = get_info(device)['LABEL']
+        # The filesystem is new, the inventory has to read it again
+        block_devices.invalidate(device)
+        info = get_info(device)
+        fs_uuid = info['UUID']
+        fs_label = info['LABEL']
         logging.debug(_("Device details: {0} UUID={1} LABEL={2}".format(device, fs_uuid, fs_label)))
 
     @property
@@ -633,16 +628,11 @@ class AutoPartition(object):
 
         # Get just the disk size in MiB
         device = self.auto_device
-        device_name = check_output("basename {0}".format(device))
-        base_path = os.path.join("/sys/block", device_name)
-        size_path = os.path.join(base_path, "size")
-        if os.path.exists(size_path):
-            logical_path = os.path.join(base_path, "queue/logical_block_size")
-            with open(logical_path, 'r') as f:
-                logical_block_size = int(f.read())
-            with open(size_path, 'r') as f:
-                size = int(f.read())
-            disk_size = ((logical_block_size * (size - 68)) / 1024) / 1024
+        disk = block_devices.get(device)
+        if disk is not None:
+            # sysfs counts 512 byte sectors
+            size = disk['size'] // 512
+            disk_size = ((disk['logical_block_size'] * (size - 68)) / 1024) / 1024
         else:
             txt = _("Setup cannot detect size of your device, please use advanced "
                     "installation routine for partitioning and mounting devices.")
@@ -679,6 +669,9 @@ class AutoPartition(object):
             # Create fresh GPT
             sgdisk("clear", device)
 
+            # Partition nodes set up by udev from now on belong to our new table
+            udev_mark = udev_monitor.mark()
+
             # Inform the kernel of the partition change. Needed if the hard disk had a MBR partition table.
             try:
                 subprocess.check_call(["partprobe", device])
@@ -736,6 +729,9 @@ class AutoPartition(object):
             # Create DOS MBR
             parted_mktable(device, "msdos")
 
+            # Partition nodes set up by udev from now on belong to our new table
+            udev_mark = udev_monitor.mark()
+
             # Create boot partition (all sizes are in MiB)
             # if start is -1 parted_mkpart assumes that our partition starts at 1 (first partition in disk)
             start = -1
@@ -774,10 +770,12 @@ class AutoPartition(object):
 
         printk(True)
 
-        # Wait until /dev initialized correct devices
-        subprocess.check_call(["udevadm", "settle"])
-
+        # Wait until udev has set up the partitions we have created (settle
+        # the whole udev queue only if one of them doesn't show up)
+        block_devices.invalidate(device)
         devices = self.get_devices
+        partitions = sorted(set(path for path in devices.values() if path.startswith(device)))
+        udev_monitor.wait_for_devices(partitions, since=udev_mark)
 
         if self.GPT and self.bootloader == "grub2":
             logging.debug("EFI: {0}".format(devices['efi']))
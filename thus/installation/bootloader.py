@@ -35,6 +35,7 @@ import subprocess
 import re
 
 import parted3.fs_module as fs
+import os_probe
 
 from installation import chroot
 
@@ -279,6 +280,7 @@ class Bootloader(object):
 
         # Add -l option to os-prober's umount call so that it does not hang
         self.apply_osprober_patch()
+        os_prober_script = self.pregenerate_os_entries(efi=False)
 
         # Run grub-mkconfig last
         locale = self.settings.get("locale")
@@ -294,6 +296,8 @@ class Bootloader(object):
                             " and os-prober so we can continue."))
             subprocess.check_call(['killall', 'grub-mount'])
             subprocess.check_call(['killall', 'os-prober'])
+        finally:
+            self.restore_os_prober(os_prober_script)
 
         cfg = os.path.join(self.dest_dir, "boot/grub/grub.cfg")
         with open(cfg) as grub_cfg:
@@ -389,6 +393,7 @@ class Bootloader(object):
 
         # Add -l option to os-prober's umount call so that it does not hang
         self.apply_osprober_patch()
+        os_prober_script = self.pregenerate_os_entries(efi=True)
 
         locale = self.settings.get("locale")
         try:
@@ -404,6 +409,8 @@ class Bootloader(object):
             logging.error(txt)
             subprocess.check_call(['killall', 'grub-mount'])
             subprocess.check_call(['killall', 'os-prober'])
+        finally:
+            self.restore_os_prober(os_prober_script)
 
         paths = [os.path.join(self.dest_dir, "boot/grub/x86_64-efi/core.efi"),
                  os.path.join(self.dest_dir,
@@ -442,6 +449,40 @@ class Bootloader(object):
             logging.warning(_("Failed to patch 50mounted-tests, "
                               "file not found."))
 
+    def pregenerate_os_entries(self, efi):
+        """
+        Writes the menu entries of the other installed OSes (see os_probe.py)
+        as a grub.d script, and disables 30_os-prober so grub-mkconfig does
+        not mount every partition again. Returns the disabled script (to be
+        restored by restore_os_prober), or None if os-prober has to run
+        """
+        os_prober_script = os.path.join(self.dest_dir, "etc/grub.d/30_os-prober")
+        if not os.access(os_prober_script, os.X_OK):
+            return None
+        try:
+            # As os-prober, leave out the partition we are installing to (but
+            # not the EFI partition, which may hold Windows' boot manager)
+            os_probe.write_grub_script(self.dest_dir, efi, [self.root_device])
+        except Exception as general_error:
+            logging.warning(_("Can't write the grub entries of other OSes, "
+                              "os-prober will look for them: {0}").format(general_error))
+            return None
+        # grub-mkconfig skips the scripts that aren't executable
+        os.chmod(os_prober_script, 0o644)
+        return os_prober_script
+
+    def restore_os_prober(self, os_prober_script):
+        """ Enables 30_os-prober again and removes the pregenerated entries
+            (they are already in grub.cfg), so later grub-mkconfig runs in the
+            installed system find other OSes by themselves """
+        if os_prober_script is None:
+            return
+        os.chmod(os_prober_script, 0o755)
+        try:
+            os.remove(os.path.join(self.dest_dir, "etc/grub.d", os_probe.GRUB_SCRIPT))
+        except OSError:
+            pass
+
     def copy_grub2_theme_files(self):
         """ Copy grub2 theme files to /boot """
         logging.info(_("Copying GRUB(2) Theme Files"))
@@ -24,11 +24,22 @@
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #  MA 02110-1301, USA.
 
-""" Chroot related functions. Used in the installation process """
+""" Chroot related functions. Used in the installation process
 
+    Run as a script, this module is the chroot helper: it enters the root
+    given as its argument and runs the requests it reads from stdin """
+
+import errno
+import grp
+import json
 import logging
 import os
+import pwd
+import queue
 import subprocess
+import sys
+import threading
+import time
 
 # When testing, no _() is available
 try:
@@ -39,6 +50,12 @@ except NameError as err:
 
 _special_dirs_mounted = False
 
+# Running chroot helpers, by root directory
+_executors = {}
+
+# Slowest commands listed when a helper is stopped
+SLOWEST_SHOWN = 5
+
 
 def get_special_dirs():
     """ Get special dirs to be mounted or unmounted """
@@ -113,8 +130,75 @@ def umount_special_dirs(dest_dir):
     _special_dirs_mounted = False
 
 
+def start_executor(dest_dir):
+    """ Starts a chroot helper for dest_dir. From now on, commands run in
+        dest_dir go through it. Special dirs must be mounted already """
+    if dest_dir in _executors:
+        return
+    try:
+        _executors[dest_dir] = ChrootExecutor(dest_dir)
+        logging.debug(_("Chroot helper started in {0}").format(dest_dir))
+    except OSError as error:
+        logging.warning(_("Can't start the chroot helper: {0}").format(error))
+
+
+def stop_executor(dest_dir):
+    """ Stops the chroot helper of dest_dir (if any) """
+    executor = _executors.pop(dest_dir, None)
+    if executor is not None:
+        executor.stop()
+
+
+def _executor_for(dest_dir):
+    executor = _executors.get(dest_dir)
+    if executor is not None and executor.alive():
+        return executor
+    return None
+
+
+def symlink(target, link_name, dest_dir):
+    """ Creates (or replaces) the symlink link_name inside the chroot """
+    try:
+        executor = _executor_for(dest_dir)
+        if executor is not None:
+            executor.call('symlink', target, link_name)
+            return
+        path = os.path.join(dest_dir, link_name.lstrip('/'))
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(target, path)
+    except OSError as error:
+        logging.error(_("Can't create the link {0}: {1}").format(link_name, error))
+        logging.error(_("Thus will try to continue anyways"))
+
+
+def chown(path, user, group, dest_dir, recursive=False):
+    """ Changes the owner of path inside the chroot (names are looked up in
+        the chroot's own passwd and group files) """
+    executor = _executor_for(dest_dir)
+    if executor is not None:
+        try:
+            executor.call('chown', path, user, group, recursive)
+        except OSError as error:
+            logging.error(_("Can't change the owner of {0}: {1}").format(path, error))
+            logging.error(_("Thus will try to continue anyways"))
+        return
+    cmd = ['chown']
+    if recursive:
+        cmd.append('-R')
+    run(cmd + ['{0}:{1}'.format(user, group), path], dest_dir)
+
+
 def run(cmd, dest_dir, timeout=None, stdin=None):
-    """ Runs command inside the chroot """
+    """ Runs command inside the chroot. Returns its exit code (None if it
+        couldn't be run) """
+    executor = _executor_for(dest_dir)
+    if executor is not None and stdin is None:
+        try:
+            return executor.run(cmd, timeout)
+        except OSError as error:
+            logging.warning(_("Chroot helper failed ({0}), forking chroot instead").format(error))
+
     full_cmd = ['chroot', dest_dir]
 
     for element in cmd:
@@ -130,6 +214,7 @@ def run(cmd, dest_dir, timeout=None, stdin=None):
         txt = outs.decode().strip()
         if len(txt) > 0:
             logging.debug(txt)
+        return proc.returncode
     except subprocess.TimeoutExpired as error:
         if proc:
             proc.kill()
@@ -139,3 +224,225 @@ def run(cmd, dest_dir, timeout=None, stdin=None):
     except OSError as error:
         logging.error(_("Error running command: {0}".format(error.strerror)))
         logging.error(_("Thus will try to continue anyways"))
+
+
+class ChrootExecutor(object):
+    """ Long-lived helper process that has entered dest_dir once and runs
+        commands (and a few file operations natively) for us, so each step
+        doesn't pay for a chroot fork. Requests and replies are JSON lines
+        over a pipe; requests may be sent from several threads at once.
+        Command output is logged line by line as it comes and the time
+        every request took is kept in timings """
+
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        self.timings = []
+        self._next_id = 0
+        self._replies = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), dest_dir],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def alive(self):
+        return not self._closed and self._proc.poll() is None
+
+    def _read(self):
+        for line in self._proc.stdout:
+            try:
+                reply = json.loads(line.decode())
+            except ValueError:
+                continue
+            with self._lock:
+                replies = self._replies.get(reply['id'])
+            if replies is not None:
+                replies.put(reply)
+        # The helper is gone, wake up whoever is still waiting
+        with self._lock:
+            self._closed = True
+            for replies in self._replies.values():
+                replies.put(None)
+
+    def _request(self, op, **fields):
+        """ Sends a request and waits for its final reply """
+        replies = queue.Queue()
+        with self._lock:
+            if self._closed:
+                raise OSError(errno.EPIPE, _("The chroot helper has exited"))
+            request_id = self._next_id
+            self._next_id += 1
+            self._replies[request_id] = replies
+            fields.update(id=request_id, op=op)
+            try:
+                self._proc.stdin.write((json.dumps(fields) + '\n').encode())
+                self._proc.stdin.flush()
+            except OSError:
+                del self._replies[request_id]
+                raise
+        try:
+            while True:
+                reply = replies.get()
+                if reply is None:
+                    raise OSError(errno.EPIPE, _("The chroot helper has exited"))
+                if 'line' in reply:
+                    if reply['line']:
+                        logging.debug(reply['line'])
+                    continue
+                return reply
+        finally:
+            with self._lock:
+                del self._replies[request_id]
+
+    def run(self, cmd, timeout=None):
+        """ Runs cmd in the chroot. Returns its exit code (None if it
+            couldn't be run) """
+        reply = self._request('run', cmd=cmd, timeout=timeout)
+        name = ' '.join(cmd)
+        self.timings.append((name, reply['elapsed']))
+        logging.debug(_("'{0}' took {1:.2f} seconds").format(name, reply['elapsed']))
+        if reply.get('timeout'):
+            logging.error(_("Timeout running the command {0}".format(cmd)))
+            logging.error(_("Thus will try to continue anyways"))
+        elif 'error' in reply:
+            logging.error(_("Error running command: {0}".format(reply['error'])))
+            logging.error(_("Thus will try to continue anyways"))
+        return reply.get('returncode')
+
+    def call(self, op, *args):
+        """ Runs one of the helper's native file operations """
+        reply = self._request(op, args=args)
+        self.timings.append(("{0} {1}".format(op, args[0]), reply['elapsed']))
+        if 'error' in reply:
+            raise OSError(reply['error'])
+
+    def stop(self):
+        """ Lets the helper finish what it's doing and exit """
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._reader.join()
+
+        total = sum(elapsed for name, elapsed in self.timings)
+        logging.debug(_("Chroot helper ran {0} requests in {1:.2f} seconds").format(
+            len(self.timings), total))
+        for name, elapsed in sorted(self.timings, key=lambda timing: -timing[1])[:SLOWEST_SHOWN]:
+            logging.debug("    {0:8.2f}s {1}".format(elapsed, name))
+
+
+# Chroot helper side (runs inside the chroot)
+
+def _helper_symlink(target, link_name):
+    if os.path.lexists(link_name):
+        os.remove(link_name)
+    os.symlink(target, link_name)
+
+
+def _helper_chown(path, user, group, recursive):
+    uid = pwd.getpwnam(user).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    os.lchown(path, uid, gid)
+    if recursive:
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                os.lchown(os.path.join(root, name), uid, gid)
+
+
+def _helper_write_file(path, text, mode):
+    with open(path, 'w') as target_file:
+        target_file.write(text)
+    os.chmod(path, mode)
+
+
+def _helper_chmod(path, mode):
+    os.chmod(path, mode)
+
+
+def _helper_makedirs(path, mode):
+    os.makedirs(path, mode, exist_ok=True)
+
+
+_HELPER_OPS = {
+    'symlink': _helper_symlink,
+    'chown': _helper_chown,
+    'write_file': _helper_write_file,
+    'chmod': _helper_chmod,
+    'makedirs': _helper_makedirs}
+
+
+def _helper_run(request, send):
+    """ Runs a command, streaming its output. Returns (exit code, timed out) """
+    proc = subprocess.Popen(request['cmd'],
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    timed_out = []
+    timer = None
+    if request.get('timeout'):
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(proc.pid, 9)
+            except OSError:
+                pass
+        timer = threading.Timer(request['timeout'], kill)
+        timer.start()
+    for line in proc.stdout:
+        send({'id': request['id'], 'line': line.decode('utf-8', 'replace').rstrip()})
+    returncode = proc.wait()
+    if timer is not None:
+        timer.cancel()
+    return returncode, bool(timed_out)
+
+
+def _helper_handle(request, send):
+    start = time.monotonic()
+    reply = {'id': request['id']}
+    try:
+        if request['op'] == 'run':
+            reply['returncode'], reply['timeout'] = _helper_run(request, send)
+        elif request['op'] in _HELPER_OPS:
+            _HELPER_OPS[request['op']](*request['args'])
+        else:
+            reply['error'] = "Unknown operation {0}".format(request['op'])
+    except (OSError, LookupError, ValueError, subprocess.SubprocessError) as error:
+        reply['error'] = str(error)
+    reply['elapsed'] = time.monotonic() - start
+    send(reply)
+
+
+def _helper_main(dest_dir):
+    """ Enters dest_dir and serves requests until stdin is closed. Everything
+        needed is imported before entering it, the chroot may have no Python """
+    output = sys.stdout.buffer
+    output_lock = threading.Lock()
+
+    def send(message):
+        with output_lock:
+            output.write((json.dumps(message) + '\n').encode())
+            output.flush()
+
+    os.chroot(dest_dir)
+    os.chdir('/')
+
+    workers = []
+    for line in sys.stdin.buffer:
+        request = json.loads(line.decode())
+        worker = threading.Thread(target=_helper_handle, args=(request, send))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    _helper_main(sys.argv[1])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  copy_journal.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Journal of the files already copied to the target, so that a failed or
+    interrupted install can carry on where it stopped """
+
+import ctypes
+import json
+import logging
+import os
+import stat
+import threading
+import time
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+JOURNAL_NAME = '.thus-copy-journal'
+
+# Seconds between journal writes. Each write syncs the target first, so a
+# file is never recorded before its data is on disk
+CHECKPOINT_INTERVAL = 10
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def _syncfs(fd):
+    """ Flushes the filesystem fd is in (everything, if there's no syncfs) """
+    try:
+        if _libc.syncfs(fd) == 0:
+            return
+    except AttributeError:
+        pass
+    os.sync()
+
+
+class CopyJournal(object):
+    """ Append-only list of (path, size, mtime) of the files fully copied to
+        dest_dir, stored in dest_dir itself """
+
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        self.path = os.path.join(dest_dir, JOURNAL_NAME)
+        self.done = self._load()
+        self._pending = []
+        self._file = None
+        self._lock = threading.Lock()
+        # Held while a checkpoint syncs and writes (without _lock, so the
+        # other workers can go on recording)
+        self._write_lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+        if self.done:
+            logging.debug(_("Copy journal found, {0} files were already copied").format(
+                len(self.done)))
+
+    def _load(self):
+        done = {}
+        try:
+            with open(self.path, 'r') as journal:
+                for line in journal:
+                    try:
+                        path, size, mtime = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted write
+                        break
+                    done[path] = (size, mtime)
+        except FileNotFoundError:
+            pass
+        except OSError as os_error:
+            logging.warning(_("Can't read copy journal {0}: {1}").format(self.path, os_error))
+        return done
+
+    def is_done(self, path, size, mtime):
+        """ True if the journal says this file was copied and the target
+            still has it, with the same size and modification time """
+        if self.done.get(path) != (size, mtime):
+            return False
+        try:
+            st = os.lstat(os.path.join(self.dest_dir, path))
+        except OSError:
+            return False
+        return stat.S_ISREG(st.st_mode) and st.st_size == size and int(st.st_mtime) == mtime
+
+    def record(self, path, size, mtime):
+        """ Adds a file whose data and metadata have been written """
+        with self._lock:
+            self._pending.append((path, size, mtime))
+            if time.monotonic() - self._last_checkpoint < CHECKPOINT_INTERVAL:
+                return
+            self._last_checkpoint = time.monotonic()
+        # If another worker is writing a checkpoint, this one isn't needed
+        if self._write_lock.acquire(blocking=False):
+            try:
+                self._checkpoint()
+            finally:
+                self._write_lock.release()
+
+    def _checkpoint(self):
+        """ Syncs the target and writes the entries pending until now. Call
+            it holding _write_lock """
+        with self._lock:
+            entries, self._pending = self._pending, []
+        if not entries:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            _syncfs(self._file.fileno())
+            for entry in entries:
+                self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except BaseException:
+            with self._lock:
+                self._pending = entries + self._pending
+            raise
+
+    def close(self):
+        """ Writes what is pending (the copy stopped or failed) """
+        with self._write_lock:
+            try:
+                self._checkpoint()
+            finally:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+
+    def remove(self):
+        """ Deletes the journal once the copy is complete """
+        with self._write_lock, self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._pending = []
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
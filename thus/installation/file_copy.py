@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  file_copy.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Copies mounted directory trees (the live media images) to the target.
+    The kernel moves the data (reflinks, copy_file_range or sendfile) while
+    a pool of worker threads keeps many small files in flight """
+
+import collections
+import concurrent.futures
+import errno
+import fcntl
+import logging
+import os
+import stat
+
+from installation import page_cache
+from installation import squashfs
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+# ioctl that shares the extents of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Files at least this big are copied in their own job, in kernel space
+LARGE_FILE = 1024 * 1024
+
+# Size of each copy_file_range / sendfile call
+COPY_CHUNK = 64 * 1024 * 1024
+
+# Small files (and symlinks, device nodes...) of the same directory are
+# copied together, up to this many per job
+BATCH_SIZE = 256
+
+# Errors that mean "this kernel (or filesystem) can't do that, try another way"
+UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                      errno.ENOTTY, errno.EBADF)
+
+
+class DirectoryPlan(squashfs.CopyPlan):
+    """ Merged list of the entries of several directories (layers).
+        Entries are os.stat_result objects """
+
+    def _walk_layer(self, source):
+        pending = [('', os.lstat(source))]
+        while pending:
+            path, st = pending.pop()
+            size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+            yield path, st, st.st_mode, size
+            if stat.S_ISDIR(st.st_mode):
+                with os.scandir(os.path.join(source, path)) as entries:
+                    children = [(os.path.join(path, entry.name), entry.stat(follow_symlinks=False))
+                                for entry in entries]
+                # Reversed, so they are popped in name order
+                children.sort(key=lambda child: child[0], reverse=True)
+                pending.extend(children)
+
+    def _load(self, source, st):
+        return st
+
+    def _position(self, source, st):
+        # mksquashfs numbers inodes in the order it scans the tree, which is
+        # also the order it writes their data in, so on a mounted image this
+        # follows the layout of the image closely
+        return st.st_ino
+
+
+def _copy_xattrs(src_fd, dst_fd):
+    """ Copies extended attributes (file capabilities, ACLs...) """
+    try:
+        names = os.listxattr(src_fd)
+    except OSError as os_error:
+        if os_error.errno in (errno.ENOTSUP, errno.ENOSYS):
+            return
+        raise
+    for name in names:
+        try:
+            os.setxattr(dst_fd, name, os.getxattr(src_fd, name))
+        except OSError as os_error:
+            # Some targets (vfat /boot) don't support them
+            if os_error.errno not in (errno.ENOTSUP, errno.ENOSYS, errno.EPERM):
+                raise
+
+
+def _kernel_copy(func, src_fd, dst_fd, size):
+    """ Copies size bytes from the current offsets using func, which is
+        os.copy_file_range or os.sendfile. Stops early at end of file """
+    copied = 0
+    while copied < size:
+        if func is os.sendfile:
+            count = os.sendfile(dst_fd, src_fd, None, min(COPY_CHUNK, size - copied))
+        else:
+            count = func(src_fd, dst_fd, min(COPY_CHUNK, size - copied))
+        if count == 0:
+            break
+        copied += count
+
+
+def copy_data(src_fd, dst_fd, size, same_fs=False):
+    """ Copies the contents of a file, letting the kernel do the work when it can """
+    if same_fs:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError as os_error:
+            if os_error.errno not in UNSUPPORTED_ERRORS:
+                raise
+
+    if size >= LARGE_FILE:
+        funcs = [os.sendfile]
+        if hasattr(os, 'copy_file_range'):
+            funcs.insert(0, os.copy_file_range)
+        for func in funcs:
+            try:
+                _kernel_copy(func, src_fd, dst_fd, size)
+                return
+            except OSError as os_error:
+                # Both calls use (and move) the file offsets, so the next
+                # one carries on from where this one failed
+                if os_error.errno not in UNSUPPORTED_ERRORS:
+                    raise
+
+    while True:
+        data = os.read(src_fd, COPY_CHUNK)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+
+def _set_metadata(name, st, fd=None, dir_fd=None):
+    """ Restores ownership, permissions and modification time, either through
+        an open file or by name, relative to dir_fd """
+    times = (st.st_atime_ns, st.st_mtime_ns)
+    if fd is not None:
+        os.fchown(fd, st.st_uid, st.st_gid)
+        os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        os.utime(fd, ns=times)
+    elif stat.S_ISLNK(st.st_mode):
+        os.chown(name, st.st_uid, st.st_gid, dir_fd=dir_fd, follow_symlinks=False)
+        os.utime(name, ns=times, dir_fd=dir_fd, follow_symlinks=False)
+    else:
+        os.chown(name, st.st_uid, st.st_gid, dir_fd=dir_fd)
+        os.chmod(name, stat.S_IMODE(st.st_mode), dir_fd=dir_fd)
+        os.utime(name, ns=times, dir_fd=dir_fd)
+
+
+def _remove_existing(name, dir_fd=None):
+    """ Removes whatever is in our way (rsync replaces files too) """
+    try:
+        if stat.S_ISDIR(os.lstat(name, dir_fd=dir_fd).st_mode):
+            os.rmdir(name, dir_fd=dir_fd)
+        else:
+            os.unlink(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+
+class TreeCopier(squashfs.Extractor):
+    """ Copies the entries of a DirectoryPlan.
+        Large files get a job of their own, small ones are grouped by
+        directory so each job opens its directories once and works with
+        names relative to them """
+
+    @staticmethod
+    def _signature(st):
+        return st.st_size, int(st.st_mtime)
+
+    def _copy_file(self, src_fd, name, st, dir_fd, dest_dev, target):
+        """ Creates a file and copies its data, permissions and xattrs """
+        _remove_existing(name, dir_fd)
+        dst_fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW,
+                         0o600, dir_fd=dir_fd)
+        try:
+            same_fs = st.st_dev == dest_dev
+            if st.st_size >= LARGE_FILE and not same_fs:
+                try:
+                    os.posix_fallocate(dst_fd, 0, st.st_size)
+                except OSError:
+                    # Not all filesystems support it
+                    pass
+            copy_data(src_fd, dst_fd, st.st_size, same_fs)
+            os.ftruncate(dst_fd, st.st_size)
+            _copy_xattrs(src_fd, dst_fd)
+            _set_metadata(name, st, fd=dst_fd)
+            if self.write_behind is not None:
+                page_cache.drop(src_fd)
+                self.write_behind.written(dst_fd, target, st.st_size)
+        finally:
+            os.close(dst_fd)
+
+    def _copy_large(self, source, path, st):
+        """ Copies one large file """
+        if self.stop_event.is_set():
+            return
+        target = self._target(path)
+        dir_fd = os.open(os.path.dirname(target), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            src_fd = os.open(os.path.join(source, path), os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                self._copy_file(src_fd, os.path.basename(path), st, dir_fd,
+                                os.fstat(dir_fd).st_dev, target)
+            finally:
+                os.close(src_fd)
+        finally:
+            os.close(dir_fd)
+        self._record(path, st)
+        self._done(1, st.st_size)
+
+    def _copy_batch(self, parent, batch):
+        """ Copies small files, symlinks and special files of a directory """
+        if self.stop_event.is_set():
+            return
+        dir_fd = os.open(self._target(parent), os.O_RDONLY | os.O_DIRECTORY)
+        source_fds = {}
+        num_bytes = 0
+        try:
+            dest_dev = os.fstat(dir_fd).st_dev
+            for source, name, st in batch:
+                if source not in source_fds:
+                    source_fds[source] = os.open(os.path.join(source, parent),
+                                                 os.O_RDONLY | os.O_DIRECTORY)
+                source_fd = source_fds[source]
+
+                if stat.S_ISREG(st.st_mode):
+                    src_fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=source_fd)
+                    try:
+                        self._copy_file(src_fd, name, st, dir_fd, dest_dev,
+                                        os.path.join(self._target(parent), name))
+                    finally:
+                        os.close(src_fd)
+                    self._record(os.path.join(parent, name), st)
+                    num_bytes += st.st_size
+                    continue
+
+                _remove_existing(name, dir_fd)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(name, dir_fd=source_fd), name, dir_fd=dir_fd)
+                else:
+                    os.mknod(name, st.st_mode, st.st_rdev, dir_fd=dir_fd)
+                _set_metadata(name, st, dir_fd=dir_fd)
+        finally:
+            for source_fd in source_fds.values():
+                os.close(source_fd)
+            os.close(dir_fd)
+        self._done(len(batch), num_bytes)
+
+    def _make_dir(self, path):
+        target = self._target(path)
+        if not os.path.isdir(target) or os.path.islink(target):
+            _remove_existing(target)
+            os.mkdir(target, 0o700)
+
+    def run(self, entries):
+        """ Copies (source dir, path, stat) entries, parents before children
+            (see DirectoryPlan). Raises the first error found by any worker """
+        directories = []
+        hard_links = {}
+        pending_links = []
+        batches = collections.OrderedDict()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for source, path, st in entries:
+                if self.stop_event.is_set():
+                    break
+                if stat.S_ISDIR(st.st_mode):
+                    self._make_dir(path)
+                    directories.append((source, path, st))
+                    continue
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    key = (st.st_dev, st.st_ino)
+                    if key in hard_links:
+                        pending_links.append((hard_links[key], path))
+                        continue
+                    hard_links[key] = path
+                if stat.S_ISREG(st.st_mode) and self._already_copied(path, st):
+                    continue
+                if stat.S_ISREG(st.st_mode) and st.st_size >= LARGE_FILE:
+                    self._submit(executor, self._copy_large, source, path, st)
+                    continue
+
+                parent, name = os.path.split(path)
+                batch = batches.setdefault(parent, [])
+                batch.append((source, name, st))
+                if len(batch) >= BATCH_SIZE:
+                    self._submit(executor, self._copy_batch, parent, batches.pop(parent))
+
+            for parent, batch in batches.items():
+                if self.stop_event.is_set():
+                    break
+                self._submit(executor, self._copy_batch, parent, batch)
+
+        if self._error is not None:
+            raise self._error
+        if self.stop_event.is_set():
+            return False
+
+        for source, path in pending_links:
+            target = self._target(path)
+            _remove_existing(target)
+            os.link(self._target(source), target)
+            self._done(1, 0)
+
+        # Deepest directories first, so their parents' mtime is preserved
+        for source, path, st in reversed(directories):
+            src_fd = os.open(os.path.join(source, path), os.O_RDONLY | os.O_DIRECTORY)
+            dir_fd = os.open(self._target(path), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                _copy_xattrs(src_fd, dir_fd)
+                _set_metadata(path, st, fd=dir_fd)
+            finally:
+                os.close(dir_fd)
+                os.close(src_fd)
+            self._done(1, 0)
+
+        logging.debug(_("Copied {0} files ({1} bytes) to {2}").format(
+            self.files_done, self.bytes_done, self.dest_dir))
+        if self.files_skipped:
+            logging.debug(_("{0} files ({1} bytes) were already there from a previous attempt").format(
+                self.files_skipped, self.bytes_skipped))
+        return True
@@ -21,6 +21,8 @@
 import os
 import re
 
+import misc.block_devices as block_devices
+
 
 HEADER = """# /etc/fstab: static file system information.
 #
@@ -44,12 +46,8 @@ def is_ssd_disk(disk_name):
     :param disk_name:
     :return:
     """
-    filename = os.path.join("/sys/block", disk_name, "queue/rotational")
-    if not os.path.exists(filename):
-        # Should not happen unless sysfs changes, but better safe than sorry
-        return False
-    with open(filename) as f:
-        return f.read() == "0\n"
+    # Unknown disks (should not happen) are taken as not being ssd
+    return block_devices.is_ssd("/dev/" + disk_name) or False
 
 
 def disk_name_for_partition(partition):
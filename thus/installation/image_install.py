@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  image_install.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Block-level install ('image' partition mode): a prebuilt ext4 or btrfs
+    image is written to the root partition with large sequential writes and
+    then grown to fill it, instead of copying the live images file by file.
+
+    Run as a module (see bin/thus-build-image) to build that image from the
+    live squashfs images """
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+import parted3.fs_module as fs
+from installation import file_copy
+from installation import squashfs
+
+from configobj import ConfigObj
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+conf_file = '/etc/thus.conf'
+configuration = ConfigObj(conf_file)
+
+# ioctl that zeroes a range of a block device (letting the device do it
+# when it can, with discard or write-zeroes)
+BLKZEROOUT = 0x127f
+
+# Bytes written by each sendfile call
+WRITE_CHUNK = 64 * 1024 * 1024
+
+MIB = 1024 * 1024
+
+# Filesystems an image can be built with
+IMAGE_FILESYSTEMS = ('ext4', 'btrfs')
+
+
+class ImageError(Exception):
+    """ The system image can't be built or installed """
+    pass
+
+
+def image_path():
+    """ Returns the configured system image (ROOT_IMAGE in thus.conf) """
+    return configuration['install'].get('ROOT_IMAGE', '')
+
+
+def image_available():
+    """ True if there is a system image to install from """
+    path = image_path()
+    return bool(path) and os.path.exists(path)
+
+
+def device_size(fd):
+    """ Size in bytes of an open block device (or file) """
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+def _zero(fd, offset, length):
+    """ Zeroes part of the target, as the image has a hole there """
+    try:
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+        return
+    except OSError:
+        # Not a block device (or too old a kernel), write the zeroes ourselves
+        pass
+    zeroes = bytes(min(length, WRITE_CHUNK))
+    end = offset + length
+    while offset < end:
+        offset += os.pwrite(fd, zeroes[:end - offset], offset)
+
+
+def _data_ranges(fd, size):
+    """ Yields (start, end) of the parts of a sparse file that hold data """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as os_error:
+            if os_error.errno == errno.ENXIO:
+                # Only a hole is left
+                return
+            # No SEEK_DATA support, all of it is data
+            yield offset, size
+            return
+        yield start, min(end, size)
+        offset = end
+
+
+def write_image(image, device, callback=None):
+    """ Writes image to device. Data is sent with sendfile in big chunks, holes
+        are zeroed by the device. callback(bytes_done) is called as we go """
+    in_fd = os.open(image, os.O_RDONLY)
+    try:
+        size = os.fstat(in_fd).st_size
+        out_fd = os.open(device, os.O_WRONLY)
+        try:
+            if size > device_size(out_fd):
+                raise ImageError(_("System image {0} ({1} bytes) doesn't fit in {2}").format(
+                    image, size, device))
+            position = 0
+            for start, end in _data_ranges(in_fd, size):
+                if start > position:
+                    _zero(out_fd, position, start - position)
+                os.lseek(in_fd, start, os.SEEK_SET)
+                os.lseek(out_fd, start, os.SEEK_SET)
+                position = start
+                while position < end:
+                    count = os.sendfile(out_fd, in_fd, None, min(WRITE_CHUNK, end - position))
+                    if count == 0:
+                        raise ImageError(_("Unexpected end of {0}").format(image))
+                    position += count
+                    if callback is not None:
+                        callback(position)
+            if position < size:
+                _zero(out_fd, position, size - position)
+            os.fsync(out_fd)
+        finally:
+            os.close(out_fd)
+    finally:
+        os.close(in_fd)
+    if callback is not None:
+        callback(size)
+
+
+def new_uuid(device, fs_type):
+    """ Gives the filesystem written from the image a UUID of its own, so
+        machines installed from the same image can be told apart """
+    if fs_type.startswith('ext'):
+        cmd = ["tune2fs", "-U", "random", device]
+    else:
+        cmd = ["btrfstune", "-f", "-u", device]
+    try:
+        subprocess.check_call(cmd)
+    except (OSError, subprocess.CalledProcessError) as err:
+        logging.warning(_("Can't change the UUID of {0}: {1}").format(device, err))
+
+
+def grow_filesystem(device, fs_type):
+    """ Grows the filesystem written from the image to fill its partition """
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        size_mb = device_size(fd) // MIB
+    finally:
+        os.close(fd)
+
+    if fs_type.startswith('ext'):
+        # resize2fs wants a freshly checked filesystem
+        # (e2fsck returns 1 or 2 when it fixed something)
+        if subprocess.call(["e2fsck", "-f", "-y", device]) >= 4:
+            raise ImageError(_("Filesystem check of {0} failed").format(device))
+
+    if not fs.resize(device, fs_type, size_mb):
+        raise ImageError(_("Can't grow the {0} filesystem in {1} to {2} MiB").format(
+            fs_type, device, size_mb))
+    logging.debug(_("{0} filesystem in {1} grown to {2} MiB").format(fs_type, device, size_mb))
+
+
+def move_to_partition(dest_dir, mount_point, device):
+    """ Moves what the image has in mount_point (/boot...) to the partition
+        that will be mounted there, and mounts it """
+    source = os.path.join(dest_dir, mount_point.lstrip('/'))
+    os.makedirs(source, exist_ok=True)
+
+    staging = tempfile.mkdtemp(prefix="thus-")
+    try:
+        subprocess.check_call(["mount", device, staging])
+        try:
+            copier = file_copy.TreeCopier(staging)
+            copier.run(file_copy.DirectoryPlan([source]).layout_order())
+        finally:
+            subprocess.call(["umount", staging])
+    finally:
+        os.rmdir(staging)
+
+    # Free the space these files took in the root partition
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    subprocess.check_call(["mount", device, source])
+
+
+def build_image(images, output, fs_type='ext4', size_mb=None, label='Manjaro'):
+    """ Builds a system image from the live squashfs images (the last one
+        wins, as when they are copied). ext images are shrunk to fit """
+    if fs_type not in IMAGE_FILESYSTEMS:
+        raise ImageError(_("Can't build a {0} image").format(fs_type))
+
+    opened = [squashfs.SquashfsImage(path) for path in images]
+    try:
+        plan = squashfs.CopyPlan(opened)
+        if size_mb is None:
+            # Room for metadata and journals
+            size_mb = int(plan.bytes * 1.3 / MIB) + 512
+        logging.info(_("Building a {0} MiB {1} image of {2} files ({3} bytes)").format(
+            size_mb, fs_type, len(plan), plan.bytes))
+
+        with open(output, 'wb') as image_file:
+            image_file.truncate(size_mb * MIB)
+        options = '-F -m 1 -O dir_index' if fs_type.startswith('ext') else ''
+        failed, result = fs.create_fs(output, fs_type, label, options)
+        if failed:
+            raise ImageError(_("Can't create a {0} filesystem in {1}: {2}").format(
+                fs_type, output, result))
+
+        mount_dir = tempfile.mkdtemp(prefix="thus-image-")
+        try:
+            subprocess.check_call(["mount", "-o", "loop", output, mount_dir])
+            try:
+                extractor = squashfs.Extractor(mount_dir)
+                extractor.run(plan.layout_order())
+            finally:
+                subprocess.check_call(["umount", mount_dir])
+        finally:
+            os.rmdir(mount_dir)
+    finally:
+        for image in opened:
+            image.close()
+
+    if fs_type.startswith('ext'):
+        # Make the image as small as it can be, it is grown when installed
+        subprocess.call(["e2fsck", "-f", "-y", output])
+        subprocess.check_call(["resize2fs", "-M", output])
+        info = subprocess.check_output(["dumpe2fs", "-h", output],
+                                       stderr=subprocess.DEVNULL).decode()
+        fields = dict(line.split(':', 1) for line in info.splitlines() if ':' in line)
+        size = int(fields['Block count']) * int(fields['Block size'])
+        with open(output, 'r+b') as image_file:
+            image_file.truncate(size)
+    logging.info(_("System image {0} built ({1} bytes)").format(output, os.path.getsize(output)))
+
+
+def main():
+    """ Companion command that builds the system image """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=_("Builds the system image used by the 'image' install mode"))
+    parser.add_argument(
+        "images", nargs='*',
+        help=_("Live squashfs images, in order (defaults to the ones in thus.conf)"))
+    parser.add_argument(
+        "-o", "--output", default=image_path() or "root-image.img",
+        help=_("Image to create (defaults to ROOT_IMAGE in thus.conf)"))
+    parser.add_argument(
+        "-t", "--type", default='ext4', choices=IMAGE_FILESYSTEMS,
+        help=_("Filesystem of the image"))
+    parser.add_argument(
+        "-s", "--size", type=int,
+        help=_("Size of the image while it is built, in MiB"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG, format="%(levelname)s: %(message)s")
+    images = args.images
+    if not images:
+        images = [configuration['install']['LIVE_MEDIA_SOURCE'],
+                  configuration['install']['LIVE_MEDIA_DESKTOP']]
+    build_image(images, args.output, args.type, args.size)
+
+
+if __name__ == '__main__':
+    main()
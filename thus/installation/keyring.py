@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  keyring.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Pacman keyring stage. The live system's keyring (whose keys pacman-init
+    generated) is copied to the target, and it's only populated again when
+    the target has other keyring packages than the live system, or the live
+    keyring wasn't populated """
+
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+from installation import chroot
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+GNUPG_DIR = "etc/pacman.d/gnupg"
+KEYRINGS_DIR = "usr/share/pacman/keyrings"
+
+# Keyrings populated when that's needed
+KEYRINGS = ['archlinux', 'manjaro']
+
+# How long the last populate took (to tell how much time is saved)
+STATS_FILE = "/var/cache/thus/keyring.json"
+
+
+def keyring_versions(root):
+    """ Versions of the keyring packages (of KEYRINGS) installed in root,
+        by package """
+    versions = {}
+    for keyring in KEYRINGS:
+        pattern = "var/lib/pacman/local/{0}-keyring-[0-9]*".format(keyring)
+        for path in glob.glob(os.path.join(root, pattern)):
+            name, version, release = os.path.basename(path).rsplit('-', 2)
+            versions[name] = "{0}-{1}".format(version, release)
+    return versions
+
+
+def trusted_fingerprints(root):
+    """ Fingerprints the keyrings in root ask to be trusted """
+    fingerprints = set()
+    for path in glob.glob(os.path.join(root, KEYRINGS_DIR, "*-trusted")):
+        try:
+            with open(path) as trusted:
+                for line in trusted:
+                    if line.strip() and not line.startswith('#'):
+                        fingerprints.add(line.split(':')[0].upper())
+        except OSError as os_error:
+            logging.debug(_("Can't read {0}: {1}").format(path, os_error))
+    return fingerprints
+
+
+def is_populated(root):
+    """ True if the keyring in root trusts every key its keyring packages
+        ask for (which is what populating it does) """
+    fingerprints = trusted_fingerprints(root)
+    if not fingerprints:
+        return False
+    try:
+        output = subprocess.check_output(
+            ["gpg", "--homedir", os.path.join(root, GNUPG_DIR), "--export-ownertrust"],
+            stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError) as error:
+        logging.debug(_("Can't read the keyring's owner trust: {0}").format(error))
+        return False
+    trusted = set(line.split(':')[0].upper() for line in output.splitlines()
+                  if line and not line.startswith('#'))
+    return fingerprints <= trusted
+
+
+def copy_keyring(dest_dir):
+    """ Replaces the target's keyring with a copy of the live one. Agent
+        sockets and lock files are left out """
+    target = os.path.join(dest_dir, GNUPG_DIR)
+    if os.path.lexists(target):
+        shutil.rmtree(target)
+    shutil.copytree("/" + GNUPG_DIR, target, symlinks=True,
+                    ignore=shutil.ignore_patterns("S.*", "*.lock", ".#*"))
+
+
+def _last_populate_time():
+    try:
+        with open(STATS_FILE) as stats:
+            return json.load(stats).get('populate')
+    except (OSError, ValueError):
+        return None
+
+
+def _store_populate_time(seconds):
+    try:
+        os.makedirs(os.path.dirname(STATS_FILE), exist_ok=True)
+        with open(STATS_FILE, 'w') as stats:
+            json.dump({'populate': seconds}, stats)
+    except OSError:
+        pass
+
+
+def setup(dest_dir):
+    """ Sets up the target's keyring """
+    start = time.time()
+    try:
+        copy_keyring(dest_dir)
+        copied = time.time() - start
+    except OSError as os_error:
+        logging.warning(_("Can't copy the live keyring: {0}").format(os_error))
+        copied = None
+
+    live_versions = keyring_versions("/")
+    target_versions = keyring_versions(dest_dir)
+    if copied is not None and live_versions and live_versions == target_versions and \
+            is_populated("/"):
+        last = _last_populate_time()
+        if last is not None:
+            saved = _("{0:.1f} seconds saved").format(last - copied)
+        else:
+            saved = _("{0} keys not imported again").format(len(trusted_fingerprints("/")))
+        logging.debug(_("Live keyring copied in {0:.1f} seconds, populate skipped ({1})").format(
+            copied, saved))
+        return
+
+    if live_versions != target_versions:
+        logging.debug(_("Keyring packages differ (live {0}, target {1}), populating").format(
+            live_versions, target_versions))
+    start = time.time()
+    chroot.run(['pacman-key', '--populate'] + KEYRINGS, dest_dir)
+    populate = time.time() - start
+    _store_populate_time(populate)
+    logging.debug(_("Keyring populated in {0:.1f} seconds").format(populate))
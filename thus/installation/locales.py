@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  locales.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Locale stage. Instead of running locale-gen, which compiles every
+    locale enabled in locale.gen from scratch, the locales the target's
+    locale-archive lacks are taken from the live system's archive (when
+    both have the same glibc) or from a cache of earlier builds, and only
+    what is still missing is compiled, several locales at a time """
+
+import concurrent.futures
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import time
+
+from installation import chroot
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+ARCHIVE = "usr/lib/locale/locale-archive"
+LOCALE_GEN = "etc/locale.gen"
+LOCALE_SOURCES = "usr/share/i18n/locales"
+
+# Compiled archives, by glibc version and list of locales
+CACHE_DIR = "/var/cache/thus/locales"
+
+# Magic number and header of a locale-archive (see glibc's locarchive.h)
+ARCHIVE_MAGIC = 0xde020109
+_ARCHIVE_HEADER = struct.Struct('=14I')
+_NAMEHASH_ENTRY = struct.Struct('=3I')
+
+
+def glibc_version(root):
+    """ Version of the glibc package installed in root (None if unknown) """
+    for path in glob.glob(os.path.join(root, "var/lib/pacman/local/glibc-[0-9]*")):
+        return os.path.basename(path)[len("glibc-"):]
+    return None
+
+
+def enabled_locales(root):
+    """ Locales enabled in root's locale.gen, as (locale, charset) pairs """
+    locales = []
+    try:
+        with open(os.path.join(root, LOCALE_GEN)) as locale_gen:
+            for line in locale_gen:
+                fields = line.split()
+                if len(fields) == 2 and not fields[0].startswith('#'):
+                    locales.append((fields[0], fields[1]))
+    except OSError as os_error:
+        logging.warning(_("Can't read locale.gen: {0}").format(os_error))
+    return locales
+
+
+def normalize(locale):
+    """ Name a locale is stored with in the archive: the codeset is written
+        in lowercase without punctuation (en_US.UTF-8 -> en_US.utf8) """
+    name, dot, rest = locale.partition('.')
+    if not dot:
+        return locale
+    codeset, at, modifier = rest.partition('@')
+    codeset = ''.join(char for char in codeset if char.isalnum()).lower()
+    if codeset.isdigit():
+        codeset = "iso" + codeset
+    return name + '.' + codeset + at + modifier
+
+
+def archive_locales(path):
+    """ Names of the locales stored in a locale-archive """
+    try:
+        with open(path, 'rb') as archive:
+            data = archive.read()
+    except OSError:
+        return set()
+    if len(data) < _ARCHIVE_HEADER.size:
+        return set()
+    header = _ARCHIVE_HEADER.unpack_from(data)
+    if header[0] != ARCHIVE_MAGIC:
+        logging.warning(_("{0} is not a locale archive").format(path))
+        return set()
+    namehash_offset, namehash_size = header[2], header[4]
+    names = set()
+    for index in range(namehash_size):
+        hashval, name_offset, locrec_offset = _NAMEHASH_ENTRY.unpack_from(
+            data, namehash_offset + index * _NAMEHASH_ENTRY.size)
+        if name_offset != 0 and locrec_offset != 0:
+            end = data.index(b'\0', name_offset)
+            names.add(data[name_offset:end].decode())
+    return names
+
+
+class LocaleStage(object):
+    """ Makes the locales enabled in dest_dir's locale.gen available """
+
+    def __init__(self, dest_dir, workers=None):
+        self.dest_dir = dest_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.archive = os.path.join(dest_dir, ARCHIVE)
+        self.glibc = glibc_version(dest_dir)
+
+    def cache_path(self, names):
+        key = hashlib.sha1(" ".join(sorted(names)).encode()).hexdigest()
+        return os.path.join(CACHE_DIR, self.glibc, key, "locale-archive")
+
+    def use_archive(self, path, names, origin):
+        """ Takes path as the target's archive if it has all names """
+        if not names <= archive_locales(path):
+            return False
+        os.makedirs(os.path.dirname(self.archive), exist_ok=True)
+        shutil.copyfile(path, self.archive + '+')
+        os.rename(self.archive + '+', self.archive)
+        logging.debug(_("Locale archive taken from {0}").format(origin))
+        return True
+
+    def compile(self, locale, charset):
+        """ Compiles a locale into the target's archive, as locale-gen does """
+        locale_input = locale
+        if not os.path.exists(os.path.join(self.dest_dir, LOCALE_SOURCES, locale)):
+            name, dot, rest = locale.partition('.')
+            modifier = rest.partition('@')[1:]
+            locale_input = name + ''.join(modifier) if dot else locale
+        cmd = ['localedef', '-i', locale_input, '-c', '-f', charset,
+               '-A', '/usr/share/locale/locale.alias', locale]
+        return chroot.run(cmd, self.dest_dir)
+
+    def run(self):
+        start = time.time()
+        locales = enabled_locales(self.dest_dir)
+        names = set(normalize(locale) for locale, charset in locales)
+
+        present = archive_locales(self.archive)
+        missing = [(locale, charset) for locale, charset in locales
+                   if normalize(locale) not in present]
+        if not missing:
+            logging.debug(_("All locales ({0}) are already in the archive").format(
+                ", ".join(sorted(names))))
+            return
+
+        if self.glibc is not None:
+            if self.use_archive(self.cache_path(names), names, _("the cache")):
+                return
+            if self.glibc == glibc_version("/") and \
+                    self.use_archive("/" + ARCHIVE, names, _("the live system")):
+                return
+
+        # localedef locks the archive while it adds a locale to it
+        logging.debug(_("Compiling locales {0}").format(
+            ", ".join(locale for locale, charset in missing)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(lambda entry: self.compile(*entry), missing))
+        failed = [locale for (locale, charset), result in zip(missing, results) if result != 0]
+        if failed:
+            logging.warning(_("Can't compile locales {0}").format(", ".join(failed)))
+        elif self.glibc is not None:
+            self.store_cache(names)
+        logging.debug(_("Locales compiled in {0:.1f} seconds").format(time.time() - start))
+
+    def store_cache(self, names):
+        """ Keeps the compiled archive for the next install """
+        path = self.cache_path(names)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(self.archive, path + '+')
+            os.rename(path + '+', path)
+        except OSError as os_error:
+            logging.debug(_("Can't cache the locale archive: {0}").format(os_error))
@@ -26,8 +26,14 @@
 
 """ Module to setup and run mkinitcpio """
 
+import concurrent.futures
+import hashlib
 import logging
 import os
+import re
+import shutil
+import subprocess
+import time
 
 from installation import chroot
 from configobj import ConfigObj
@@ -35,6 +41,9 @@ from configobj import ConfigObj
 conf_file = '/etc/thus.conf'
 configuration = ConfigObj(conf_file)
 
+# Images built during an install are kept here, by key (see image_key)
+CACHE_DIR = "/var/cache/thus/initramfs"
+
 def run(dest_dir, settings, mount_devices, blvm):
     """ Runs mkinitcpio """
 
@@ -93,8 +102,175 @@ def run(dest_dir, settings, mount_devices, blvm):
     # Fix for bsdcpio error. See: http://forum.antergos.com/viewtopic.php?f=5&t=1378&start=20#p5450
     locale = settings.get('locale')
     kernel = configuration['install']['KERNEL']
-    cmd = ['sh', '-c', 'LANG={0} /usr/bin/mkinitcpio -p {1}'.format(locale,kernel)]
-    chroot.run(cmd, dest_dir)
+    presets = read_presets(dest_dir, kernel)
+    if not presets:
+        cmd = ['sh', '-c', 'LANG={0} /usr/bin/mkinitcpio -p {1}'.format(locale,kernel)]
+        chroot.run(cmd, dest_dir)
+        return
+
+    compression = get_compression(dest_dir)
+    to_build = []
+    for preset in presets:
+        preset['key'] = image_key(dest_dir, preset, compression)
+        cached = find_cached_image(preset['key'])
+        if cached is not None:
+            shutil.copyfile(cached, os.path.join(dest_dir, preset['image'].lstrip('/')))
+            logging.debug(_("Initramfs {0} taken from {1}").format(preset['image'], cached))
+        else:
+            to_build.append(preset)
+
+    # Presets (default and fallback) are built at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(to_build))) as executor:
+        builds = [executor.submit(build_image, dest_dir, preset, locale, compression)
+                  for preset in to_build]
+        for build in builds:
+            build.result()
+
+
+def read_presets(dest_dir, kernel):
+    """ Reads the kernel's mkinitcpio preset. Returns a list with the kernel,
+        config, image and options of each preset, or None if the file can't
+        be understood (mkinitcpio -p is used then) """
+    path = os.path.join(dest_dir, "etc/mkinitcpio.d/{0}.preset".format(kernel))
+    values = {}
+    try:
+        with open(path) as preset_file:
+            for line in preset_file:
+                match = re.match(r'\s*(\w+)=(.*)$', line)
+                if match:
+                    values[match.group(1)] = match.group(2).strip()
+    except OSError as os_error:
+        logging.warning(_("Can't read {0}: {1}").format(path, os_error))
+        return None
+
+    names = re.findall(r"[\w-]+", values.get('PRESETS', '').strip('()'))
+    presets = []
+    for name in names:
+        preset = {
+            'name': name,
+            'kver': values.get(name + '_kver', values.get('ALL_kver', '')),
+            'config': values.get(name + '_config', values.get('ALL_config', '/etc/mkinitcpio.conf')),
+            'image': values.get(name + '_image', ''),
+            'options': values.get(name + '_options', '')}
+        preset = dict((key, value.strip('"\'')) for key, value in preset.items())
+        if not preset['kver'] or not preset['image'] or '$' in ''.join(preset.values()):
+            logging.debug(_("Preset {0} of {1} can't be used directly").format(name, path))
+            return None
+        presets.append(preset)
+    return presets
+
+
+def get_compression(dest_dir):
+    """ Compressor to build the images with (INITRAMFS_COMPRESSION in
+        thus.conf, if the target has it), or None to use mkinitcpio.conf's """
+    compression = configuration['install'].get('INITRAMFS_COMPRESSION', '')
+    if not compression:
+        return None
+    if not os.path.exists(os.path.join(dest_dir, "usr/bin", compression)):
+        logging.debug(_("{0} isn't installed, initramfs compression left as it is").format(
+            compression))
+        return None
+    return compression
+
+
+def hardware_id():
+    """ Identifies the hardware autodetect looks at (the modalias of every
+        device) """
+    aliases = set()
+    for root, dirs, files in os.walk("/sys/devices"):
+        if "modalias" in files:
+            try:
+                with open(os.path.join(root, "modalias")) as modalias:
+                    aliases.add(modalias.read().strip())
+            except OSError:
+                pass
+    return "\n".join(sorted(aliases))
+
+
+def filesystem_types(dest_dir):
+    """ Filesystems of the target's / and /usr (autodetect adds their
+        modules and fsck helpers) """
+    types = []
+    for path in (dest_dir, os.path.join(dest_dir, "usr")):
+        try:
+            types.append(subprocess.check_output(
+                ["findmnt", "-uno", "FSTYPE", "-T", path], stderr=subprocess.DEVNULL).decode().strip())
+        except (OSError, subprocess.CalledProcessError) as error:
+            logging.debug(_("Can't tell the filesystem of {0}: {1}").format(path, error))
+            types.append("")
+    return types
+
+
+def image_key(dest_dir, preset, compression):
+    """ Key of the image a preset builds: it changes with the kernel, the
+        packages installed, mkinitcpio.conf (hooks and modules), the keymap,
+        /etc/modprobe.d (the modconf hook adds it), the compressor and,
+        unless autodetect is skipped, the hardware and the filesystems of
+        / and /usr """
+    key = hashlib.sha256()
+
+    kernel = os.path.join(dest_dir, preset['kver'].lstrip('/'))
+    if os.path.isfile(kernel):
+        with open(kernel, 'rb') as kernel_file:
+            key.update(hashlib.sha256(kernel_file.read()).digest())
+    else:
+        key.update(preset['kver'].encode())
+
+    packages = sorted(os.listdir(os.path.join(dest_dir, "var/lib/pacman/local")))
+    key.update("\n".join(packages).encode())
+
+    modprobe_dir = os.path.join(dest_dir, "etc/modprobe.d")
+    modprobe_files = sorted(os.listdir(modprobe_dir)) if os.path.isdir(modprobe_dir) else []
+    for path in [preset['config'], "/etc/vconsole.conf"] + \
+            [os.path.join("/etc/modprobe.d", name) for name in modprobe_files]:
+        key.update(path.encode() + b'\0')
+        try:
+            with open(os.path.join(dest_dir, path.lstrip('/')), 'rb') as config_file:
+                key.update(config_file.read())
+        except OSError:
+            pass
+
+    key.update("{0}\n{1}".format(preset['options'], compression).encode())
+    if "-S autodetect" not in preset['options']:
+        key.update(hardware_id().encode())
+        key.update(" ".join(filesystem_types(dest_dir)).encode())
+    return key.hexdigest()
+
+
+def find_cached_image(key):
+    """ Looks for an image built with the same key on the live medium
+        (INITRAMFS_CACHE in thus.conf) or in the local cache """
+    dirs = configuration['install'].get('INITRAMFS_CACHE', '')
+    if isinstance(dirs, str):
+        dirs = [dirs] if dirs else []
+    for cache_dir in list(dirs) + [CACHE_DIR]:
+        path = os.path.join(cache_dir, key + ".img")
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def build_image(dest_dir, preset, locale, compression):
+    """ Builds the image of a preset, and caches it """
+    start = time.time()
+    cmd = ['env', 'LANG={0}'.format(locale), '/usr/bin/mkinitcpio',
+           '-k', preset['kver'], '-c', preset['config'], '-g', preset['image']]
+    cmd.extend(preset['options'].split())
+    if compression is not None:
+        cmd.extend(['-z', compression])
+    if chroot.run(cmd, dest_dir) != 0:
+        logging.warning(_("mkinitcpio failed building the {0} image").format(preset['name']))
+        return
+    logging.debug(_("Initramfs {0} built in {1:.1f} seconds").format(
+        preset['image'], time.time() - start))
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, preset['key'] + ".img")
+        shutil.copyfile(os.path.join(dest_dir, preset['image'].lstrip('/')), path + '+')
+        os.rename(path + '+', path)
+    except OSError as os_error:
+        logging.debug(_("Can't cache the {0} image: {1}").format(preset['name'], os_error))
 
 
 def set_hooks_and_modules(dest_dir, hooks, modules):
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  page_cache.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Keeps the copy from filling the page cache with data nobody will read
+    again, which on small machines pushes the live session out of RAM """
+
+import collections
+import ctypes
+import ctypes.util
+import logging
+import os
+import threading
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+# sync_file_range flags (see linux/fs.h)
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# Files smaller than this are left to the kernel's own writeback
+MIN_TRACKED_SIZE = 128 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sync_file_range = _libc.sync_file_range
+    _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+except (OSError, AttributeError):
+    _sync_file_range = None
+
+
+def sync_file_range(fd, offset, length, flags):
+    """ Starts (and/or waits for) the writeback of part of a file. Falls back
+        to fdatasync when waiting is asked for and the call isn't available """
+    if _sync_file_range is not None:
+        if _sync_file_range(fd, offset, length, flags) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    elif flags & SYNC_FILE_RANGE_WAIT_AFTER:
+        os.fdatasync(fd)
+
+
+def drop(fd, offset=0, length=0):
+    """ Tells the kernel we won't read this part of a file again.
+        Dirty pages are only dropped once they have been written back """
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+class WriteBehind(object):
+    """ Flushes the files the copy has finished writing and drops them from
+        the page cache, from a thread of its own. About limit bytes are left
+        in flight; writers are held back when twice that is pending """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._files = collections.deque()
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def written(self, fd, path, size):
+        """ Called, with the file still open, once a file has been written """
+        if size < MIN_TRACKED_SIZE:
+            return
+        try:
+            # Writeback starts now, in the background
+            sync_file_range(fd, 0, 0, SYNC_FILE_RANGE_WRITE)
+        except OSError:
+            pass
+        with self._condition:
+            while self._pending > 2 * self.limit and not self._closed:
+                self._condition.wait()
+            self._files.append((path, size))
+            self._pending += size
+            self._condition.notify_all()
+
+    def _flush(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            # Replaced or removed meanwhile
+            return
+        try:
+            sync_file_range(fd, 0, 0, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                            SYNC_FILE_RANGE_WAIT_AFTER)
+            drop(fd)
+        except OSError as err:
+            logging.debug(_("Can't flush {0}: {1}").format(path, err))
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending < self.limit and not self._closed:
+                    self._condition.wait()
+                if not self._files:
+                    return
+                path, size = self._files.popleft()
+            self._flush(path)
+            with self._condition:
+                self._pending -= size
+                self._condition.notify_all()
+
+    def close(self):
+        """ Flushes what is left and stops the thread """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
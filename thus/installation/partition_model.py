@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  partition_model.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" In-memory model of the advanced partitioner's tree. Rows are grouped
+    (one group per disk, one for all LVM volumes); after an operation the
+    rows of the groups it touched are built again from parted and compared
+    with the ones shown, and only the rows that differ are changed, added
+    or removed in the Gtk.TreeStore. The same comparison, against the rows
+    we started with, tells which partitions will be deleted or changed """
+
+import collections
+import logging
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+# key identifies a row across rebuilds (a partition that is deleted and
+# created again gets a new one), parent is its parent row's key (None for
+# top level rows), uid is the partition uid used by stage_opts (None for
+# disks and volume groups) and values are the TreeStore columns
+PartitionRow = collections.namedtuple('PartitionRow', 'key parent uid is_new values')
+
+RowsDiff = collections.namedtuple('RowsDiff', 'added removed changed')
+
+
+def diff(old_rows, new_rows):
+    """ Compares two dicts of rows by key. A row whose parent changed counts
+        as removed and added again """
+    added = []
+    changed = []
+    for key, row in new_rows.items():
+        old = old_rows.get(key)
+        if old is None or old.parent != row.parent:
+            added.append(key)
+        elif old.values != row.values:
+            changed.append(key)
+    removed = [key for key, row in old_rows.items()
+               if key not in new_rows or new_rows[key].parent != row.parent]
+    return RowsDiff(added, removed, changed)
+
+
+class PartitionModel(object):
+    """ Keeps store showing the rows of each group """
+
+    def __init__(self, store):
+        self.store = store
+        # Keys of the rows of each group, in order
+        self.groups = collections.OrderedDict()
+        self.rows = {}
+        self.iters = {}
+        # Rows of the first update of each group
+        self.original = {}
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def all_rows(self):
+        """ Current rows, in tree order """
+        return [self.rows[key] for keys in self.groups.values() for key in keys]
+
+    def get_value(self, key, column):
+        return self.store.get_value(self.iters[key], column)
+
+    def set_value(self, key, column, value):
+        """ Changes a column of a row in the store (and in the model) """
+        values = list(self.rows[key].values)
+        values[column] = value
+        self.rows[key] = self.rows[key]._replace(values=values)
+        self.store.set_value(self.iters[key], column, value)
+
+    def _anchor(self, group):
+        """ Last top level row of the groups shown before group """
+        anchor = None
+        for other, keys in self.groups.items():
+            if other == group:
+                break
+            for key in keys:
+                if self.rows[key].parent is None:
+                    anchor = self.iters[key]
+        return anchor
+
+    def _remove(self, keys):
+        """ Removes rows from the store. Give children before their parents
+            (removing a row would take its children's iters with it) """
+        for key in keys:
+            del self.rows[key]
+            self.store.remove(self.iters.pop(key))
+
+    def update(self, group, rows):
+        """ Shows rows (a list of PartitionRow in tree order, parents before
+            their children) as the rows of group. Returns what changed """
+        old_keys = self.groups.get(group, [])
+        old_rows = collections.OrderedDict((key, self.rows[key]) for key in old_keys)
+        new_rows = collections.OrderedDict((row.key, row) for row in rows)
+        if group not in self.original:
+            self.original[group] = new_rows
+        changes = diff(old_rows, new_rows)
+
+        # The children of a removed row go with it
+        removed = set(changes.removed)
+        for key in old_keys:
+            if old_rows[key].parent in removed:
+                removed.add(key)
+        kept = [key for key in old_keys if key not in removed]
+        if kept != [key for key in new_rows if key in old_rows and key not in removed]:
+            # The rows we keep changed order (they shouldn't), start again
+            removed = set(old_keys)
+        self._remove([key for key in reversed(old_keys) if key in removed])
+
+        anchor = self._anchor(group)
+        last_child = {}
+        for key, row in new_rows.items():
+            if key in self.rows:
+                tree_iter = self.iters[key]
+                shown = self.store[tree_iter]
+                for column, value in enumerate(row.values):
+                    if shown[column] != value:
+                        self.store.set_value(tree_iter, column, value)
+            else:
+                parent_iter = self.iters[row.parent] if row.parent is not None else None
+                sibling = last_child.get(row.parent)
+                if sibling is None and row.parent is None:
+                    sibling = anchor
+                if sibling is None:
+                    tree_iter = self.store.prepend(parent_iter, row.values)
+                else:
+                    tree_iter = self.store.insert_after(parent_iter, sibling, row.values)
+                self.iters[key] = tree_iter
+            self.rows[key] = row
+            last_child[row.parent] = self.iters[key]
+        self.groups[group] = list(new_rows)
+
+        logging.debug(_("Partition list {0}: {1} rows added, {2} removed, {3} changed").format(
+            group, len(changes.added), len(changes.removed), len(changes.changed)))
+        return changes
+
+    def remove_group(self, group):
+        keys = self.groups.pop(group, [])
+        self._remove([key for key in reversed(keys) if key in self.rows])
+
+    def changes(self):
+        """ Differences between the rows we started with and the current
+            ones, over all groups """
+        old_rows = collections.OrderedDict()
+        for group, rows in self.original.items():
+            old_rows.update(rows)
+        new_rows = collections.OrderedDict((row.key, row) for row in self.all_rows())
+        return old_rows, new_rows, diff(old_rows, new_rows)
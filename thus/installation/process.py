@@ -34,21 +34,31 @@ import multiprocessing
 import os
 import collections
 import platform
-import queue
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import yaml
 
 import parted3.fs_module as fs
 import misc.misc as misc
+import misc.block_devices as block_devices
 import encfs
+from installation import accounts
 from installation import auto_partition
 from installation import chroot
 from installation import mkinitcpio
 from installation import fstab
+from installation import image_install
+from installation import keyring
+from installation import locales
+from installation import page_cache
+from installation import copy_journal
+from installation import file_copy
+from installation import scheduler
+from installation import squashfs
 
 from configobj import ConfigObj
 
@@ -87,6 +97,74 @@ def write_file(filecontents, filename):
     with open(filename, "w") as fh:
         fh.write(filecontents)
 
+
+class CopyProgress(object):
+    """ Byte based progress of the copy phase. Big and small files get their
+        real weight, and the transfer rate and ETA are published as a
+        'copy-progress' event (a dict) along with the usual 'percent' one """
+
+    # Seconds between two progress events
+    INTERVAL = 0.5
+
+    def __init__(self, installer, total_bytes):
+        self.installer = installer
+        self.total_bytes = total_bytes
+        self.bytes_done = 0
+        self.start_time = time.time()
+        self.last_update = 0
+        self.lock = threading.Lock()
+        # Highest memory use (MemTotal - MemAvailable) and dirty + writeback
+        # pages seen while copying
+        self.peak_used = 0
+        self.peak_dirty = 0
+
+    def sample_memory(self):
+        try:
+            meminfo = misc.get_meminfo()
+        except (OSError, ValueError):
+            return
+        used = meminfo.get('MemTotal', 0) - meminfo.get('MemAvailable', 0)
+        dirty = meminfo.get('Dirty', 0) + meminfo.get('Writeback', 0)
+        self.peak_used = max(self.peak_used, used)
+        self.peak_dirty = max(self.peak_dirty, dirty)
+
+    def update(self, bytes_done, force=False):
+        """ Called by the copy threads (maybe from several workers at once) """
+        self.bytes_done = bytes_done
+        now = time.time()
+        if not force and now - self.last_update < CopyProgress.INTERVAL:
+            return
+        if not self.lock.acquire(blocking=force):
+            # Another worker is already publishing
+            return
+        try:
+            self.last_update = now
+            self.sample_memory()
+            elapsed = now - self.start_time
+            rate = bytes_done / elapsed if elapsed > 0 else 0
+            if rate > 0:
+                eta = max(0, self.total_bytes - bytes_done) / rate
+            else:
+                eta = None
+            self.installer.queue_event('percent', min(1.0, bytes_done / self.total_bytes))
+            self.installer.queue_event('copy-progress', {
+                'bytes_done': bytes_done,
+                'bytes_total': self.total_bytes,
+                'rate': rate / (1024 * 1024),
+                'eta': eta})
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        """ Publishes the final state and logs the average throughput """
+        self.update(self.bytes_done, force=True)
+        elapsed = time.time() - self.start_time
+        rate = self.bytes_done / elapsed / (1024 * 1024) if elapsed > 0 else 0
+        logging.info(_("Copied {0} bytes in {1:.1f} seconds ({2:.1f} MB/s)").format(
+            self.bytes_done, elapsed, rate))
+        logging.info(_("Peak memory use while copying: {0}, peak dirty pages: {1}").format(
+            misc.format_size(self.peak_used), misc.format_size(self.peak_dirty)))
+
 # BEGIN: RSYNC-based file copy support
 # CMD = 'unsquashfs -f -i -da 32 -fr 32 -d %(dest)s %(source)s'
 CMD = 'rsync -ar --progress %(source)s %(dest)s'
@@ -98,7 +176,7 @@ ON_POSIX = 'posix' in sys.builtin_module_names
 
 class FileCopyThread(Thread):
     """ Update the value of the progress bar so that we get some movement """
-    def __init__(self, installer, current_file, total_files, source, dest, offset=0):
+    def __init__(self, installer, current_file, total_files, source, dest, offset=0, progress=None):
         # Environment used for executing rsync properly
         # Setting locale to C (fix issue with tr_TR locale)
         self.at_env = os.environ
@@ -121,6 +199,10 @@ class FileCopyThread(Thread):
         # we need to set the offset because the total number of files is
         # calculated before.
         self.offset = offset
+        # byte based progress (None if we don't know how many bytes to copy)
+        self.progress = progress
+        if progress is not None:
+            self.bytes_offset = progress.bytes_done
         super(FileCopyThread, self).__init__()
 
     def kill(self):
@@ -135,9 +217,22 @@ class FileCopyThread(Thread):
         self.installer.queue_event('percent', progress)
         #self.installer.queue_event('progress-info', PERCENTAGE_FORMAT % (num_files, self.total_files, (progress*100)))
 
+    def read_lines(self):
+        """ Yields rsync output split on newlines and carriage returns
+            (rsync uses the latter to update the progress of big files) """
+        pending = b''
+        for chunk in iter(lambda: self.process.stdout.read1(4096), b''):
+            lines = re.split(b'[\r\n]', pending + chunk)
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+
     def run(self):
         num_files_copied = 0
-        for line in iter(self.process.stdout.readline, b''):
+        bytes_copied = 0
+        for line in self.read_lines():
             # small comment on this regexp.
             # rsync outputs three parameters in the progress.
             # xfer#x => i try to interpret it as 'file copy try no. x'
@@ -150,14 +245,24 @@ class FileCopyThread(Thread):
             # In case of Manjaro, we pre-compute the total number of files.
             # Therefore we can easily subtract x from y in order to get real
             # files copied / processed count.
-            m = re.findall(r'xfr#(\d+), ir-chk=(\d+)/(\d+)', line.decode())
+            line = line.decode(errors='replace')
+            m = re.findall(r'xfr#(\d+), ir-chk=(\d+)/(\d+)', line)
+            # Bytes of the current file copied so far (the whole file once
+            # xfr# shows up)
+            b = re.findall(r'^\s*([\d,]+)\s+\d+%', line)
+            if b and self.progress is not None:
+                current_bytes = int(b[0].replace(',', ''))
+                if m:
+                    bytes_copied += current_bytes
+                    current_bytes = 0
+                self.progress.update(self.bytes_offset + bytes_copied + current_bytes)
             if m:
                 # we've got a percentage update
                 num_files_remaining = int(m[0][1])
                 num_files_total_local = int(m[0][2])
                 # adjusting the offset so that progressbar can be continuesly drawn
                 num_files_copied = num_files_total_local - num_files_remaining + self.offset
-                if num_files_copied % 100 == 0:
+                if num_files_copied % 100 == 0 and self.progress is None:
                     self.update_progress(num_files_copied)
             # Disabled until we find a proper solution for BadDrawable
             # (invalid Pixmap or Window parameter) errors
@@ -172,6 +277,104 @@ class FileCopyThread(Thread):
 
 # END: RSYNC-based file copy support
 
+# BEGIN: squashfs-based file copy support
+
+
+class SquashfsCopyThread(Thread):
+    """ Extracts the live squashfs images straight into the target, without
+        mounting them. The images are merged into a single copy plan (the
+        last one wins) and their blocks are decompressed by a pool of workers
+        (one per CPU) """
+    def __init__(self, installer, total_files, images, dest, progress=None):
+        self.installer = installer
+        self.total_files = total_files
+        self.images = images
+        self.progress = progress
+        self.error = None
+        # Lets a retry skip the files this attempt manages to copy
+        self.journal = copy_journal.CopyJournal(dest)
+        # Keeps the copied data from pushing the live session out of RAM
+        write_behind_mb = int(configuration['install'].get('COPY_WRITE_BEHIND_MB', 0))
+        if write_behind_mb > 0:
+            self.write_behind = page_cache.WriteBehind(write_behind_mb * 1024 * 1024)
+        else:
+            self.write_behind = None
+        self.extractor = squashfs.Extractor(dest, callback=self.update_progress,
+                                            journal=self.journal,
+                                            write_behind=self.write_behind)
+        super(SquashfsCopyThread, self).__init__()
+
+    def kill(self):
+        self.extractor.stop()
+
+    def copy(self, plan):
+        """ Runs the copy, keeping the journal only if it doesn't complete """
+        completed = False
+        try:
+            completed = self.extractor.run(plan)
+        finally:
+            if self.write_behind is not None:
+                self.write_behind.close()
+            if completed:
+                self.journal.remove()
+            else:
+                self.journal.close()
+
+    def update_progress(self, num_files, num_bytes):
+        if self.progress is not None:
+            self.progress.update(num_bytes)
+        elif num_files % 100 == 0:
+            progress = (float(num_files) / float(self.total_files))
+            self.installer.queue_event('percent', progress)
+
+    def run(self):
+        images = []
+        try:
+            for path in self.images:
+                images.append(squashfs.SquashfsImage(path))
+            plan = squashfs.CopyPlan(images)
+            logging.debug(_("Copy plan: {0} files ({1} bytes)").format(len(plan), plan.bytes))
+            logging.debug(_("Merging images saved writing {0} files ({1} bytes) twice").format(
+                plan.saved_files, plan.saved_bytes))
+            self.total_files = len(plan)
+            if self.progress is not None:
+                self.progress.total_bytes = plan.bytes
+            self.copy(plan.layout_order())
+        except (OSError, squashfs.SquashfsError) as err:
+            self.error = err
+        finally:
+            for image in images:
+                image.close()
+
+# END: squashfs-based file copy support
+
+# BEGIN: kernel-assisted file copy support
+
+
+class TreeCopyThread(SquashfsCopyThread):
+    """ Copies the mounted live images to the target. The mount points are
+        merged into a single copy plan (the last one wins), file data is
+        moved by the kernel (reflink, copy_file_range or sendfile) and small
+        files are copied by a pool of workers, one directory at a time """
+    def __init__(self, installer, total_files, sources, dest, progress=None):
+        super(TreeCopyThread, self).__init__(installer, total_files, sources, dest, progress)
+        self.extractor = file_copy.TreeCopier(dest, callback=self.update_progress,
+                                              journal=self.journal,
+                                              write_behind=self.write_behind)
+
+    def run(self):
+        try:
+            plan = file_copy.DirectoryPlan(self.images)
+            logging.debug(_("Copy plan: {0} files ({1} bytes)").format(len(plan), plan.bytes))
+            self.total_files = len(plan)
+            if self.progress is not None:
+                self.progress.total_bytes = plan.bytes
+            self.copy(plan.layout_order())
+        except OSError as err:
+            self.error = err
+
+# END: kernel-assisted file copy support
+
 
 class InstallError(Exception):
     """ Exception class called upon an installer error """
@@ -234,6 +437,11 @@ class InstallationProcess(multiprocessing.Process):
         self.media = configuration['install']['LIVE_MEDIA_SOURCE']
         self.media_desktop = configuration['install']['LIVE_MEDIA_DESKTOP']
         self.media_type = configuration['install']['LIVE_MEDIA_TYPE']
+        # 'squashfs' extracts the images directly, 'kernel' and 'rsync' copy them
+        # from their mount points
+        self.copy_engine = configuration['install'].get('COPY_ENGINE', 'rsync')
+        if self.media_type != 'squashfs' and self.copy_engine == 'squashfs':
+            self.copy_engine = 'rsync'
 
     def queue_fatal_event(self, txt):
         """ Queues the fatal event and exits process """
@@ -246,10 +454,7 @@ class InstallationProcess(multiprocessing.Process):
 
     def queue_event(self, event_type, event_text=""):
         if self.callback_queue is not None:
-            try:
-                self.callback_queue.put_nowait((event_type, event_text))
-            except queue.Full:
-                pass
+            self.callback_queue.put(event_type, event_text)
         else:
             print("{0}: {1}".format(event_type, event_text))
 
@@ -305,7 +510,8 @@ class InstallationProcess(multiprocessing.Process):
             auto_partition.unmount_all(DEST_DIR)
 
         # Create, format and mount partitions in automatic mode
-        if self.method == 'automatic':
+        # (image mode uses the same layout)
+        if self.method in ('automatic', 'image'):
             logging.debug(_("Creating partitions and their filesystems in {0}"
                             .format(self.auto_device)))
 
@@ -368,7 +574,10 @@ class InstallationProcess(multiprocessing.Process):
 
         try:
             self.queue_event('debug', _('Install System ...'))
-            self.install_system()
+            if self.method == 'image':
+                self.install_image()
+            else:
+                self.install_system()
             self.queue_event('debug', _('System installed.'))
             self.queue_event('debug', _('Configuring system ...'))
             self.configure_system()
@@ -474,62 +683,71 @@ class InstallationProcess(multiprocessing.Process):
                 logging.error(txt)
                 self.queue_fatal_event(txt)
 
-            # Mount the installation media
-            mount_point = "/source"
-            device = self.check_source_folder(mount_point)
-            if device is None:
-                subprocess.check_call(["mount",
-                                       self.media,
-                                       mount_point,
-                                       "-t",
-                                       self.media_type,
-                                       "-o",
-                                       "loop"])
-            else:
-                logging.warning(_("{0} is already mounted at {1} as {2}"
-                                  .format(self.media, mount_point, device)))
-
-            mount_point = "/source_desktop"
-            device = self.check_source_folder(mount_point)
-            if device is None:
-                subprocess.check_call(["mount",
-                                       self.media_desktop,
-                                       mount_point,
-                                       "-t",
-                                       self.media_type,
-                                       "-o",
-                                       "loop"])
-            else:
-                logging.warning(_("{0} is already mounted at {1} as {2}"
-                                  .format(self.media_desktop, mount_point, device)))
+            if self.copy_engine != 'squashfs':
+                self.mount_source_images()
 
-            # walk root filesystem
-            source = "/source/"
             directory_times = []
             # index the files
             self.queue_event('info', _("Indexing files of root-image to be copied ..."))
-            p1 = subprocess.Popen(["unsquashfs", "-l", self.media], stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(["wc", "-l"], stdin=p1.stdout, stdout=subprocess.PIPE)
-            output1 = p2.communicate()[0]
+            index1 = self.index_image(self.media)
             self.queue_event('info', _("Indexing files of desktop-image to be copied ..."))
-            p1 = subprocess.Popen(["unsquashfs", "-l", self.media_desktop], stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(["wc", "-l"], stdin=p1.stdout, stdout=subprocess.PIPE)
-            output2 = p2.communicate()[0]
-            our_total = int(float(output1) + float(output2))
-            self.queue_event('info', _("Extracting root-image ..."))
-            our_current = 0
-            t = FileCopyThread(self, our_current, our_total, source, DEST_DIR)
-            t.start()
-            t.join()
-
-            # walk desktop filesystem
-            source = "/source_desktop/"
-            directory_times = []
-            self.queue_event('info', _("Extracting desktop-image ..."))
-            our_current = int(output1)
-            t = FileCopyThread(self, our_current, our_total, source, DEST_DIR, t.offset)
-            t.start()
-            t.join()
+            index2 = self.index_image(self.media_desktop)
+            our_total = index1.files + index2.files
+            if index1.bytes and index2.bytes:
+                progress = CopyProgress(self, index1.bytes + index2.bytes)
+            else:
+                progress = None
+
+            # Stop the prefetcher (see prefetch.py), the copy reads the images now
+            self.settings.set('copy_started', True)
+            prefetch_warm = self.settings.get('prefetch_warm')
+            if prefetch_warm:
+                for image, fraction in prefetch_warm.items():
+                    logging.debug(_("{0:.0%} of {1} was prefetched into RAM").format(fraction, image))
+
+            readahead = self.set_source_readahead()
+
+            if self.copy_engine == 'squashfs':
+                # Both images are extracted in a single pass
+                self.queue_event('info', _("Extracting root-image and desktop-image ..."))
+                t = SquashfsCopyThread(self, our_total, [self.media, self.media_desktop],
+                                       DEST_DIR, progress)
+                t.start()
+                t.join()
+                if t.error is not None:
+                    raise InstallError(t.error)
+                our_total = t.total_files
+            elif self.copy_engine == 'kernel':
+                # Both mount points are copied in a single pass
+                self.queue_event('info', _("Copying root-image and desktop-image ..."))
+                t = TreeCopyThread(self, our_total, ["/source", "/source_desktop"],
+                                   DEST_DIR, progress)
+                t.start()
+                t.join()
+                if t.error is not None:
+                    raise InstallError(t.error)
+                our_total = t.total_files
+            else:
+                # walk root filesystem
+                source = "/source/"
+                self.queue_event('info', _("Extracting root-image ..."))
+                our_current = 0
+                t = FileCopyThread(self, our_current, our_total, source, DEST_DIR, progress=progress)
+                t.start()
+                t.join()
+
+                # walk desktop filesystem
+                source = "/source_desktop/"
+                self.queue_event('info', _("Extracting desktop-image ..."))
+                our_current = index1.files
+                t = FileCopyThread(self, our_current, our_total, source, DEST_DIR, t.offset, progress)
+                t.start()
+                t.join()
+
+            if progress is not None:
+                progress.finish()
+            if readahead is not None:
+                misc.set_readahead(*readahead)
 
             # this is purely out of aesthetic reasons. Because we're reading of
             # the queue once 3 seconds, good chances are we're going to miss
@@ -537,6 +755,7 @@ class InstallationProcess(multiprocessing.Process):
             # the user so he doesn't panick that not all of the files copied.
             self.queue_event('percent', 1.00)
             self.queue_event('progress-info', PERCENTAGE_FORMAT % (our_total, our_total, 100))
+            self.queue_event('text', 'hide')
             for dirtime in directory_times:
                 (directory, atime, mtime) = dirtime
                 try:
@@ -552,6 +771,109 @@ class InstallationProcess(multiprocessing.Process):
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_tb(exc_traceback, limit=1, file=sys.stdout)
 
+    def install_image(self):
+        """ Writes the prebuilt system image to the root partition, grows it
+            and moves what belongs to other partitions (/boot...) to them """
+        image = image_install.image_path()
+        root_device = self.mount_devices['/']
+        fs_type = fs.get_type(image)
+        if fs_type not in image_install.IMAGE_FILESYSTEMS:
+            raise InstallError(_("Unsupported system image {0} ({1})").format(image, fs_type))
+
+        # The partitions were mounted when they were created. Root goes last
+        for path in sorted(self.mount_devices, reverse=True):
+            if path not in ("", "swap"):
+                auto_partition.unmount(DEST_DIR + path)
+
+        self.queue_event('info', _("Writing system image ..."))
+        progress = CopyProgress(self, os.path.getsize(image))
+        try:
+            image_install.write_image(image, root_device, progress.update)
+            progress.finish()
+            self.queue_event('info', _("Resizing system image ..."))
+            image_install.grow_filesystem(root_device, fs_type)
+            block_devices.invalidate(root_device)
+        except (OSError, image_install.ImageError) as err:
+            raise InstallError(err)
+        image_install.new_uuid(root_device, fs_type)
+        # fstab and the bootloader read the new uuid from the inventory
+        block_devices.invalidate(root_device)
+
+        self.fs_devices[root_device] = fs_type
+        if fs_type == 'btrfs':
+            self.settings.set('btrfs', True)
+
+        subprocess.check_call(['mount', root_device, DEST_DIR])
+        for path in sorted(self.mount_devices):
+            if path in ("", "swap", "/"):
+                continue
+            logging.debug(_("Moving {0} to {1}").format(path, self.mount_devices[path]))
+            image_install.move_to_partition(DEST_DIR, path, self.mount_devices[path])
+
+        self.queue_event('percent', 1.00)
+        self.queue_event('text', 'hide')
+
+    @staticmethod
+    def index_image(image):
+        """ Gets the number of files and bytes to be copied from an image """
+        try:
+            index = squashfs.index_image(image)
+        except squashfs.SquashfsError as err:
+            # Not something we can read, let unsquashfs count its files
+            logging.warning(err)
+            p1 = subprocess.Popen(["unsquashfs", "-l", image], stdout=subprocess.PIPE)
+            p2 = subprocess.Popen(["wc", "-l"], stdin=p1.stdout, stdout=subprocess.PIPE)
+            output = p2.communicate()[0]
+            index = squashfs.ImageIndex(int(output), 0)
+        logging.debug(_("{0} has {1} files ({2} bytes)").format(image, index.files, index.bytes))
+        return index
+
+    def set_source_readahead(self):
+        """ Sets the readahead of the live medium as configured for its kind
+            (USB, CD...). Returns what set_readahead needs to restore it """
+        medium, disk = misc.get_source_medium(self.media)
+        size_kb = configuration.get('readahead', {}).get(medium, '0')
+        logging.debug(_("Live images are on {0} ({1})").format(disk, medium))
+        if disk is None or int(size_kb) <= 0:
+            return None
+        old_size_kb = misc.set_readahead(disk, int(size_kb))
+        if old_size_kb is None:
+            return None
+        logging.debug(_("Readahead of {0} set to {1} KiB (was {2} KiB)").format(
+            disk, size_kb, old_size_kb))
+        return disk, old_size_kb
+
+    def mount_source_images(self):
+        """ Loop-mounts the live images in /source and /source_desktop """
+        # Mount the installation media
+        mount_point = "/source"
+        device = self.check_source_folder(mount_point)
+        if device is None:
+            subprocess.check_call(["mount",
+                                   self.media,
+                                   mount_point,
+                                   "-t",
+                                   self.media_type,
+                                   "-o",
+                                   "loop"])
+        else:
+            logging.warning(_("{0} is already mounted at {1} as {2}"
+                              .format(self.media, mount_point, device)))
+
+        mount_point = "/source_desktop"
+        device = self.check_source_folder(mount_point)
+        if device is None:
+            subprocess.check_call(["mount",
+                                   self.media_desktop,
+                                   mount_point,
+                                   "-t",
+                                   self.media_type,
+                                   "-o",
+                                   "loop"])
+        else:
+            logging.warning(_("{0} is already mounted at {1} as {2}"
+                              .format(self.media_desktop, mount_point, device)))
+
     def is_running(self):
         """ Checks if thread is running """
         return self.running
@@ -857,17 +1179,72 @@ class InstallationProcess(multiprocessing.Process):
             Run mkinitcpio
             Populate pacman keyring
             Setup systemd services
-            ... and more """
+            ... and more
+
+            Steps are declared as tasks with the steps they need done first,
+            and those that don't depend on each other run at the same time """
 
         # First and last thing we do here mounting/unmouting special dirs.
         chroot.mount_special_dirs(DEST_DIR)
-        
+        chroot.start_executor(DEST_DIR)
+
         self.queue_event('pulse', 'start')
         self.queue_event('action', _("Configuring your new system"))
 
+        workers = int(configuration['install'].get('CONFIGURE_WORKERS', 4))
+        tasks = scheduler.TaskScheduler(_("Configure system"), workers)
+
+        tasks.add('fstab', self.setup_fstab)
+        tasks.add('network', self.setup_network)
+        tasks.add('timezone', self.setup_timezone)
+        # Drivers are installed with pacman, which needs the keyring as it
+        # was copied and may add system users
+        tasks.add('drivers', self.install_drivers)
+        tasks.add('users', self.setup_users, after=['drivers'])
+        tasks.add('locale', self.setup_locale)
+        tasks.add('keyboard', self.setup_keyboard)
+        tasks.add('hwclock', self.setup_hwclock)
+        tasks.add('alsa', self.setup_alsa)
+        tasks.add('display_manager', self.setup_display_manager)
+        # /etc/skel is copied when the user is created, before this
+        tasks.add('environment', self.setup_environment, after=['users'])
+        tasks.add('live_packages', self.remove_live_packages, after=['drivers', 'users'])
+        tasks.add('machine_id', self.setup_machine_id)
+        tasks.add('pacman', self.setup_pacman, after=['drivers'])
+        # The initramfs includes the keymap, fsck helpers for the filesystems
+        # in fstab and whatever the drivers need
+        tasks.add('mkinitcpio', self.run_mkinitcpio,
+                  after=['fstab', 'keyboard', 'drivers', 'live_packages'])
+        # In openbox "desktop", the post-install script writes /etc/slim.conf
+        # so we always have to call set_autologin AFTER the post-install script.
+        if self.settings.get('require_password') is False:
+            tasks.add('autologin', self.set_autologin, after=['users', 'display_manager'])
+        if self.settings.get('encrypt_home'):
+            tasks.add('encrypt_home', self.encrypt_user_home, after=['users'])
+        # Install boot loader (always after running mkinitcpio)
+        if self.settings.get('bootloader_install'):
+            tasks.add('bootloader', self.install_bootloader, after=['mkinitcpio', 'locale'])
+
+        try:
+            if not tasks.run():
+                return False
+        finally:
+            chroot.stop_executor(DEST_DIR)
+
+        self.queue_event('pulse', 'stop')
+        chroot.umount_special_dirs(DEST_DIR)
+
+    def wait_for_page(self, key):
+        """ Waits until the user is done with a page (key is its setting) """
+        start = time.time()
+        self.settings.wait_for(key)
+        logging.debug(_("Waited {0:.1f} seconds for {1}").format(time.time() - start, key))
+
+    def setup_fstab(self):
         self.auto_fstab()
         self.queue_event('debug', _('fstab file generated.'))
 
+    def setup_network(self):
         # Copy configured networks in Live medium to target system
         if self.network_manager == 'NetworkManager':
             self.copy_network_config()
@@ -886,24 +1263,22 @@ class InstallationProcess(multiprocessing.Process):
 
         # self.queue_event('debug', 'Enabled installed services.')
 
+    def setup_timezone(self):
         # Wait FOREVER until the user sets the timezone
-        while self.settings.get('timezone_done') is False:
-            # wait five seconds and try again
-            time.sleep(5)
+        self.wait_for_page('timezone_done')
 
         if self.settings.get("use_ntp"):
             self.enable_services(["ntpd"])
 
         # Set timezone
         zoneinfo_path = os.path.join("/usr/share/zoneinfo", self.settings.get("timezone_zone"))
-        chroot_run(['ln', '-s', zoneinfo_path, "/etc/localtime"])
+        chroot.symlink(zoneinfo_path, "/etc/localtime", DEST_DIR)
 
         self.queue_event('debug', _('Time zone set.'))
 
+    def setup_users(self):
         # Wait FOREVER until the user sets his params
-        while self.settings.get('user_info_done') is False:
-            # wait five seconds and try again
-            time.sleep(5)
+        self.wait_for_page('user_info_done')
 
         # Set user parameters
         username = self.settings.get('username')
@@ -921,13 +1296,42 @@ class InstallationProcess(multiprocessing.Process):
 
         self.queue_event('debug', _('Sudo configuration for user {0} done.'.format(username)))
 
-        default_groups = 'lp,video,network,storage,wheel,audio'
+        default_groups = ['lp', 'video', 'network', 'storage', 'wheel', 'audio']
 
+        try:
+            with accounts.Accounts(DEST_DIR) as database:
+                if self.settings.get('require_password') is False:
+                    database.add_group('autologin')
+                    default_groups.append('autologin')
+                database.add_user(username, fullname, 'users', default_groups)
+                database.create_home(username)
+                # Both passwords go in the same write of /etc/shadow
+                database.set_password(username, password)
+                database.set_password('root', root_password or password)
+        except (OSError, accounts.AccountsError) as error:
+            logging.warning(_("Can't create user {0} directly ({1}), using useradd").format(
+                username, error))
+            self.add_user_with_tools(username, fullname, password, root_password,
+                                     ','.join(default_groups))
+        else:
+            self.queue_event('debug', _('User {0} added.'.format(username)))
+            if root_password:
+                self.queue_event('debug', _('Set root password.'))
+            else:
+                self.queue_event('debug', _('Set the same password to root.'))
+
+        hostname_path = os.path.join(DEST_DIR, "etc/hostname")
+        with open(hostname_path, "w") as hostname_file:
+            hostname_file.write(hostname)
+
+        self.queue_event('debug', _('Hostname  {0} set.'.format(hostname)))
+
+    def add_user_with_tools(self, username, fullname, password, root_password, groups):
+        """ Creates the user running useradd and friends in the chroot """
         if self.settings.get('require_password') is False:
             chroot_run(['groupadd', 'autologin'])
-            default_groups += ',autologin'
 
-        chroot_run(['useradd', '-m', '-s', '/bin/bash', '-g', 'users', '-G', default_groups, username])
+        chroot_run(['useradd', '-m', '-s', '/bin/bash', '-g', 'users', '-G', groups, username])
 
         self.queue_event('debug', _('User {0} added.'.format(username)))
 
@@ -935,13 +1339,7 @@ class InstallationProcess(multiprocessing.Process):
 
         chroot_run(['chfn', '-f', fullname, username])
 
-        chroot_run(['chown', '-R', '{0}:users'.format(username), "/home/{0}".format(username)])
-
-        hostname_path = os.path.join(DEST_DIR, "etc/hostname")
-        with open(hostname_path, "w") as hostname_file:
-            hostname_file.write(hostname)
-
-        self.queue_event('debug', _('Hostname  {0} set.'.format(hostname)))
+        chroot.chown("/home/{0}".format(username), username, 'users', DEST_DIR, recursive=True)
 
         # Set root password
         if root_password is not '':
@@ -951,17 +1349,23 @@ class InstallationProcess(multiprocessing.Process):
             self.change_user_password('root', password)
             self.queue_event('debug', _('Set the same password to root.'))
 
+    def setup_locale(self):
         # Generate locales
         locale = self.settings.get("locale")
 
         self.queue_event('info', _("Generating locales ..."))
         self.uncomment_locale_gen(locale)
-        chroot_run(['locale-gen'])
+        try:
+            locales.LocaleStage(DEST_DIR).run()
+        except OSError as os_error:
+            logging.warning(_("Locale stage failed ({0}), running locale-gen").format(os_error))
+            chroot_run(['locale-gen'])
 
         locale_conf_path = os.path.join(DEST_DIR, "etc/locale.conf")
         with open(locale_conf_path, "w") as locale_conf:
             locale_conf.write('LANG={0}\n'.format(locale))
 
+    def setup_keyboard(self):
         keyboard_layout = self.settings.get("keyboard_layout")
         keyboard_variant = self.settings.get("keyboard_variant")
         # Set /etc/vconsole.conf
@@ -998,12 +1402,14 @@ class InstallationProcess(multiprocessing.Process):
                                xkbvariant,
                                "terminate:ctrl_alt_bksp,grp:alt_shift_toggle"))
 
+    def setup_hwclock(self):
         self.queue_event('info', _("Adjusting hardware clock ..."))
         self.auto_timesetting()
 
         # Install configs for root
         # chroot_run(['cp', '-av', '/etc/skel/.', '/root/'])
 
+    def setup_alsa(self):
         self.queue_event('info', _("Configuring hardware ..."))
 
         # Configure ALSA
@@ -1014,6 +1420,7 @@ class InstallationProcess(multiprocessing.Process):
         if os.path.exists(os.path.join(DEST_DIR, "usr/bin/pulseaudio-ctl")):
             chroot_run(['pulseaudio-ctl', 'set', '75%'])'''
 
+    def install_drivers(self):
         # Install xf86-video driver
         if os.path.exists("/opt/livecd/pacman-gfx.conf"):
             self.queue_event('info', _("Installing drivers ..."))
@@ -1027,6 +1434,7 @@ class InstallationProcess(multiprocessing.Process):
                 self.queue_fatal_event(txt)
                 return False
 
+    def setup_display_manager(self):
         self.queue_event('info', _("Configure display manager ..."))
         # Setup slim
         if os.path.exists("/usr/bin/slim"):
@@ -1075,6 +1483,7 @@ class InstallationProcess(multiprocessing.Process):
         if os.path.exists("{0}/usr/bin/kdm".format(DEST_DIR)):
             self.desktop_manager = 'kdm'
 
+    def setup_environment(self):
         self.queue_event('info', _("Configure System ..."))
 
         # Add BROWSER var
@@ -1091,6 +1500,7 @@ class InstallationProcess(multiprocessing.Process):
                 os.path.exists("{0}/usr/lib32/libudev.so.0".format(DEST_DIR))):
             os.system("echo -e \"STEAM_RUNTIME=0\nSTEAM_FRAME_FORCE_CLOSE=1\" >> {0}/etc/environment".format(DEST_DIR))
 
+    def remove_live_packages(self):
         # Remove thus
         if os.path.exists("{0}/usr/bin/thus".format(DEST_DIR)):
             self.queue_event('info', _("Removing live configuration (packages)"))
@@ -1103,10 +1513,13 @@ class InstallationProcess(multiprocessing.Process):
         if num_res == "0":
             chroot_run(['sh', '-c', 'pacman -Rsc --noconfirm $(pacman -Qq | grep virtualbox-guest-modules)'])
 
+    @staticmethod
+    def setup_machine_id():
         # Set unique machine-id
         chroot_run(['dbus-uuidgen', '--ensure=/etc/machine-id'])
         chroot_run(['dbus-uuidgen', '--ensure=/var/lib/dbus/machine-id'])
 
+    def setup_pacman(self):
         # Setup pacman
         self.queue_event("action", _("Configuring package manager"))
 
@@ -1115,12 +1528,11 @@ class InstallationProcess(multiprocessing.Process):
                      os.path.join(DEST_DIR, 'etc/pacman.d/mirrorlist'))
 
         # Copy random generated keys by pacman-init to target
-        if os.path.exists("{0}/etc/pacman.d/gnupg".format(DEST_DIR)):
-            os.system("rm -rf {0}/etc/pacman.d/gnupg".format(DEST_DIR))
-        os.system("cp -a /etc/pacman.d/gnupg {0}/etc/pacman.d/".format(DEST_DIR))
-        chroot_run(['pacman-key', '--populate', 'archlinux', 'manjaro'])
+        # (populated again only if the keyring packages differ)
+        keyring.setup(DEST_DIR)
         self.queue_event('info', _("Finished configuring package manager."))
 
+    def run_mkinitcpio(self):
         # Let's start without using hwdetect for mkinitcpio.conf.
         # I think it should work out of the box most of the time.
         # This way we don't have to fix deprecated hooks.
@@ -1129,32 +1541,22 @@ class InstallationProcess(multiprocessing.Process):
         mkinitcpio.run(DEST_DIR, self.settings, self.mount_devices, self.blvm)
         self.queue_event('info', _("Running mkinitcpio - done"))
 
-        # Set autologin if selected
-        # In openbox "desktop", the post-install script writes /etc/slim.conf
-        # so we always have to call set_autologin AFTER the post-install script.
-        if self.settings.get('require_password') is False:
-            self.set_autologin()
-
+    def encrypt_user_home(self):
         # Encrypt user's home directory if requested
         # FIXME: This is not working atm
-        if self.settings.get('encrypt_home'):
-            logging.debug(_("Encrypting user home dir..."))
-            encfs.setup(username, DEST_DIR)
-            logging.debug(_("User home dir encrypted"))
+        logging.debug(_("Encrypting user home dir..."))
+        encfs.setup(self.settings.get('username'), DEST_DIR)
+        logging.debug(_("User home dir encrypted"))
 
-        # Install boot loader (always after running mkinitcpio)
-        if self.settings.get('bootloader_install'):
-            try:
-                self.queue_event('info', _("Installing bootloader..."))
-                from installation import bootloader
-
-                boot_loader = bootloader.Bootloader(DEST_DIR,
-                                                    self.settings,
-                                                    self.mount_devices)
-                boot_loader.install()
-            except Exception as error:
-                logging.error(_("Couldn't install boot loader: {0}"
-                                .format(error)))
-      
-        self.queue_event('pulse', 'stop')        
-        chroot.umount_special_dirs(DEST_DIR)
+    def install_bootloader(self):
+        try:
+            self.queue_event('info', _("Installing bootloader..."))
+            from installation import bootloader
+
+            boot_loader = bootloader.Bootloader(DEST_DIR,
+                                                self.settings,
+                                                self.mount_devices)
+            boot_loader.install()
+        except Exception as error:
+            logging.error(_("Couldn't install boot loader: {0}"
+                            .format(error)))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  scheduler.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Runs the steps of an installation stage as a graph of tasks: each task
+    starts as soon as the tasks it depends on are done, on a bounded pool """
+
+import collections
+import concurrent.futures
+import logging
+import time
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+
+Task = collections.namedtuple('Task', 'name function after')
+
+
+class TaskScheduler(object):
+    """ Tasks are added with the names of the tasks they must run after, and
+        those must have been added before (so there can't be cycles). Tasks
+        that are ready are started in the order they were added.
+
+        A task that returns False or raises stops the stage: no new task is
+        started, the running ones are waited for and run() returns False (or
+        raises the same exception). The time each task took is logged and
+        kept in timings """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = max(1, workers)
+        self.tasks = collections.OrderedDict()
+        self.timings = collections.OrderedDict()
+
+    def add(self, name, function, after=()):
+        """ Adds a task that calls function() """
+        if name in self.tasks:
+            raise ValueError(_("Task {0} was already added").format(name))
+        for dependency in after:
+            if dependency not in self.tasks:
+                raise ValueError(_("Task {0} depends on {1}, which hasn't been added").format(
+                    name, dependency))
+        self.tasks[name] = Task(name, function, tuple(after))
+
+    def _timed(self, task):
+        start = time.monotonic()
+        try:
+            return task.function()
+        finally:
+            self.timings[task.name] = time.monotonic() - start
+            logging.debug(_("{0}: task '{1}' took {2:.2f} seconds").format(
+                self.name, task.name, self.timings[task.name]))
+
+    def run(self):
+        """ Runs all tasks. Returns False if one of them failed """
+        start = time.monotonic()
+        pending = collections.OrderedDict(self.tasks)
+        done = set()
+        running = {}
+        failed = False
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                if not failed:
+                    for task in list(pending.values()):
+                        if len(running) >= self.workers:
+                            break
+                        if all(dependency in done for dependency in task.after):
+                            del pending[task.name]
+                            running[executor.submit(self._timed, task)] = task
+                if not running:
+                    break
+                finished, not_done = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as task_error:
+                        logging.error(_("{0}: task '{1}' failed: {2}").format(
+                            self.name, task.name, task_error))
+                        if error is None:
+                            error = task_error
+                        failed = True
+                        continue
+                    if result is False:
+                        logging.error(_("{0}: task '{1}' failed").format(self.name, task.name))
+                        failed = True
+                    else:
+                        done.add(task.name)
+
+        if pending:
+            logging.warning(_("{0}: tasks not run: {1}").format(self.name, ", ".join(pending)))
+        elapsed = time.monotonic() - start
+        logging.debug(_("{0}: {1} tasks took {2:.2f} seconds ({3:.2f} seconds one after another)")
+                      .format(self.name, len(self.timings), elapsed, sum(self.timings.values())))
+        if error is not None:
+            raise error
+        return not failed
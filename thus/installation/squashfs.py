@@ -0,0 +1,795 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  squashfs.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Squashfs (v4) image reader and parallel extractor.
+    Used to copy the live media images to the target without mounting them """
+
+import collections
+import concurrent.futures
+import json
+import logging
+import lzma
+import os
+import stat
+import struct
+import threading
+import zlib
+
+from installation import page_cache
+
+# Optional decompressors (gzip, lzma and xz are always available)
+try:
+    import lzo
+except ImportError:
+    lzo = None
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+SQUASHFS_MAGIC = 0x73717368
+SUPERBLOCK_FORMAT = '<IIIIIHHHHHHQQQQQQQQ'
+SUPERBLOCK_SIZE = struct.calcsize(SUPERBLOCK_FORMAT)
+
+METADATA_SIZE = 8192
+METADATA_UNCOMPRESSED = 1 << 15
+BLOCK_UNCOMPRESSED = 1 << 24
+BLOCK_SIZE_MASK = BLOCK_UNCOMPRESSED - 1
+INVALID_FRAGMENT = 0xFFFFFFFF
+
+# Metadata blocks kept in memory by SquashfsImage (8 KiB each)
+METADATA_CACHE_SIZE = 4096
+# Decompressed fragment blocks kept in memory by SquashfsImage
+FRAGMENT_CACHE_SIZE = 32
+# Files bigger than this number of blocks are split between workers
+CHUNK_BLOCKS = 32
+
+# index_image results, so a retried install doesn't have to index again
+INDEX_CACHE = '/var/cache/thus/squashfs-index.json'
+
+COMPRESSORS = {1: 'gzip', 2: 'lzma', 3: 'lzo', 4: 'xz', 5: 'lz4', 6: 'zstd'}
+
+# Inode types (basic and extended)
+DIR_TYPE = 1
+FILE_TYPE = 2
+SYMLINK_TYPE = 3
+BLKDEV_TYPE = 4
+CHRDEV_TYPE = 5
+FIFO_TYPE = 6
+SOCKET_TYPE = 7
+LDIR_TYPE = 8
+LFILE_TYPE = 9
+LSYMLINK_TYPE = 10
+LBLKDEV_TYPE = 11
+LCHRDEV_TYPE = 12
+LFIFO_TYPE = 13
+LSOCKET_TYPE = 14
+
+Superblock = collections.namedtuple('Superblock', [
+    'magic', 'inode_count', 'modification_time', 'block_size',
+    'fragment_entry_count', 'compression_id', 'block_log', 'flags',
+    'id_count', 'version_major', 'version_minor', 'root_inode_ref',
+    'bytes_used', 'id_table_start', 'xattr_id_table_start',
+    'inode_table_start', 'directory_table_start', 'fragment_table_start',
+    'export_table_start'])
+
+ImageIndex = collections.namedtuple('ImageIndex', ['files', 'bytes'])
+
+Inode = collections.namedtuple('Inode', [
+    'number', 'mode', 'uid', 'gid', 'mtime', 'nlink', 'size',
+    'blocks_start', 'block_sizes', 'fragment', 'fragment_offset',
+    'dir_block', 'dir_offset', 'target', 'rdev'])
+
+
+class SquashfsError(Exception):
+    """ Exception raised when an image can't be read """
+    pass
+
+
+class _MetadataReader(object):
+    """ Sequential reader over a metadata table (inodes, directories...) """
+
+    def __init__(self, image, table_start, block, offset):
+        self.image = image
+        self.data, self.next_block = image.read_metadata_block(table_start + block)
+        self.offset = offset
+
+    def read(self, length):
+        """ Reads length bytes, crossing metadata blocks if needed """
+        chunks = []
+        while length > 0:
+            if self.offset >= len(self.data):
+                self.data, self.next_block = self.image.read_metadata_block(self.next_block)
+                self.offset = 0
+            chunk = self.data[self.offset:self.offset + length]
+            self.offset += len(chunk)
+            length -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def unpack(self, fmt):
+        """ Reads and unpacks a little endian structure """
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+
+class SquashfsImage(object):
+    """ Read-only squashfs image. All reads use pread, so one instance can be
+        shared between threads """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            # Files are extracted in the order their data is stored (see
+            # CopyPlan.layout_order), let the kernel read ahead generously
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            self.superblock = self._read_superblock()
+            self.block_size = self.superblock.block_size
+            self.compression = COMPRESSORS.get(self.superblock.compression_id)
+            self._check_compression()
+            self._metadata_cache = {}
+            self._fragment_cache = collections.OrderedDict()
+            self._cache_lock = threading.Lock()
+            self._fragments = None
+            self.ids = [uid for uid, in self._read_lookup_table(
+                self.superblock.id_table_start, self.superblock.id_count, '<I')]
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        """ Closes the image file """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _read_superblock(self):
+        """ Reads and checks the image superblock """
+        data = os.pread(self.fd, SUPERBLOCK_SIZE, 0)
+        if len(data) < SUPERBLOCK_SIZE:
+            raise SquashfsError(_("{0} is too small to be a squashfs image").format(self.path))
+        superblock = Superblock(*struct.unpack(SUPERBLOCK_FORMAT, data))
+        if superblock.magic != SQUASHFS_MAGIC:
+            raise SquashfsError(_("{0} is not a squashfs image").format(self.path))
+        if superblock.version_major != 4:
+            raise SquashfsError(_("Unsupported squashfs version {0}.{1} in {2}").format(
+                superblock.version_major, superblock.version_minor, self.path))
+        return superblock
+
+    def _check_compression(self):
+        """ Checks that we are able to decompress this image """
+        available = {'gzip': True, 'lzma': True, 'xz': True,
+                     'lzo': lzo is not None, 'lz4': lz4_block is not None,
+                     'zstd': zstandard is not None}
+        if not available.get(self.compression, False):
+            raise SquashfsError(_("Can't decompress {0}: unsupported compressor '{1}'").format(
+                self.path, self.compression or self.superblock.compression_id))
+
+    def decompress(self, data, max_size):
+        """ Decompresses a metadata or data block """
+        if self.compression == 'gzip':
+            return zlib.decompress(data)
+        elif self.compression == 'xz':
+            return lzma.decompress(data, format=lzma.FORMAT_XZ)
+        elif self.compression == 'lzma':
+            return lzma.decompress(data, format=lzma.FORMAT_ALONE)
+        elif self.compression == 'lzo':
+            return lzo.decompress(data, False, max_size)
+        elif self.compression == 'lz4':
+            return lz4_block.decompress(data, uncompressed_size=max_size)
+        elif self.compression == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+
+    def read_metadata_block(self, position):
+        """ Returns a decompressed metadata block and the position of the next one """
+        with self._cache_lock:
+            cached = self._metadata_cache.get(position)
+        if cached is not None:
+            return cached
+
+        header, = struct.unpack('<H', os.pread(self.fd, 2, position))
+        size = header & ~METADATA_UNCOMPRESSED
+        data = os.pread(self.fd, size, position + 2)
+        if not header & METADATA_UNCOMPRESSED:
+            data = self.decompress(data, METADATA_SIZE)
+        result = (data, position + 2 + size)
+
+        with self._cache_lock:
+            if len(self._metadata_cache) >= METADATA_CACHE_SIZE:
+                self._metadata_cache.clear()
+            self._metadata_cache[position] = result
+        return result
+
+    def _read_lookup_table(self, start, count, fmt):
+        """ Reads a table indexed by a list of metadata block pointers
+            (id and fragment tables) """
+        entry_size = struct.calcsize(fmt)
+        table_size = count * entry_size
+        num_blocks = (table_size + METADATA_SIZE - 1) // METADATA_SIZE
+        pointers = struct.unpack('<{0}Q'.format(num_blocks),
+                                 os.pread(self.fd, 8 * num_blocks, start))
+        data = b''.join(self.read_metadata_block(pointer)[0] for pointer in pointers)
+        return list(struct.iter_unpack(fmt, data[:table_size]))
+
+    def _parse_inode(self, reader):
+        """ Parses the inode at the current reader position """
+        inode_type, mode, uid_idx, gid_idx, mtime, number = reader.unpack('<HHHHII')
+        nlink = 1
+        size = 0
+        blocks_start = 0
+        block_sizes = ()
+        fragment = INVALID_FRAGMENT
+        fragment_offset = 0
+        dir_block = 0
+        dir_offset = 0
+        target = None
+        rdev = 0
+
+        if inode_type == DIR_TYPE:
+            dir_block, nlink, size, dir_offset, parent = reader.unpack('<IIHHI')
+            mode |= stat.S_IFDIR
+        elif inode_type == LDIR_TYPE:
+            nlink, size, dir_block, parent, index_count, dir_offset, xattr = reader.unpack('<IIIIHHI')
+            for i in range(index_count):
+                index, start, name_size = reader.unpack('<III')
+                reader.read(name_size + 1)
+            mode |= stat.S_IFDIR
+        elif inode_type in (FILE_TYPE, LFILE_TYPE):
+            if inode_type == FILE_TYPE:
+                blocks_start, fragment, fragment_offset, size = reader.unpack('<IIII')
+            else:
+                (blocks_start, size, sparse, nlink, fragment,
+                 fragment_offset, xattr) = reader.unpack('<QQQIIII')
+            if fragment == INVALID_FRAGMENT:
+                num_blocks = (size + self.block_size - 1) // self.block_size
+            else:
+                num_blocks = size // self.block_size
+            block_sizes = reader.unpack('<{0}I'.format(num_blocks))
+            mode |= stat.S_IFREG
+        elif inode_type in (SYMLINK_TYPE, LSYMLINK_TYPE):
+            nlink, target_size = reader.unpack('<II')
+            target = os.fsdecode(reader.read(target_size))
+            if inode_type == LSYMLINK_TYPE:
+                reader.unpack('<I')
+            mode |= stat.S_IFLNK
+        elif inode_type in (BLKDEV_TYPE, CHRDEV_TYPE, LBLKDEV_TYPE, LCHRDEV_TYPE):
+            nlink, rdev = reader.unpack('<II')
+            if inode_type in (LBLKDEV_TYPE, LCHRDEV_TYPE):
+                reader.unpack('<I')
+            if inode_type in (BLKDEV_TYPE, LBLKDEV_TYPE):
+                mode |= stat.S_IFBLK
+            else:
+                mode |= stat.S_IFCHR
+        elif inode_type in (FIFO_TYPE, SOCKET_TYPE, LFIFO_TYPE, LSOCKET_TYPE):
+            nlink, = reader.unpack('<I')
+            if inode_type in (LFIFO_TYPE, LSOCKET_TYPE):
+                reader.unpack('<I')
+            if inode_type in (FIFO_TYPE, LFIFO_TYPE):
+                mode |= stat.S_IFIFO
+            else:
+                mode |= stat.S_IFSOCK
+        else:
+            raise SquashfsError(_("Unknown inode type {0} in {1}").format(inode_type, self.path))
+
+        return Inode(number, mode, self.ids[uid_idx], self.ids[gid_idx], mtime,
+                     nlink, size, blocks_start, block_sizes, fragment,
+                     fragment_offset, dir_block, dir_offset, target, rdev)
+
+    def read_inode(self, ref):
+        """ Reads an inode given its reference (metadata block << 16 | offset) """
+        reader = _MetadataReader(self, self.superblock.inode_table_start,
+                                 ref >> 16, ref & 0xFFFF)
+        return self._parse_inode(reader)
+
+    def iter_inodes(self):
+        """ Yields every inode of the image, reading the inode table sequentially """
+        reader = _MetadataReader(self, self.superblock.inode_table_start, 0, 0)
+        for i in range(self.superblock.inode_count):
+            yield self._parse_inode(reader)
+
+    def list_dir(self, inode):
+        """ Yields (name, inode reference) for each entry of a directory inode """
+        # Directory sizes include three bytes for the implicit '.' and '..'
+        remaining = inode.size - 3
+        if remaining <= 0:
+            return
+        reader = _MetadataReader(self, self.superblock.directory_table_start,
+                                 inode.dir_block, inode.dir_offset)
+        while remaining > 0:
+            count, start_block, base_number = reader.unpack('<III')
+            remaining -= 12
+            for i in range(count + 1):
+                offset, number_delta, entry_type, name_size = reader.unpack('<HhHH')
+                name = os.fsdecode(reader.read(name_size + 1))
+                remaining -= 8 + name_size + 1
+                yield name, (start_block << 16) | offset
+
+    def _walk_refs(self):
+        """ Yields (relative path, inode reference, inode) for every entry """
+        ref = self.superblock.root_inode_ref
+        pending = [('', ref, self.read_inode(ref))]
+        while pending:
+            path, ref, inode = pending.pop()
+            yield path, ref, inode
+            if stat.S_ISDIR(inode.mode):
+                children = []
+                for name, child_ref in self.list_dir(inode):
+                    children.append((os.path.join(path, name), child_ref, self.read_inode(child_ref)))
+                # Reversed, so entries are popped in directory order
+                pending.extend(reversed(children))
+
+    def walk(self):
+        """ Yields (relative path, inode) for every entry in the image.
+            Parents are always yielded before their children ('' is the root) """
+        for path, ref, inode in self._walk_refs():
+            yield path, inode
+
+    def read_data_block(self, position, word):
+        """ Reads and decompresses one data block """
+        data = os.pread(self.fd, word & BLOCK_SIZE_MASK, position)
+        if word & BLOCK_UNCOMPRESSED:
+            return data
+        return self.decompress(data, self.block_size)
+
+    def _fragment_table(self):
+        if self._fragments is None:
+            self._fragments = self._read_lookup_table(
+                self.superblock.fragment_table_start,
+                self.superblock.fragment_entry_count, '<QII')
+        return self._fragments
+
+    def data_position(self, inode):
+        """ Offset in the image where the data of a regular file starts """
+        if inode.block_sizes or inode.fragment == INVALID_FRAGMENT:
+            return inode.blocks_start
+        return self._fragment_table()[inode.fragment][0]
+
+    def read_fragment(self, index):
+        """ Returns a decompressed fragment block """
+        fragments = self._fragment_table()
+
+        with self._cache_lock:
+            data = self._fragment_cache.get(index)
+            if data is not None:
+                self._fragment_cache.move_to_end(index)
+                return data
+
+        start, word, unused = fragments[index]
+        data = self.read_data_block(start, word)
+
+        with self._cache_lock:
+            self._fragment_cache[index] = data
+            if len(self._fragment_cache) > FRAGMENT_CACHE_SIZE:
+                self._fragment_cache.popitem(last=False)
+        return data
+
+
+def _load_index_cache():
+    """ Loads index_image results from previous runs """
+    try:
+        with open(INDEX_CACHE) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_index_cache(cache):
+    """ Saves index_image results """
+    try:
+        os.makedirs(os.path.dirname(INDEX_CACHE), exist_ok=True)
+        with open(INDEX_CACHE + '+', 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(INDEX_CACHE + '+', INDEX_CACHE)
+    except OSError as os_error:
+        logging.warning(os_error)
+
+
+def index_image(path):
+    """ Returns the number of inodes and the total uncompressed size of the
+        files in an image. The inode count comes from the superblock and the
+        sizes from the inode table, so no data block is ever read.
+        Results are cached by image path and mtime """
+    mtime = os.stat(path).st_mtime
+    cache = _load_index_cache()
+    cached = cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return ImageIndex(cached[1], cached[2])
+
+    with SquashfsImage(path) as image:
+        total_bytes = sum(inode.size for inode in image.iter_inodes()
+                          if stat.S_ISREG(inode.mode))
+        index = ImageIndex(image.superblock.inode_count, total_bytes)
+
+    cache[path] = [mtime, index.files, index.bytes]
+    _save_index_cache(cache)
+    return index
+
+
+class CopyPlan(object):
+    """ Merged list of the entries of several images (layers), walked once.
+        Upper layers win, as they would when copying the images one after
+        the other, but each destination path is written only once """
+
+    def __init__(self, layers):
+        self.layers = layers
+        # path -> (layer, reference, mode, size)
+        self.entries = collections.OrderedDict()
+        self.files = 0
+        self.bytes = 0
+        self.saved_files = 0
+        self.saved_bytes = 0
+        for layer in layers:
+            self._add_layer(layer)
+
+    def _walk_layer(self, image):
+        """ Yields (path, reference, mode, size) for every entry of a layer,
+            parents before children """
+        for path, ref, inode in image._walk_refs():
+            size = inode.size if stat.S_ISREG(inode.mode) else 0
+            yield path, ref, inode.mode, size
+
+    def _load(self, image, ref):
+        """ Gets the entry (an inode) back from its reference """
+        return image.read_inode(ref)
+
+    def _position(self, image, inode):
+        """ Where the data of a regular file is stored in its layer """
+        return image.data_position(inode)
+
+    def _forget(self, entry):
+        """ Accounts for an entry that an upper layer overrides """
+        layer, ref, mode, size = entry
+        self.files -= 1
+        self.bytes -= size
+        self.saved_files += 1
+        self.saved_bytes += size
+
+    def _add_layer(self, layer):
+        for path, ref, mode, size in self._walk_layer(layer):
+            previous = self.entries.get(path)
+            if previous is not None:
+                self._forget(previous)
+                if stat.S_ISDIR(previous[2]) and not stat.S_ISDIR(mode):
+                    # A directory replaced by something else. Drop its contents too
+                    prefix = os.path.join(path, '')
+                    for child in [child for child in self.entries if child.startswith(prefix)]:
+                        self._forget(self.entries.pop(child))
+            # Overridden entries keep their position, so parents still come first
+            self.entries[path] = (layer, ref, mode, size)
+            self.files += 1
+            self.bytes += size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        """ Yields (layer, relative path, entry), parents before children """
+        for path, (layer, ref, mode, size) in self.entries.items():
+            yield layer, path, self._load(layer, ref)
+
+    def layout_order(self):
+        """ Like iterating the plan, but regular files come last, sorted by
+            layer and by where their data is stored, so each source is read
+            (nearly) sequentially instead of seeking back and forth """
+        layer_numbers = {id(layer): number for number, layer in enumerate(self.layers)}
+        files = []
+        for path, (layer, ref, mode, size) in self.entries.items():
+            entry = self._load(layer, ref)
+            if stat.S_ISREG(mode):
+                key = (layer_numbers[id(layer)], self._position(layer, entry), path)
+                files.append((key, layer, path, entry))
+            else:
+                yield layer, path, entry
+        files.sort(key=lambda item: item[0])
+        for key, layer, path, entry in files:
+            yield layer, path, entry
+
+
+class _FileJob(object):
+    """ A regular file being written, possibly by several workers at once """
+
+    def __init__(self, image, path, inode, fd, num_chunks):
+        self.image = image
+        self.path = path
+        self.inode = inode
+        self.fd = fd
+        self.remaining = num_chunks
+        # False if some chunk was skipped because the extraction was stopped
+        self.complete = True
+        self.lock = threading.Lock()
+
+
+class Extractor(object):
+    """ Extracts squashfs images into a directory.
+        Data blocks are read and decompressed by a pool of worker threads
+        (zlib and lzma release the GIL), files are preallocated and their
+        metadata is restored as soon as they are written """
+
+    def __init__(self, dest_dir, workers=None, callback=None, journal=None,
+                 write_behind=None):
+        self.dest_dir = dest_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.callback = callback
+        # CopyJournal of the files already copied (see copy_journal.py)
+        self.journal = journal
+        # page_cache.WriteBehind. If given, the page cache is spared: what
+        # has been read and written is dropped from it
+        self.write_behind = write_behind
+
+        self.files_done = 0
+        self.bytes_done = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+        self.stop_event = threading.Event()
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers * 4)
+        self._error = None
+
+    def stop(self):
+        """ Asks the extraction to stop as soon as possible """
+        self.stop_event.set()
+
+    def _done(self, num_files, num_bytes):
+        """ Updates counters and notifies our caller """
+        with self._lock:
+            self.files_done += num_files
+            self.bytes_done += num_bytes
+            files_done = self.files_done
+            bytes_done = self.bytes_done
+        if self.callback is not None:
+            self.callback(files_done, bytes_done)
+
+    def _target(self, path):
+        return os.path.join(self.dest_dir, path)
+
+    @staticmethod
+    def _signature(inode):
+        """ Size and mtime of a regular file, as stored in the journal """
+        return inode.size, inode.mtime
+
+    def _already_copied(self, path, inode):
+        """ Checks the journal for a file copied by an earlier attempt """
+        if self.journal is None:
+            return False
+        size, mtime = self._signature(inode)
+        if not self.journal.is_done(path, size, mtime):
+            return False
+        self.files_skipped += 1
+        self.bytes_skipped += size
+        self._done(1, size)
+        return True
+
+    def _record(self, path, inode):
+        if self.journal is not None:
+            size, mtime = self._signature(inode)
+            self.journal.record(path, size, mtime)
+
+    @staticmethod
+    def _remove_existing(target):
+        """ Removes whatever is in our way (rsync replaces files too) """
+        try:
+            if stat.S_ISDIR(os.lstat(target).st_mode):
+                os.rmdir(target)
+            else:
+                os.unlink(target)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _set_metadata(target, inode, fd=None):
+        """ Restores ownership, permissions and modification time """
+        if fd is not None:
+            os.fchown(fd, inode.uid, inode.gid)
+            os.fchmod(fd, stat.S_IMODE(inode.mode))
+            os.utime(fd, (inode.mtime, inode.mtime))
+        elif stat.S_ISLNK(inode.mode):
+            os.lchown(target, inode.uid, inode.gid)
+            os.utime(target, (inode.mtime, inode.mtime), follow_symlinks=False)
+        else:
+            os.chown(target, inode.uid, inode.gid)
+            os.chmod(target, stat.S_IMODE(inode.mode))
+            os.utime(target, (inode.mtime, inode.mtime))
+
+    def _submit(self, executor, func, *args):
+        """ Queues a job, never keeping more than a few jobs per worker in memory """
+        self._slots.acquire()
+        future = executor.submit(func, *args)
+        future.add_done_callback(self._job_finished)
+
+    def _job_finished(self, future):
+        self._slots.release()
+        error = future.exception()
+        if error is not None and self._error is None:
+            self._error = error
+            self.stop_event.set()
+
+    def _write_chunk(self, job, first_block, position, offset):
+        """ Writes up to CHUNK_BLOCKS data blocks (and the tail fragment if
+            this is the last chunk) of a file """
+        try:
+            if self.stop_event.is_set():
+                job.complete = False
+            else:
+                image = job.image
+                inode = job.inode
+                start = position
+                block_sizes = inode.block_sizes[first_block:first_block + CHUNK_BLOCKS]
+                for word in block_sizes:
+                    size = word & BLOCK_SIZE_MASK
+                    if size == 0:
+                        # Sparse block, nothing to write
+                        offset += image.block_size
+                        continue
+                    data = image.read_data_block(position, word)
+                    os.pwrite(job.fd, data, offset)
+                    position += size
+                    offset += len(data)
+                if self.write_behind is not None and position > start:
+                    # Data blocks are read once (fragments may be read again)
+                    page_cache.drop(image.fd, start, position - start)
+
+                last_chunk = first_block + CHUNK_BLOCKS >= len(inode.block_sizes)
+                if last_chunk and inode.fragment != INVALID_FRAGMENT:
+                    data = image.read_fragment(inode.fragment)
+                    tail_size = inode.size - offset
+                    start = inode.fragment_offset
+                    os.pwrite(job.fd, data[start:start + tail_size], offset)
+        except Exception:
+            # The file is left incomplete, its fd is closed with the last chunk
+            job.complete = False
+            raise
+        finally:
+            with job.lock:
+                job.remaining -= 1
+                finished = job.remaining == 0
+            if finished:
+                self._finish_file(job)
+
+    def _finish_file(self, job):
+        """ Called once all chunks of a file have been written """
+        if not job.complete:
+            os.close(job.fd)
+            return
+        try:
+            os.ftruncate(job.fd, job.inode.size)
+            self._set_metadata(self._target(job.path), job.inode, job.fd)
+            if self.write_behind is not None:
+                self.write_behind.written(job.fd, self._target(job.path), job.inode.size)
+        finally:
+            os.close(job.fd)
+        self._record(job.path, job.inode)
+        self._done(1, job.inode.size)
+
+    def _extract_file(self, executor, image, path, inode):
+        """ Creates a regular file and queues its data blocks """
+        target = self._target(path)
+        self._remove_existing(target)
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        if inode.size > 0:
+            try:
+                os.posix_fallocate(fd, 0, inode.size)
+            except OSError:
+                # Not all filesystems support it
+                pass
+
+        num_chunks = max(1, (len(inode.block_sizes) + CHUNK_BLOCKS - 1) // CHUNK_BLOCKS)
+        job = _FileJob(image, path, inode, fd, num_chunks)
+        position = inode.blocks_start
+        offset = 0
+        for first_block in range(0, num_chunks * CHUNK_BLOCKS, CHUNK_BLOCKS):
+            self._submit(executor, self._write_chunk, job, first_block, position, offset)
+            for word in inode.block_sizes[first_block:first_block + CHUNK_BLOCKS]:
+                position += word & BLOCK_SIZE_MASK
+                offset += image.block_size
+
+    def _extract_special(self, path, inode):
+        """ Creates directories, symlinks, device nodes, fifos and sockets """
+        target = self._target(path)
+        if stat.S_ISDIR(inode.mode):
+            if not os.path.isdir(target) or os.path.islink(target):
+                self._remove_existing(target)
+                os.mkdir(target, 0o700)
+            # Directory metadata is restored at the end
+            return
+        self._remove_existing(target)
+        if stat.S_ISLNK(inode.mode):
+            os.symlink(inode.target, target)
+        else:
+            major = (inode.rdev >> 8) & 0xFFF
+            minor = (inode.rdev & 0xFF) | ((inode.rdev >> 12) & 0xFFF00)
+            os.mknod(target, inode.mode, os.makedev(major, minor))
+        self._set_metadata(target, inode)
+        self._done(1, 0)
+
+    def extract_image(self, image):
+        """ Extracts a whole image """
+        return self.run((image, path, inode) for path, inode in image.walk())
+
+    def run(self, entries):
+        """ Extracts (image, path, inode) entries, parents before children
+            (see CopyPlan). Raises the first error found by any worker """
+        directories = []
+        hard_links = {}
+        pending_links = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for image, path, inode in entries:
+                if self.stop_event.is_set():
+                    break
+                if stat.S_ISREG(inode.mode):
+                    if inode.nlink > 1:
+                        key = (image.path, inode.number)
+                        if key in hard_links:
+                            pending_links.append((hard_links[key], path))
+                            continue
+                        hard_links[key] = path
+                    if not self._already_copied(path, inode):
+                        self._extract_file(executor, image, path, inode)
+                else:
+                    self._extract_special(path, inode)
+                    if stat.S_ISDIR(inode.mode):
+                        directories.append((path, inode))
+
+        if self._error is not None:
+            raise self._error
+        if self.stop_event.is_set():
+            return False
+
+        for source, path in pending_links:
+            target = self._target(path)
+            self._remove_existing(target)
+            os.link(self._target(source), target)
+            self._done(1, 0)
+
+        # Deepest directories first, so their parents' mtime is preserved
+        for path, inode in reversed(directories):
+            self._set_metadata(self._target(path), inode)
+            self._done(1, 0)
+
+        logging.debug(_("Extracted {0} files ({1} bytes) to {2}").format(
+            self.files_done, self.bytes_done, self.dest_dir))
+        if self.files_skipped:
+            logging.debug(_("{0} files ({1} bytes) were already there from a previous attempt").format(
+                self.files_skipped, self.bytes_skipped))
+        return True
@@ -30,10 +30,10 @@ from gi.repository import Gtk, Gdk
 
 import os
 import sys
-import multiprocessing
 import logging
 
 import config
+import event_bus
 import language
 import location
 import check
@@ -43,6 +43,9 @@ import user_info
 import slides
 import misc.misc as misc
 import info
+import prefetch
+import os_probe
+import misc.udev_monitor as udev_monitor
 import show_message as show
 
 from installation import ask as installation_ask
@@ -151,9 +154,18 @@ class MainWindow(Gtk.ApplicationWindow):
         self.backwards_button.set_always_show_image(True)
         # self.backwards_button.add(Gtk.Arrow(Gtk.ArrowType.LEFT, Gtk.ShadowType.NONE))
 
-        # Create a queue. Will be used to report pacman messages (pacman/pac.py)
-        # to the main thread (installation/process.py)
-        self.callback_queue = multiprocessing.JoinableQueue()
+        # Warm up the live images while the user goes through the first screens
+        self.prefetch_thread = prefetch.start(self.settings)
+
+        # Look for other installed OSes before the installation pages ask
+        os_probe.start()
+
+        # Keep the device inventory in step with udev
+        udev_monitor.start()
+
+        # Create the event bus. Will be used to report the installation
+        # progress (installation/process.py) to the slides page
+        self.callback_queue = event_bus.EventBus()
 
         '''# Save in config if we have to use aria2 to download pacman packages
         self.settings.set("use_aria2", cmd_line.aria2)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  block_devices.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Inventory of the block devices of the system. The first call builds it
+    with one pass over sysfs and one lsblk run; later calls are answered
+    from memory. A device whose filesystem changed is read again (with
+    blkid) when it's next asked for, once someone calls invalidate() for it,
+    and the disks whose partitions appear, vanish or change size in
+    /proc/partitions are read again by themselves """
+
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+SYS_BLOCK = "/sys/class/block"
+
+# Seconds between two looks at /proc/partitions
+CHECK_INTERVAL = 1.0
+
+# Fields lsblk (and blkid) tell about the filesystem or partition in a
+# device, with the names get_info() gives them (as blkid does)
+FS_FIELDS = (
+    ('fstype', 'TYPE'),
+    ('uuid', 'UUID'),
+    ('label', 'LABEL'),
+    ('partuuid', 'PARTUUID'),
+    ('partlabel', 'PARTLABEL'))
+
+# Names blkid -p gives to the partition fields
+PROBE_NAMES = {'partuuid': 'PART_ENTRY_UUID', 'partlabel': 'PART_ENTRY_NAME'}
+
+_lock = threading.RLock()
+_devices = None
+_partitions = None
+_dirty = set()
+_last_check = 0.0
+
+# How the inventory has been used (see stats())
+_counters = {'snapshots': 0, 'refreshes': 0, 'lookups': 0}
+
+
+def _read_sys(name, attribute):
+    try:
+        with open(os.path.join(SYS_BLOCK, name, attribute)) as sys_file:
+            return sys_file.read().strip()
+    except OSError:
+        return None
+
+
+def _read_proc_partitions():
+    """ Size in KiB of each device in /proc/partitions, by name """
+    partitions = {}
+    with open("/proc/partitions") as partitions_file:
+        for line in partitions_file:
+            fields = line.split()
+            if len(fields) == 4 and fields[0].isdigit():
+                partitions[fields[3]] = int(fields[2])
+    return partitions
+
+
+def _sys_entry(name):
+    """ What sysfs says of a block device """
+    partition = os.path.exists(os.path.join(SYS_BLOCK, name, "partition"))
+    disk = name
+    if partition:
+        disk = os.path.basename(os.path.dirname(os.path.realpath(os.path.join(SYS_BLOCK, name))))
+    size = int(_read_sys(name, "size") or 0) * 512
+    rotational = _read_sys(disk, "queue/rotational")
+    entry = {
+        'name': name,
+        'path': "/dev/" + name,
+        'type': 'part' if partition else 'disk',
+        'disk': "/dev/" + disk,
+        'size': size,
+        'rotational': None if rotational is None else rotational == "1",
+        'removable': _read_sys(disk, "removable") == "1",
+        'read_only': _read_sys(name, "ro") == "1",
+        'logical_block_size': int(_read_sys(disk, "queue/logical_block_size") or 512),
+        # An extended partition only holds the first sectors of the chain
+        'extended': partition and size <= 1024}
+    for field, blkid_name in FS_FIELDS:
+        entry[field] = None
+    return entry
+
+
+def _lsblk(paths=()):
+    """ lsblk's view of the devices (all of them if no paths are given),
+        flattened, by kernel name """
+    cmd = ["lsblk", "-J", "-b", "-O"] + list(paths)
+    output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode()
+    found = {}
+    pending = json.loads(output).get('blockdevices', [])
+    while pending:
+        device = pending.pop()
+        pending.extend(device.get('children') or [])
+        found[device['kname']] = device
+    return found
+
+
+def _blkid(path):
+    """ What blkid finds probing a device itself (not from its cache) """
+    try:
+        output = subprocess.check_output(["blkid", "-p", "-o", "export", path],
+                                         stderr=subprocess.DEVNULL).decode()
+    except subprocess.CalledProcessError:
+        # Nothing there
+        return {}
+    except OSError as error:
+        logging.warning(_("Can't run blkid: {0}").format(error))
+        return {}
+    return dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+
+
+def _apply_lsblk(entry, device):
+    for field, blkid_name in FS_FIELDS:
+        entry[field] = device.get(field) or None
+    if device.get('path'):
+        entry['path'] = device['path']
+    if device.get('type'):
+        entry['type'] = device['type']
+    if device.get('parttype') in ('0x5', '0xf', '0x85'):
+        entry['extended'] = True
+
+
+def _apply_blkid(entry, fields):
+    for field, blkid_name in FS_FIELDS:
+        entry[field] = fields.get(blkid_name) or fields.get(PROBE_NAMES.get(field)) or None
+
+
+def snapshot():
+    """ Builds the whole inventory again """
+    global _devices, _partitions, _last_check
+    start = time.time()
+    with _lock:
+        devices = dict((name, _sys_entry(name)) for name in os.listdir(SYS_BLOCK))
+        try:
+            for name, device in _lsblk().items():
+                if name in devices:
+                    _apply_lsblk(devices[name], device)
+        except (OSError, ValueError, subprocess.CalledProcessError) as error:
+            # Old lsblk without JSON output, ask blkid about each device
+            logging.debug(_("Can't run lsblk: {0}").format(error))
+            for entry in devices.values():
+                if not entry['extended']:
+                    _apply_blkid(entry, _blkid(entry['path']))
+        _devices = devices
+        _partitions = _read_proc_partitions()
+        _last_check = time.time()
+        _dirty.clear()
+        _counters['snapshots'] += 1
+    logging.debug(_("Block device inventory built in {0:.2f} seconds ({1} devices)").format(
+        time.time() - start, len(devices)))
+
+
+def _refresh(name):
+    """ Reads a device again """
+    entry = _sys_entry(name)
+    old = _devices.get(name)
+    if old is not None:
+        entry['path'], entry['type'] = old['path'], old['type']
+    else:
+        # A new device, ask lsblk what it is
+        try:
+            device = _lsblk(["/dev/" + name]).get(name)
+            if device is not None:
+                _apply_lsblk(entry, device)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            pass
+    if not entry['extended']:
+        # udev may not have caught up with a new filesystem yet
+        _apply_blkid(entry, _blkid(entry['path']))
+    _devices[name] = entry
+    _counters['refreshes'] += 1
+
+
+def _check_partitions():
+    """ Finds the devices that appeared, vanished or changed size since the
+        last look at /proc/partitions, and marks them (and their disks) to
+        be read again """
+    global _partitions, _last_check
+    _last_check = time.time()
+    partitions = _read_proc_partitions()
+    changed = set(name for name in set(partitions) | set(_partitions)
+                  if partitions.get(name) != _partitions.get(name))
+    for name in changed:
+        disk = _devices.get(name, {}).get('disk')
+        if disk is not None and disk != "/dev/" + name:
+            _dirty.add(os.path.basename(disk))
+        if name not in partitions:
+            _devices.pop(name, None)
+            _dirty.discard(name)
+        else:
+            _dirty.add(name)
+    _partitions = partitions
+
+
+def _inventory():
+    """ The inventory, up to date. Call it holding _lock """
+    if _devices is None:
+        snapshot()
+    elif time.time() - _last_check >= CHECK_INTERVAL:
+        _check_partitions()
+    for name in list(_dirty):
+        if os.path.exists(os.path.join(SYS_BLOCK, name)):
+            _refresh(name)
+        else:
+            _devices.pop(name, None)
+    _dirty.clear()
+    _counters['lookups'] += 1
+    return _devices
+
+
+def _name(device):
+    """ Kernel name of a device path (/dev/mapper/x -> dm-0) """
+    return os.path.basename(os.path.realpath(device))
+
+
+def invalidate(device=None):
+    """ Tells the inventory that device changed (its filesystem, or the
+        partitions of a disk). Without a device, everything is read again """
+    global _last_check
+    with _lock:
+        if device is None or _devices is None:
+            _dirty.clear()
+            if _devices is not None:
+                _dirty.update(_devices)
+            _last_check = 0.0
+            return
+        name = _name(device)
+        _dirty.add(name)
+        for entry in _devices.values():
+            if entry['disk'] == "/dev/" + name:
+                _dirty.add(entry['name'])
+        # Partitions may have been added or removed
+        _last_check = 0.0
+
+
+def get(device):
+    """ What is known of a device (a dict), or None if there's no such device """
+    with _lock:
+        entry = _inventory().get(_name(device))
+        return dict(entry) if entry is not None else None
+
+
+def devices(device_type=None):
+    """ All devices (of a type: 'disk', 'part', 'loop'...), sorted by name """
+    with _lock:
+        entries = [dict(entry) for entry in _inventory().values()
+                   if device_type is None or entry['type'] == device_type]
+    return sorted(entries, key=lambda entry: entry['name'])
+
+
+def get_info(device):
+    """ Filesystem and partition details of a device, with the names blkid
+        uses (UUID, LABEL, TYPE...). Empty for extended partitions """
+    entry = get(device)
+    if entry is None or entry['extended']:
+        return {}
+    return dict((blkid_name, entry[field]) for field, blkid_name in FS_FIELDS
+                if entry[field] is not None)
+
+
+def probe(path):
+    """ What blkid finds in path, with its names. For what the inventory
+        doesn't hold, like image files """
+    return _blkid(path)
+
+
+def exists(device):
+    return get(device) is not None
+
+
+def is_extended(device):
+    entry = get(device)
+    return entry is not None and entry['extended']
+
+
+def is_ssd(device):
+    """ True if the disk of device doesn't rotate (None if we can't tell) """
+    entry = get(device)
+    if entry is None:
+        return None
+    disk = get(entry['disk'])
+    return None if disk is None or disk['rotational'] is None else not disk['rotational']
+
+
+def stats():
+    with _lock:
+        return dict(_counters)
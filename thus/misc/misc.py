@@ -34,6 +34,7 @@ import dbus
 import urllib
 from socket import timeout
 
+import misc.block_devices as block_devices
 import misc.osextras as osextras
 
 NM = 'org.freedesktop.NetworkManager'
@@ -572,6 +573,58 @@ def get_install_medium():
 get_install_medium.medium = ''
 
 
+def get_source_medium(path):
+    """ Returns the kind of medium a file is stored on ('USB', 'CD', 'DISK'
+        or 'RAM') and the sysfs directory of its disk (None if there's no
+        disk, like when the live media has been copied to RAM) """
+    try:
+        device = os.stat(path).st_dev
+    except OSError:
+        return 'DISK', None
+    if os.major(device) == 0:
+        # tmpfs, overlayfs...
+        return 'RAM', None
+    sysfs = os.path.realpath('/sys/dev/block/{0}:{1}'.format(os.major(device), os.minor(device)))
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        sysfs = os.path.dirname(sysfs)
+    if os.path.basename(sysfs).startswith('sr'):
+        medium = 'CD'
+    elif '/usb' in sysfs:
+        medium = 'USB'
+    else:
+        medium = 'DISK'
+    return medium, sysfs
+
+
+def get_meminfo():
+    """ Returns /proc/meminfo as a dict of sizes in bytes """
+    meminfo = {}
+    with open('/proc/meminfo') as meminfo_file:
+        for line in meminfo_file:
+            fields = line.split()
+            if len(fields) >= 2:
+                size = int(fields[1])
+                if len(fields) > 2 and fields[2] == 'kB':
+                    size *= 1024
+                meminfo[fields[0].rstrip(':')] = size
+    return meminfo
+
+
+def set_readahead(sysfs, size_kb):
+    """ Sets the readahead (in KiB) of a disk. Returns the old one, or None
+        if it couldn't be changed """
+    path = os.path.join(sysfs, 'queue', 'read_ahead_kb')
+    try:
+        with open(path) as read_ahead:
+            old_size_kb = int(read_ahead.read())
+        with open(path, 'w') as read_ahead:
+            read_ahead.write(str(size_kb))
+    except (OSError, ValueError) as err:
+        logging.warning(_("Can't set readahead of {0}: {1}").format(sysfs, err))
+        return None
+    return old_size_kb
+
+
 def execute(*args):
     """runs args* in shell mode. Output status is taken."""
 
@@ -1014,47 +1067,12 @@ def set_cursor(cursor_type):
 
 def partition_exists(partition):
     """ Check if a partition already exists """
-    if "/dev/" in partition:
-        partition = partition[len("/dev/"):]
-
-    exists = False
-    with open("/proc/partitions") as partitions:
-        if partition in partitions.read():
-            exists = True
-    return exists
+    return block_devices.exists(partition)
 
 
 def is_partition_extended(partition):
     """ Check if a partition is of extended type """
-
-    if "/dev/mapper" in partition:
-        return False
-
-    if "/dev/" in partition:
-        partition = partition[len("/dev/"):]
-
-    num = partition[len("sdX"):]
-    if len(num) == 0:
-        return False
-
-    try:
-        num = int(num)
-    except ValueError as err:
-        logging.warning(err)
-        return False
-
-    if num > 4:
-        # logical partition
-        return False
-
-    with open("/proc/partitions") as partitions:
-        lines = partitions.readlines()
-    for line in lines:
-        if "major" not in line:
-            info = line.split()
-            if len(info) > 0 and info[2] == '1' and info[3] == partition:
-                return True
-    return False
+    return block_devices.is_extended(partition)
 
 
 def get_partitions():
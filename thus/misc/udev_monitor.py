@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  udev_monitor.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Listens to the block device events udev sends once it has handled them
+    (device nodes and /dev/disk links are in place by then). Each event
+    invalidates the device in the inventory (see block_devices.py), and
+    code that just changed a partition table can wait for the partitions it
+    needs instead of waiting for udev to settle everything """
+
+import logging
+import os
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+import misc.block_devices as block_devices
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# Multicast group of the events udev has processed (1 is the kernel's)
+UDEV_GROUP = 2
+
+# Header of udev's netlink messages (see libudev-monitor.c): "libudev\0",
+# magic (big endian), header size, properties offset and length
+UDEV_PREFIX = b"libudev\0"
+UDEV_MAGIC = 0xfeedcafe
+_HEADER = struct.Struct("=8sIIII")
+
+RECEIVE_BUFFER = 1024 * 1024
+
+# Seconds waited by default
+DEFAULT_TIMEOUT = 30
+
+# Without the monitor, waits look again every this many seconds (with it,
+# every RECHECK_INTERVAL, in case the node shows up without an event).
+# After a mark only an event counts: the old node may still be there
+POLL_INTERVAL = 0.1
+RECHECK_INTERVAL = 1.0
+
+_condition = threading.Condition()
+_thread = None
+_pid = None
+_running = False
+_sequence = 0
+
+# Sequence number of the last event that added or changed a device, by
+# device node, /dev link and "UUID=<uuid>"
+_seen = {}
+
+
+def parse(data):
+    """ Properties of a udev event (None if it isn't one) """
+    if len(data) < _HEADER.size or not data.startswith(UDEV_PREFIX):
+        return None
+    prefix, magic, header_size, properties_off, properties_len = _HEADER.unpack_from(data)
+    if socket.ntohl(magic) != UDEV_MAGIC:
+        return None
+    properties = data[properties_off:properties_off + properties_len].split(b'\0')
+    return dict(item.decode(errors='replace').split('=', 1)
+                for item in properties if b'=' in item)
+
+
+def _handle(event):
+    global _sequence
+    if event.get('SUBSYSTEM') != 'block' or 'DEVNAME' not in event:
+        return
+    devname = event['DEVNAME']
+    if not devname.startswith('/'):
+        devname = "/dev/" + devname
+    keys = [devname] + event.get('DEVLINKS', '').split()
+    if event.get('ID_FS_UUID'):
+        keys.append("UUID=" + event['ID_FS_UUID'])
+    with _condition:
+        _sequence += 1
+        for key in keys:
+            if event.get('ACTION') == 'remove':
+                _seen.pop(key, None)
+            elif event.get('ACTION') in ('add', 'change'):
+                _seen[key] = _sequence
+        _condition.notify_all()
+    block_devices.invalidate(devname)
+
+
+def _listen(sock):
+    global _running
+    try:
+        while True:
+            event = parse(sock.recv(65536))
+            if event is not None:
+                _handle(event)
+    except OSError as error:
+        logging.warning(_("udev monitor stopped: {0}").format(error))
+    finally:
+        sock.close()
+        with _condition:
+            _running = False
+            _condition.notify_all()
+
+
+def start():
+    """ Starts listening to udev (once in each process). Returns False if
+        we can't, and waits will look at /dev by themselves """
+    global _thread, _pid, _running, _sequence
+    with _condition:
+        if _pid == os.getpid():
+            return _running
+        # Not started yet, or started in the process we were forked from
+        _pid = os.getpid()
+        _seen.clear()
+        _sequence = 0
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC,
+                                 NETLINK_KOBJECT_UEVENT)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+            sock.bind((0, UDEV_GROUP))
+        except (OSError, AttributeError) as error:
+            logging.warning(_("Can't listen to udev events: {0}").format(error))
+            _running = False
+            return False
+        _running = True
+        _thread = threading.Thread(target=_listen, args=(sock,), daemon=True)
+        _thread.start()
+    return True
+
+
+def mark():
+    """ Where the event stream is now. Take it before changing a device and
+        pass it to the waits, so they only count what came afterwards """
+    start()
+    with _condition:
+        return _sequence
+
+
+def _wait(key, path, timeout, since):
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    with _condition:
+        while True:
+            # Without the monitor we don't know which events came, just
+            # look for the device itself
+            seen = not _running or since is None or _seen.get(key, -1) > since
+            if seen and os.path.exists(path):
+                found = True
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                found = False
+                break
+            _condition.wait(min(remaining, RECHECK_INTERVAL if _running else POLL_INTERVAL))
+    elapsed = time.monotonic() - start_time
+    if found:
+        logging.debug(_("Waited {0:.2f} seconds for {1}").format(elapsed, path))
+    else:
+        logging.warning(_("udev didn't set up {0} in {1:.1f} seconds").format(path, elapsed))
+    return found
+
+
+def wait_for_device(path, timeout=DEFAULT_TIMEOUT, since=None):
+    """ Waits until udev has set up the device node (or /dev link) path,
+        after the mark since if given. Returns False on timeout """
+    start()
+    return _wait(path, path, timeout, since)
+
+
+def wait_for_uuid(uuid, timeout=DEFAULT_TIMEOUT, since=None):
+    """ Waits until udev has set up a device with the filesystem uuid """
+    start()
+    return _wait("UUID=" + uuid, os.path.join("/dev/disk/by-uuid", uuid), timeout, since)
+
+
+def wait_for_devices(paths, timeout=DEFAULT_TIMEOUT, since=None):
+    """ Waits for all the devices in paths (in timeout seconds overall).
+        If one doesn't show up, waits for udev to settle instead. Returns
+        False in that case """
+    deadline = time.monotonic() + timeout
+    for path in paths:
+        if not wait_for_device(path, max(0, deadline - time.monotonic()), since):
+            subprocess.check_call(["udevadm", "settle"])
+            return False
+    return True
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  os_probe.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Finds the OSes installed in the other partitions once, in the background,
+    for every page that asks (installation_ask, alongside) and for grub, whose
+    menu entries for them are written beforehand so grub-mkconfig doesn't run
+    os-prober. What is found in each partition is cached by filesystem UUID
+    and superblock generation, so a partition is only mounted again when
+    something has written to it """
+
+import concurrent.futures
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import bootinfo
+import misc.block_devices as block_devices
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+CACHE_FILE = "/var/cache/thus/os-probe.json"
+CACHE_VERSION = 1
+
+# Partitions mounted at the same time
+PROBE_WORKERS = 4
+
+# Filesystems that can't hold an installed OS
+SKIP_TYPES = ('swap', 'crypto_LUKS', 'LVM2_member', 'linux_raid_member',
+              'squashfs', 'iso9660', 'udf')
+
+# Where the superblock of each filesystem is (offset, size). Anything that
+# mounting it and writing to it changes is in there
+SUPERBLOCKS = {
+    'ext2': (1024, 1024),
+    'ext3': (1024, 1024),
+    'ext4': (1024, 1024),
+    'btrfs': (0x10000, 4096),
+    'xfs': (0, 512),
+    'vfat': (0, 0x10000),
+    'exfat': (0, 0x10000)}
+
+# grub modules needed to read each filesystem
+GRUB_MODULES = {
+    'ext2': 'ext2', 'ext3': 'ext2', 'ext4': 'ext2', 'btrfs': 'btrfs',
+    'xfs': 'xfs', 'ntfs': 'ntfs', 'vfat': 'fat', 'exfat': 'exfat'}
+
+# Files in the root of a partition that BIOS boot code can chainload
+CHAINLOAD_FILES = ('bootmgr', 'ntldr', 'io.sys')
+
+EFI_LOADERS = ("EFI/Microsoft/Boot/bootmgfw.efi",)
+
+GRUB_CONFIGS = ("boot/grub/grub.cfg", "boot/grub2/grub.cfg")
+
+# Initramfs names of the kernel vmlinuz<suffix>, in the ways distributions
+# call them
+INITRD_NAMES = ("initramfs{0}.img", "initrd.img{0}", "initrd{0}.img", "initrd{0}")
+
+# Written instead of running 30_os-prober
+GRUB_SCRIPT = "30_thus-os-prober"
+
+_lock = threading.Lock()
+_thread = None
+_results = None
+
+
+def list_partitions():
+    """ Partitions of the system, with their filesystem """
+    return [{'device': entry['path'], 'uuid': entry['uuid'], 'type': entry['fstype']}
+            for entry in block_devices.devices('part')]
+
+
+def _read(device, offset, size):
+    with open(device, 'rb') as block_device:
+        block_device.seek(offset)
+        return block_device.read(size)
+
+
+def _ntfs_records(device):
+    """ The first MFT records ($MFT, $MFTMirr, $LogFile, $Volume). Windows
+        writes $Volume (and so its log sequence number) on every mount """
+    boot = _read(device, 0, 512)
+    sector_size = int.from_bytes(boot[0x0B:0x0D], 'little')
+    cluster_size = sector_size * boot[0x0D]
+    mft_offset = int.from_bytes(boot[0x30:0x38], 'little') * cluster_size
+    record_clusters = int.from_bytes(boot[0x40:0x41], 'little', signed=True)
+    if record_clusters < 0:
+        record_size = 1 << -record_clusters
+    else:
+        record_size = record_clusters * cluster_size
+    return _read(device, mft_offset, 4 * record_size)
+
+
+def superblock_generation(device, fstype):
+    """ Digest of the superblock of a filesystem, which changes whenever the
+        filesystem is written to. None if we don't know where to look """
+    try:
+        if fstype == 'ntfs':
+            data = _ntfs_records(device)
+        elif fstype in SUPERBLOCKS:
+            data = _read(device, *SUPERBLOCKS[fstype])
+        else:
+            return None
+    except (OSError, ValueError) as error:
+        logging.debug(_("Can't read the superblock of {0}: {1}").format(device, error))
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+
+def _find_path(root, path):
+    """ Finds path under root ignoring case (as FAT and Windows do).
+        Returns the real path relative to root, or None """
+    found = []
+    current = root
+    for part in path.split('/'):
+        try:
+            names = os.listdir(current)
+        except OSError:
+            return None
+        matches = [name for name in names if name.lower() == part.lower()]
+        if not matches:
+            return None
+        found.append(matches[0])
+        current = os.path.join(current, matches[0])
+    return '/'.join(found)
+
+
+def _find_kernels(mount_dir):
+    """ Kernels in /boot, newest name first, with their initramfs """
+    kernels = []
+    boot_dir = os.path.join(mount_dir, "boot")
+    for path in sorted(glob.glob(os.path.join(boot_dir, "vmlinuz*")), reverse=True):
+        kernel = os.path.basename(path)
+        suffix = kernel[len("vmlinuz"):]
+        initrd = None
+        for name in INITRD_NAMES:
+            if os.path.exists(os.path.join(boot_dir, name.format(suffix))):
+                initrd = "/boot/" + name.format(suffix)
+                break
+        kernels.append(["/boot/" + kernel, initrd])
+    return kernels
+
+
+def _boot_info(mount_dir):
+    """ How grub can boot what is installed in a mounted partition """
+    try:
+        root_names = set(name.lower() for name in os.listdir(mount_dir))
+    except OSError:
+        root_names = set()
+    efi_loader = None
+    for loader in EFI_LOADERS:
+        found = _find_path(mount_dir, loader)
+        if found:
+            efi_loader = "/" + found
+            break
+    grub_cfg = None
+    for config in GRUB_CONFIGS:
+        if os.path.exists(os.path.join(mount_dir, config)):
+            grub_cfg = "/" + config
+            break
+    return {
+        'chainload': any(name in root_names for name in CHAINLOAD_FILES),
+        'efi_loader': efi_loader,
+        'grub_cfg': grub_cfg,
+        'kernels': _find_kernels(mount_dir)}
+
+
+def _mount_points():
+    """ Where each device is mounted already """
+    mount_points = {}
+    with open("/proc/self/mounts") as mounts:
+        for line in mounts:
+            fields = line.split()
+            if fields[0].startswith("/dev/"):
+                device = os.path.realpath(fields[0])
+                mount_points.setdefault(device, fields[1].replace("\\040", " "))
+    return mount_points
+
+
+def probe_partition(partition, mount_points):
+    """ Looks for an OS in a partition, mounting it (read only) if it isn't
+        mounted yet """
+    result = dict(partition, name=_("unknown"), chainload=False, efi_loader=None,
+                  grub_cfg=None, kernels=[])
+    device = partition['device']
+    if partition['type'] == 'swap':
+        result['name'] = "Swap"
+        return result
+
+    if partition['type'] and partition['type'] not in SKIP_TYPES:
+        mount_dir = mount_points.get(os.path.realpath(device))
+        tmp_dir = None
+        if mount_dir is None:
+            tmp_dir = tempfile.mkdtemp()
+            if subprocess.call(["mount", "-o", "ro", device, tmp_dir],
+                               stderr=subprocess.DEVNULL) == 0:
+                mount_dir = tmp_dir
+        if mount_dir is not None:
+            try:
+                result['name'] = bootinfo._get_os(mount_dir)
+                result.update(_boot_info(mount_dir))
+            finally:
+                if tmp_dir is not None:
+                    subprocess.call(["umount", "-l", tmp_dir], stderr=subprocess.DEVNULL)
+        if tmp_dir is not None:
+            try:
+                os.rmdir(tmp_dir)
+            except OSError:
+                pass
+
+    if result['name'] == _("unknown"):
+        # As a last resort, look at the boot sector
+        result['name'] = bootinfo._get_partition_info(device)
+    # Mounting may have replayed a journal, take the generation left behind
+    result['generation'] = superblock_generation(device, partition['type'])
+    return result
+
+
+def _load_cache():
+    try:
+        with open(CACHE_FILE) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache.get('partitions', {})
+
+
+def _store_cache(results):
+    cache = {
+        'version': CACHE_VERSION,
+        'partitions': dict((result['uuid'], result) for result in results
+                           if result['uuid'] and result['generation'])}
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE + '+', 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.rename(CACHE_FILE + '+', CACHE_FILE)
+    except OSError as error:
+        logging.debug(_("Can't store the OS probe cache: {0}").format(error))
+
+
+def probe(exclude=()):
+    """ Looks for OSes in every partition but the excluded devices. Only
+        the partitions that changed since they were last probed are mounted.
+        Returns a result (a dict) for each partition """
+    start = time.time()
+    exclude = set(os.path.realpath(device) for device in exclude)
+    partitions = [partition for partition in list_partitions()
+                  if os.path.realpath(partition['device']) not in exclude]
+    cache = _load_cache()
+    mount_points = _mount_points()
+
+    results = {}
+    to_probe = []
+    for partition in partitions:
+        cached = cache.get(partition['uuid'] or "")
+        if cached and cached['generation'] is not None and \
+                cached['generation'] == superblock_generation(partition['device'],
+                                                              partition['type']):
+            results[partition['device']] = dict(cached, **partition)
+        else:
+            to_probe.append(partition)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        futures = dict((executor.submit(probe_partition, partition, mount_points), partition)
+                       for partition in to_probe)
+        for future in concurrent.futures.as_completed(futures):
+            partition = futures[future]
+            try:
+                results[partition['device']] = future.result()
+            except (OSError, subprocess.SubprocessError) as error:
+                logging.warning(_("Can't probe {0}: {1}").format(partition['device'], error))
+
+    results = [results[partition['device']] for partition in partitions
+               if partition['device'] in results]
+    cache.update((result['uuid'], result) for result in results
+                 if result['uuid'] and result['generation'])
+    _store_cache(list(cache.values()))
+    logging.debug(_("Probed {0} partitions for OSes in {1:.1f} seconds ({2} from the cache)")
+                  .format(len(results), time.time() - start, len(results) - len(to_probe)))
+    return results
+
+
+def _run():
+    global _results
+    try:
+        results = probe()
+    except Exception as error:
+        logging.warning(_("Can't probe the partitions for OSes: {0}").format(error))
+        results = None
+    with _lock:
+        _results = results
+
+
+def start():
+    """ Starts probing the partitions in the background. Returns the thread """
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, daemon=True)
+            _thread.start()
+        return _thread
+
+
+def get_results():
+    """ What probe() found, waiting for the background probe if it's still
+        running (or probing now if it didn't run) """
+    global _results
+    thread = _thread
+    if thread is not None and thread.is_alive():
+        start_wait = time.time()
+        thread.join()
+        logging.debug(_("Waited {0:.1f} seconds for the OS probe").format(
+            time.time() - start_wait))
+    with _lock:
+        results = _results
+    if results is None:
+        results = probe()
+        with _lock:
+            _results = results
+    return results
+
+
+def get_os_dict():
+    """ Returns all detected OSes in a dict, by device (as bootinfo does) """
+    return dict((result['device'], result['name']) for result in get_results())
+
+
+def _quote(text):
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+def grub_entries(results, efi):
+    """ grub menu entries that boot the OSes found, as 30_os-prober
+        would write them """
+    entries = []
+    for result in results:
+        if not result['uuid']:
+            continue
+        title = "{0} (on {1})".format(result['name'], result['device'])
+        header = ["\tinsmod part_msdos", "\tinsmod part_gpt"]
+        if result['type'] in GRUB_MODULES:
+            header.append("\tinsmod {0}".format(GRUB_MODULES[result['type']]))
+        header.append("\tsearch --no-floppy --fs-uuid --set=root {0}".format(result['uuid']))
+        if efi and result['efi_loader']:
+            title = "Windows Boot Manager (on {0})".format(result['device'])
+            body = ["\tchainloader {0}".format(result['efi_loader'])]
+            classes = "--class windows --class os"
+        elif not efi and result['chainload']:
+            body = ["\tparttool ${root} hidden-", "\tdrivemap -s (hd0) ${root}",
+                    "\tchainloader +1"]
+            classes = "--class windows --class os"
+        elif result['grub_cfg']:
+            body = ["\tconfigfile {0}".format(result['grub_cfg'])]
+            classes = "--class gnu-linux --class os"
+        elif result['kernels']:
+            kernel, initrd = result['kernels'][0]
+            body = ["\tlinux {0} root=UUID={1} ro".format(kernel, result['uuid'])]
+            if initrd:
+                body.append("\tinitrd {0}".format(initrd))
+            classes = "--class gnu-linux --class os"
+        else:
+            continue
+        entries.append("menuentry {0} {1} {{\n{2}\n}}\n".format(
+            _quote(title), classes, "\n".join(header + body)))
+    return entries
+
+
+def write_grub_script(dest_dir, efi, exclude=()):
+    """ Writes a grub.d script in dest_dir with the menu entries of the OSes
+        installed in the other partitions. Returns its path """
+    results = probe(exclude)
+    entries = grub_entries(results, efi)
+    path = os.path.join(dest_dir, "etc/grub.d", GRUB_SCRIPT)
+    with open(path, 'w') as script:
+        script.write("#!/bin/sh\n")
+        script.write("# Other OSes found by Thus while installing (instead of os-prober)\n")
+        script.write("cat << 'EOF'\n")
+        script.write("".join(entries))
+        script.write("EOF\n")
+    os.chmod(path, 0o755)
+    logging.debug(_("{0} grub entries written for other OSes").format(len(entries)))
+    return path
@@ -28,8 +28,10 @@ import subprocess
 import shlex
 import logging
 import os
+import tempfile
 
 import misc.misc as misc
+import misc.block_devices as block_devices
 
 # constants
 NAMES = ['btrfs', 'ext2', 'ext3', 'ext4', 'fat16', 'fat32', 'f2fs', 'ntfs', 'jfs', 'reiserfs', 'swap', 'xfs']
@@ -40,37 +42,18 @@ COMMON_MOUNT_POINTS_EFI = ['/', '/boot', '/boot/efi', '/home', '/var']
 
 @misc.raise_privileges
 def get_info(part):
-    """ Get partition info using blkid """
-
-    # Do not try to get extended partition info
-    ret = ''
-    if not misc.is_partition_extended(part):
-        try:
-            ret = subprocess.check_output(['blkid', part]).decode().strip()
-        except subprocess.CalledProcessError as err:
-            logging.warning(err)
-            ret = ''
-
-    partdic = {}
-    for info in ret.split():
-        if '=' in info:
-            info = info.split('=')
-            partdic[info[0]] = info[1].strip('"')
-    return partdic
+    """ Get partition info (as blkid names it) from the device inventory.
+        Regular files (system images) aren't in it, blkid probes them """
+    if os.path.isfile(part):
+        return block_devices.probe(part)
+    # Extended partitions have no info
+    return block_devices.get_info(part)
 
 
 @misc.raise_privileges
 def get_type(part):
-    """ Get filesystem type using blkid """
-    ret = ''
-    if not misc.is_partition_extended(part):
-        try:
-            cmd = ['blkid', '-o', 'value', '-s', 'TYPE', part]
-            ret = subprocess.check_output(cmd).decode().strip()
-        except subprocess.CalledProcessError as err:
-            logging.warning(err)
-            ret = ''
-    return ret
+    """ Get filesystem type from the device inventory (see get_info) """
+    return get_info(part).get('TYPE', '')
 
 
 @misc.raise_privileges
@@ -101,6 +84,7 @@ def label_fs(fstype, part, label):
             logging.error(err)
             ret = (1, err)
             # check_call returns exit code.  0 should mean success
+        block_devices.invalidate(part)
     else:
         ret = (1, _("Can't label a {0} partition").format(fstype))
     return ret
@@ -156,6 +140,7 @@ def create_fs(part, fstype, label='', other_opts=''):
     except subprocess.CalledProcessError as err:
         logging.error(err)
         ret = (True, err)
+    block_devices.invalidate(part)
     return ret
 
 
@@ -165,14 +150,12 @@ def is_ssd(disk_path):
     :param disk_name:
     :return:
     """
-    disk_name = disk_path.split('/')[-1]
-    filename = os.path.join("/sys/block", disk_name, "queue/rotational")
-    if not os.path.exists(filename):
+    ssd = block_devices.is_ssd(disk_path)
+    if ssd is None:
         # Should not happen unless sysfs changes, but better safe than sorry
         logging.warning(_("Can't verify if {0} is a Solid State Drive or not".format(disk_path)))
         return False
-    with open(filename) as f:
-        return f.read() == "0\n"
+    return ssd
 
 # To shrink a partition:
 # 1. Shrink fs
@@ -194,6 +177,8 @@ def resize(part, fs_type, new_size_in_mb):
         res = resize_fat(part, new_size_in_mb)
     elif 'ext' in fs_type:
         res = resize_ext(part, new_size_in_mb)
+    elif 'btrfs' in fs_type:
+        res = resize_btrfs(part, new_size_in_mb)
     else:
         logging.error(_("Sorry but filesystem {0} can't be shrinked".format(fs_type)))
 
@@ -239,3 +224,27 @@ def resize_ext(part, new_size_in_mb):
     logging.debug(result)
 
     return True
+
+
+@misc.raise_privileges
+def resize_btrfs(part, new_size_in_mb):
+    """ Resize a btrfs partition (btrfs can only be resized while mounted) """
+    logging.debug("btrfs filesystem resize {0}M {1}".format(new_size_in_mb, part))
+
+    mount_dir = tempfile.mkdtemp(prefix="thus-btrfs-")
+    try:
+        subprocess.check_call(["mount", "-t", "btrfs", part, mount_dir])
+        try:
+            cmd = ["btrfs", "filesystem", "resize", "{0}M".format(new_size_in_mb), mount_dir]
+            result = subprocess.check_output(cmd)
+        finally:
+            subprocess.call(["umount", mount_dir])
+    except subprocess.CalledProcessError as err:
+        logging.error(err)
+        return False
+    finally:
+        os.rmdir(mount_dir)
+
+    logging.debug(result)
+
+    return True
@@ -32,6 +32,7 @@ import re
 import logging
 
 import misc.misc as misc
+import misc.block_devices as block_devices
 import show_message as show
 
 import parted
@@ -356,6 +357,7 @@ def get_flag(part, flag):
 @misc.raise_privileges
 def finalize_changes(diskob):
     diskob.commit()
+    block_devices.invalidate(diskob.device.path)
 
 
 def order_partitions(partdic):
@@ -22,14 +22,282 @@
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #  MA 02110-1301, USA.
 
-""" Get partition used space """
+""" Get partition used space
 
+    The superblock (or boot sector) of most filesystems says how much of them
+    is used, so it's read directly. The filesystem tools (which scrape their
+    output, and for FAT check the whole filesystem) are only used when the
+    filesystem can't be read that way. Run this file with partitions (and
+    their types) as arguments to compare both ways """
+
+import array
+import os
+import struct
 import subprocess
 import shlex
 import logging
+import sys
+import time
 
 import misc.misc as misc
 
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+
+class SuperblockError(Exception):
+    """ The filesystem can't be read directly (wrong magic, unsupported
+        layout). Its tool has to be used """
+    pass
+
+
+def _pread(part, offset, size):
+    fd = os.open(part, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        data = os.pread(fd, size, offset)
+    finally:
+        os.close(fd)
+    if len(data) < size:
+        raise SuperblockError(_("{0} is too small").format(part))
+    return data
+
+
+def _count_bits(data):
+    """ Number of bits set in data """
+    count = 0
+    for start in range(0, len(data), 1024 * 1024):
+        count += bin(int.from_bytes(data[start:start + 1024 * 1024], 'little')).count('1')
+    return count
+
+
+@misc.raise_privileges
+def read_used_ext(part):
+    """ Reads the used space of an ext2/3/4 filesystem from its superblock """
+    sb = _pread(part, 1024, 1024)
+    if struct.unpack_from('<H', sb, 0x38)[0] != 0xEF53:
+        raise SuperblockError(_("No ext superblock in {0}").format(part))
+    blocks, free = struct.unpack_from('<I', sb, 0x04)[0], struct.unpack_from('<I', sb, 0x0C)[0]
+    incompat = struct.unpack_from('<I', sb, 0x60)[0]
+    if incompat & 0x80:
+        # 64bit feature: high halves of the counts
+        blocks |= struct.unpack_from('<I', sb, 0x150)[0] << 32
+        free |= struct.unpack_from('<I', sb, 0x158)[0] << 32
+    return (blocks - free) / blocks
+
+
+def _fat_free_clusters(fat, clusters, bits):
+    """ Free entries for clusters 2..clusters+1 of a FAT """
+    if bits == 12:
+        free = 0
+        for cluster in range(2, clusters + 2):
+            value = struct.unpack_from('<H', fat, cluster * 3 // 2)[0]
+            value = value >> 4 if cluster & 1 else value & 0xFFF
+            if value == 0:
+                free += 1
+        return free
+    entries = array.array('H' if bits == 16 else 'I')
+    entries.frombytes(fat[:(clusters + 2) * bits // 8])
+    if sys.byteorder != 'little':
+        entries.byteswap()
+    entries = entries[2:]
+    if bits == 16:
+        return entries.count(0)
+    # The top 4 bits of a FAT32 entry are reserved
+    return sum(entries.count(high << 28) for high in range(16))
+
+
+@misc.raise_privileges
+def read_used_fat(part):
+    """ Reads the used space of a FAT12/16/32 filesystem from its boot
+        sector and first FAT, as dosfsck counts it """
+    boot = _pread(part, 0, 512)
+    if boot[510:512] != b'\x55\xaa':
+        raise SuperblockError(_("No FAT boot sector in {0}").format(part))
+    (sector_size, sectors_per_cluster, reserved, fat_count, root_entries,
+     total16) = struct.unpack_from('<HBHBHH', boot, 11)
+    fat_size = struct.unpack_from('<H', boot, 22)[0] or struct.unpack_from('<I', boot, 36)[0]
+    total = total16 or struct.unpack_from('<I', boot, 32)[0]
+    if not sector_size or not sectors_per_cluster or not fat_size:
+        raise SuperblockError(_("No FAT boot sector in {0}").format(part))
+    root_sectors = (root_entries * 32 + sector_size - 1) // sector_size
+    data_start = reserved + fat_count * fat_size + root_sectors
+    clusters = (total - data_start) // sectors_per_cluster
+    if clusters < 4085:
+        bits = 12
+    elif clusters < 65525:
+        bits = 16
+    else:
+        bits = 32
+    fat = _pread(part, reserved * sector_size, fat_size * sector_size)
+    used = clusters - _fat_free_clusters(fat, clusters, bits)
+    cluster_size = sector_size * sectors_per_cluster
+    return (data_start * sector_size + used * cluster_size) / (clusters * cluster_size)
+
+
+def _ntfs_fixup(record, sector_size=512):
+    """ Puts back the bytes the update sequence array replaced """
+    usa_offset, usa_count = struct.unpack_from('<HH', record, 4)
+    record = bytearray(record)
+    for index in range(1, usa_count):
+        end = index * sector_size
+        record[end - 2:end] = record[usa_offset + index * 2:usa_offset + index * 2 + 2]
+    return bytes(record)
+
+
+def _ntfs_runs(runlist):
+    """ (lcn, clusters) of each run of a runlist (lcn None if sparse) """
+    runs = []
+    position = 0
+    lcn = 0
+    while runlist[position] != 0:
+        header = runlist[position]
+        length_size, offset_size = header & 0x0F, header >> 4
+        position += 1
+        length = int.from_bytes(runlist[position:position + length_size], 'little')
+        position += length_size
+        if offset_size:
+            lcn += int.from_bytes(runlist[position:position + offset_size], 'little', signed=True)
+            runs.append((lcn, length))
+        else:
+            runs.append((None, length))
+        position += offset_size
+    return runs
+
+
+@misc.raise_privileges
+def read_used_ntfs(part):
+    """ Reads the used space of a NTFS filesystem counting the clusters its
+        $Bitmap marks as used (as ntfsinfo does) """
+    boot = _pread(part, 0, 512)
+    if boot[3:11] != b'NTFS    ':
+        raise SuperblockError(_("No NTFS boot sector in {0}").format(part))
+    sector_size = struct.unpack_from('<H', boot, 0x0B)[0]
+    sectors_per_cluster = boot[0x0D]
+    if sectors_per_cluster > 0x80:
+        sectors_per_cluster = 1 << (256 - sectors_per_cluster)
+    cluster_size = sector_size * sectors_per_cluster
+    total_clusters = struct.unpack_from('<Q', boot, 0x28)[0] // sectors_per_cluster
+    mft_lcn = struct.unpack_from('<Q', boot, 0x30)[0]
+    record_clusters = struct.unpack_from('<b', boot, 0x40)[0]
+    if record_clusters < 0:
+        record_size = 1 << -record_clusters
+    else:
+        record_size = record_clusters * cluster_size
+
+    # MFT record 6 is $Bitmap
+    record = _pread(part, mft_lcn * cluster_size + 6 * record_size, record_size)
+    if record[:4] != b'FILE':
+        raise SuperblockError(_("Can't read the $Bitmap record of {0}").format(part))
+    record = _ntfs_fixup(record)
+    offset = struct.unpack_from('<H', record, 0x14)[0]
+    runs = None
+    while offset + 16 <= len(record):
+        attribute_type, length = struct.unpack_from('<II', record, offset)
+        if attribute_type == 0xFFFFFFFF or length == 0:
+            break
+        non_resident, name_length = record[offset + 8], record[offset + 9]
+        if attribute_type == 0x80 and name_length == 0:
+            if not non_resident:
+                raise SuperblockError(_("Resident $Bitmap in {0}").format(part))
+            runlist_offset = struct.unpack_from('<H', record, offset + 0x20)[0]
+            runs = _ntfs_runs(record[offset + runlist_offset:offset + length])
+            break
+        offset += length
+    if runs is None:
+        # Most likely in an attribute list, leave it to ntfsinfo
+        raise SuperblockError(_("Can't find the $Bitmap data of {0}").format(part))
+
+    needed = (total_clusters + 7) // 8
+    bitmap = bytearray()
+    for lcn, clusters in runs:
+        if len(bitmap) >= needed:
+            break
+        size = min(clusters * cluster_size, needed - len(bitmap))
+        bitmap += b'\0' * size if lcn is None else _pread(part, lcn * cluster_size, size)
+    bitmap = bytes(bitmap[:needed])
+    used = _count_bits(bitmap[:total_clusters // 8])
+    if total_clusters % 8:
+        used += bin(bitmap[-1] & ((1 << (total_clusters % 8)) - 1)).count('1')
+    return used / total_clusters
+
+
+@misc.raise_privileges
+def read_used_xfs(part):
+    """ Reads the used space of a XFS filesystem from its primary superblock
+        (as xfs_db -c 'sb 0' does) """
+    sb = _pread(part, 0, 512)
+    if sb[:4] != b'XFSB':
+        raise SuperblockError(_("No XFS superblock in {0}").format(part))
+    dblocks = struct.unpack_from('>Q', sb, 8)[0]
+    fdblocks = struct.unpack_from('>Q', sb, 144)[0]
+    return (dblocks - fdblocks) / dblocks
+
+
+@misc.raise_privileges
+def read_used_btrfs(part):
+    """ Reads the space of the device allocated by a Btrfs filesystem from
+        the device item of its superblock (as btrfs filesystem show does) """
+    sb = _pread(part, 0x10000, 4096)
+    if sb[0x40:0x48] != b'_BHRfS_M':
+        raise SuperblockError(_("No Btrfs superblock in {0}").format(part))
+    total, used = struct.unpack_from('<QQ', sb, 0xD1)
+    return used / total
+
+
+@misc.raise_privileges
+def read_used_jfs(part):
+    """ Reads the used space of a JFS filesystem from the control page of its
+        block allocation map """
+    sb = _pread(part, 0x8000, 512)
+    if sb[:4] != b'JFS1':
+        raise SuperblockError(_("No JFS superblock in {0}").format(part))
+    block_size = struct.unpack_from('<i', sb, 16)[0]
+    # The block map is inode 2 of the aggregate inode table (at 0xB000)
+    inode = _pread(part, 0xB000 + 2 * 512, 512)
+    if struct.unpack_from('<I', inode, 8)[0] != 2:
+        raise SuperblockError(_("Can't read the block map inode of {0}").format(part))
+    # Root of its extent tree, whose first extent starts with the control page
+    flag, next_index = inode[224 + 16], struct.unpack_from('<H', inode, 224 + 18)[0]
+    if not flag & 0x02 or next_index <= 2:
+        raise SuperblockError(_("Unexpected block map of {0}").format(part))
+    length_address, address = struct.unpack_from('<II', inode, 224 + 32 + 8)
+    address |= (length_address >> 24) << 32
+    control = _pread(part, address * block_size, 16)
+    map_size, free = struct.unpack_from('<qq', control, 0)
+    return (map_size - free) / map_size
+
+
+@misc.raise_privileges
+def read_used_reiser(part):
+    """ Reads the used space of a ReiserFS filesystem from its superblock """
+    sb = _pread(part, 0x10000, 64)
+    if not sb[52:62].startswith(b'ReIsEr'):
+        raise SuperblockError(_("No ReiserFS superblock in {0}").format(part))
+    blocks, free = struct.unpack_from('<II', sb, 0)
+    return (blocks - free) / blocks
+
+
+@misc.raise_privileges
+def read_used_f2fs(part):
+    """ Reads the used space of a F2FS filesystem from its newest checkpoint """
+    sb = _pread(part, 1024, 128)
+    if struct.unpack_from('<I', sb, 0)[0] != 0xF2F52010:
+        raise SuperblockError(_("No F2FS superblock in {0}").format(part))
+    log_block_size, log_blocks_per_segment = struct.unpack_from('<II', sb, 16)
+    checkpoint_address = struct.unpack_from('<I', sb, 76)[0]
+    block_size = 1 << log_block_size
+    # There are two checkpoint packs, one segment apart
+    checkpoints = []
+    for pack in range(2):
+        address = checkpoint_address + pack * (1 << log_blocks_per_segment)
+        checkpoints.append(struct.unpack_from('<QQQ', _pread(part, address * block_size, 24)))
+    version, user_blocks, valid_blocks = max(checkpoints)
+    return valid_blocks / user_blocks
+
 
 @misc.raise_privileges
 def get_used_ntfs(part):
@@ -247,11 +515,24 @@ def get_used_f2fs(part):
 
 def is_btrfs(part):
     """ Checks if part is a Btrfs partition """
-    space = get_used_btrfs(part)
-    if not space:
+    try:
+        read_used_btrfs(part)
+    except (OSError, SuperblockError, ZeroDivisionError):
         return False
-    else:
-        return True
+    return True
+
+
+# Filesystems (by a part of their name), with the function that reads them
+# and the tool it replaces
+USED_SPACE_READERS = [
+    ('ntfs', read_used_ntfs, get_used_ntfs),
+    ('ext', read_used_ext, get_used_ext),
+    ('fat', read_used_fat, get_used_fat),
+    ('jfs', read_used_jfs, get_used_jfs),
+    ('reiser', read_used_reiser, get_used_reiser),
+    ('btrfs', read_used_btrfs, get_used_btrfs),
+    ('xfs', read_used_xfs, get_used_xfs),
+    ('f2fs', read_used_f2fs, get_used_f2fs)]
 
 
 def get_used_space(part, part_type):
@@ -259,22 +540,37 @@ def get_used_space(part, part_type):
 
     part_type = part_type.lower()
 
-    if 'ntfs' in part_type:
-        space = get_used_ntfs(part)
-    elif 'ext' in part_type:
-        space = get_used_ext(part)
-    elif 'fat' in part_type:
-        space = get_used_fat(part)
-    elif 'jfs' in part_type:
-        space = get_used_jfs(part)
-    elif 'reiser' in part_type:
-        space = get_used_reiser(part)
-    elif 'btrfs' in part_type:
-        space = get_used_btrfs(part)
-    elif 'xfs' in part_type:
-        space = get_used_xfs(part)
-    elif 'f2fs' in part_type:
-        space = get_used_f2fs(part)
+    for name, reader, tool in USED_SPACE_READERS:
+        if name in part_type:
+            try:
+                return reader(part)
+            except (OSError, SuperblockError, struct.error, ZeroDivisionError) as err:
+                logging.debug(_("Can't read the used space of {0} directly, "
+                                "using its tool: {1}").format(part, err))
+                return tool(part)
+    return 0
+
+
+def benchmark(part, part_type, rounds=10):
+    """ Times the superblock reader against the tool it replaces. Returns
+        (reader result, seconds), (tool result, seconds) """
+    for name, reader, tool in USED_SPACE_READERS:
+        if name in part_type.lower():
+            break
     else:
-        space = 0
-    return space
+        raise ValueError(_("Unknown filesystem type {0}").format(part_type))
+    results = []
+    for function, count in ((reader, rounds), (tool, 1)):
+        start = time.perf_counter()
+        for i in range(count):
+            used = function(part)
+        results.append((used, (time.perf_counter() - start) / count))
+    return results
+
+
+if __name__ == '__main__':
+    # used_space.py /dev/sda1 ntfs /dev/sda2 ext4 ...
+    for part, part_type in zip(sys.argv[1::2], sys.argv[2::2]):
+        (native, native_time), (tool, tool_time) = benchmark(part, part_type)
+        print("{0} ({1}): superblock {2:.4f} in {3:.1f} us, tool {4:.4f} in {5:.1f} ms".format(
+            part, part_type, native, native_time * 1e6, tool, tool_time * 1e3))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  prefetch.py
+#
+#  Copyright © 2013-2015 Manjaro (http://manjaro.org)
+#
+#  This file is part of Thus.
+#
+#  Thus is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  Thus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Thus; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Reads the live images into the page cache while the user is still going
+    through the first screens, so the copy doesn't wait for a slow medium """
+
+import logging
+import os
+import threading
+import time
+
+import misc.misc as misc
+
+from configobj import ConfigObj
+
+# When testing, no _() is available
+try:
+    _("")
+except NameError as err:
+    def _(message):
+        return message
+
+conf_file = '/etc/thus.conf'
+configuration = ConfigObj(conf_file)
+
+# Bytes read at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Memory and installer state are checked (and progress reported) every
+# this many bytes
+CHECK_INTERVAL = 64 * 1024 * 1024
+
+# Seconds to wait the first time memory is short, doubled up to MAX_BACKOFF
+MIN_BACKOFF = 1
+MAX_BACKOFF = 30
+
+
+class PrefetchThread(threading.Thread):
+    """ Streams the images into the page cache, in the order the copy will
+        read them. Keeps away from the memory the system needs: at most
+        max_bytes are read and reading pauses while free memory is below
+        reserve_bytes. Stops as soon as the copy starts (copy_started
+        setting). The warm fraction of each image is stored in the
+        prefetch_warm setting """
+
+    def __init__(self, settings, images, max_bytes, reserve_bytes):
+        super(PrefetchThread, self).__init__(daemon=True)
+        self.settings = settings
+        self.images = images
+        self.max_bytes = max_bytes
+        self.reserve_bytes = reserve_bytes
+        self.warm = dict((image, 0.0) for image in images)
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def must_stop(self):
+        return (self.stop_event.is_set() or
+                self.settings.get('stop_all_threads') or
+                self.settings.get('copy_started'))
+
+    def wait_for_memory(self):
+        """ Backs off while free memory is short. Returns False if we have
+            to stop meanwhile """
+        backoff = MIN_BACKOFF
+        while misc.get_meminfo().get('MemFree', 0) < self.reserve_bytes:
+            if self.must_stop():
+                return False
+            self.stop_event.wait(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        return True
+
+    def prefetch(self, image, budget):
+        """ Reads an image (or its first budget bytes). Returns the bytes read """
+        buf = bytearray(CHUNK_SIZE)
+        done = 0
+        next_check = 0
+        with open(image, 'rb', buffering=0) as image_file:
+            size = os.fstat(image_file.fileno()).st_size
+            limit = min(size, budget)
+            while done < limit:
+                if done >= next_check:
+                    next_check = done + CHECK_INTERVAL
+                    self.warm[image] = done / size
+                    self.settings.set('prefetch_warm', dict(self.warm))
+                    if self.must_stop() or not self.wait_for_memory():
+                        break
+                count = image_file.readinto(buf)
+                if not count:
+                    break
+                done += count
+            self.warm[image] = done / size if size else 1.0
+        self.settings.set('prefetch_warm', dict(self.warm))
+        return done
+
+    def run(self):
+        start = time.time()
+        budget = self.max_bytes
+        for image in self.images:
+            if budget <= 0 or self.must_stop():
+                break
+            try:
+                budget -= self.prefetch(image, budget)
+            except OSError as err:
+                logging.warning(_("Can't prefetch {0}: {1}").format(image, err))
+        warm = ", ".join("{0} {1:.0%}".format(os.path.basename(image), fraction)
+                         for image, fraction in self.warm.items())
+        logging.debug(_("Prefetch finished after {0:.0f} seconds: {1}").format(
+            time.time() - start, warm))
+
+
+def start(settings):
+    """ Starts prefetching the live images, if enabled and worth it.
+        Returns the thread (or None) """
+    install = configuration['install']
+    if install.get('PREFETCH', 'False').lower() not in ('true', 'yes', '1'):
+        return None
+    images = [install['LIVE_MEDIA_SOURCE'], install['LIVE_MEDIA_DESKTOP']]
+
+    medium, disk = misc.get_source_medium(images[0])
+    if medium == 'RAM':
+        logging.debug(_("Live images are already in RAM, no need to prefetch them"))
+        return None
+
+    meminfo = misc.get_meminfo()
+    max_bytes = meminfo.get('MemTotal', 0) * int(install.get('PREFETCH_MEMORY', 50)) // 100
+    max_bytes = min(max_bytes, meminfo.get('MemAvailable', 0))
+    reserve_bytes = int(install.get('PREFETCH_RESERVE_MB', 768)) * 1024 * 1024
+    max_bytes -= reserve_bytes
+    if max_bytes <= 0:
+        logging.debug(_("Not enough memory to prefetch the live images"))
+        return None
+
+    logging.debug(_("Prefetching up to {0} of the live images from {1}").format(
+        misc.format_size(max_bytes), medium))
+    thread = PrefetchThread(settings, [image for image in images if os.path.exists(image)],
+                            max_bytes, reserve_bytes)
+    thread.start()
+    return thread
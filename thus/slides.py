@@ -32,8 +32,7 @@ import sys
 import logging
 import subprocess
 
-import queue
-
+import event_bus
 import show_message as show
 import misc.misc as misc
 
@@ -109,7 +108,7 @@ class Slides(GtkBaseBox):
         self.forward_button.hide()
         self.exit_button.hide()
 
-        GLib.timeout_add(400, self.manage_events_from_cb_queue)
+        GLib.timeout_add(int(event_bus.TICK * 1000), self.manage_events_from_cb_queue)
 
     @staticmethod
     def store_values():
@@ -145,9 +144,21 @@ class Slides(GtkBaseBox):
             self.should_pulse = True
             GLib.timeout_add(100, pbar_pulse)
 
+    @staticmethod
+    def format_copy_progress(progress):
+        """ Formats a copy-progress event: bytes copied, rate and time left """
+        txt = _("{0} of {1} ({2:.1f} MB/s)").format(
+            misc.format_size(progress['bytes_done']),
+            misc.format_size(progress['bytes_total']),
+            progress['rate'])
+        if progress['eta'] is not None:
+            minutes, seconds = divmod(int(progress['eta']), 60)
+            txt += " - " + _("{0}:{1:02d} left").format(minutes, seconds)
+        return txt
+
     def manage_events_from_cb_queue(self):
-        """ We should do as less as possible here, we want to maintain our
-            queue message as empty as possible """
+        """ We should do as less as possible here. Called once per tick, gets
+            the events received since the last one in a single batch """
 
         if self.fatal_error:
             return False
@@ -155,12 +166,7 @@ class Slides(GtkBaseBox):
         if self.callback_queue is None:
             return True
 
-        while not self.callback_queue.empty():
-            try:
-                event = self.callback_queue.get_nowait()
-            except queue.Empty:
-                return True
-
+        for event in self.callback_queue.get_batch():
             if event[0] == 'percent':
                 self.progress_bar.set_fraction(float(event[1]))
             elif event[0] == 'downloads_percent':
@@ -172,6 +178,9 @@ class Slides(GtkBaseBox):
                 else:
                     self.progress_bar.set_show_text(True)
                     self.progress_bar.set_text(event[1])
+            elif event[0] == 'copy-progress':
+                self.progress_bar.set_show_text(True)
+                self.progress_bar.set_text(self.format_copy_progress(event[1]))
             elif event[0] == 'pulse':
                 if event[1] == 'stop':
                     self.stop_pulse()
@@ -202,6 +211,7 @@ class Slides(GtkBaseBox):
                         misc.drop_privileges()
                         webbrowser.open('https://wiki.archlinux.org/index.php/GRUB')
 
+                self.log_event_stats()
                 install_ok = _("Installation Complete!\nDo you want to restart your system now?")
                 response = show.question(self.get_toplevel(), install_ok)
                 misc.remove_temp_files()
@@ -213,9 +223,9 @@ class Slides(GtkBaseBox):
                     sys.exit(0)
                 return False
             elif event[0] == 'error':
-                self.callback_queue.task_done()
                 # A fatal error has been issued. We empty the queue
-                self.empty_queue()
+                self.callback_queue.clear()
+                self.log_event_stats()
 
                 # Show the error
                 show.fatal_error(self.get_toplevel(), event[1])
@@ -226,18 +236,15 @@ class Slides(GtkBaseBox):
                 else:
                     self.set_message(event[1])
 
-            self.callback_queue.task_done()
-
         return True
 
-    def empty_queue(self):
-        """ Empties messages queue """
-        while not self.callback_queue.empty():
-            try:
-                self.callback_queue.get_nowait()
-                self.callback_queue.task_done()
-            except queue.Empty:
-                return
+    def log_event_stats(self):
+        """ Logs how the installer events were delivered """
+        stats = self.callback_queue.stats()
+        logging.debug(_("Installer events: {0} shown, {1} superseded, latency {2:.0f} ms "
+                        "(max {3:.0f} ms)").format(stats['delivered'], stats['dropped'],
+                                                   stats['latency_avg'] * 1000,
+                                                   stats['latency_max'] * 1000))
 
     @misc.raise_privileges
     def reboot(self):